@@ -1,14 +1,20 @@
-import glob
+import argparse
 import random
-import cv2
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import os
 import sys
+from src.dataset.manifest import Manifest
+from src.dataset.video_clips import plan_clips, encode_clips, save_clip_index
 sys.stderr.write("CWD: {}\n".format(os.getcwd()))
 """
 Preprocessing step 1:
-splits the Video files into 4 seconds snippets
+splits the Video files into 4 seconds snippets.
+The clips of all videos are planned first (see src/dataset/video_clips.py), then the videos are encoded in parallel.
+Reruns only encode the videos that are new, changed or whose clips changed (see src/dataset/manifest.py).
+The planned clips are saved as virtual clips in "clips.json", with --virtual no clip is encoded and the following steps
+decode the clips directly from the original videos.
 """
 
 random.seed(12345)
@@ -28,57 +34,75 @@ def add_noise(image):
     noisy = image + gauss
     return noisy
 
+
+def clip_file(out_path, clip_id):
+    return out_path / (str(clip_id).zfill(5) + ".mp4")
+
+
 output_size = (int(2048 / 4), int(1080 / 4))
 fps = 29
 MAX_DURATION = 4
 
 splits = ["train", "test"]
 
-fourcc = cv2.VideoWriter_fourcc(*"mp4v")
-for split in splits:
-    vid_path = Path("src/dataset/data/videos/YT_originals") / split
-    video_names = [vid.stem for vid in vid_path.glob("*")]
-
-    out_path = Path("src/dataset/data/videos/YT_4sec") / split
-    input_out_path = out_path / "input"
-    input_out_path.mkdir(parents=True, exist_ok=True)
-    i = 0
-    video_counter = 0
-    for vid in video_names:
-        print("--------------------------------")
-        print("video: ", vid)
-        cap = cv2.VideoCapture(str(vid_path / vid) + ".mp4")
-        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
-        frame_rate = int(cap.get(cv2.CAP_PROP_FPS))
-        cap.set(cv2.CAP_PROP_FPS, fps)
-        start = True
-        frame_counter = 0
-        starter_frame = 0
-        while cap.isOpened():
-            ret, frame = cap.read()
-            if ret:
-                if start:
-                    out_name = str(video_counter).zfill(5) + '.mp4'
-                    out_input = cv2.VideoWriter(str(input_out_path / out_name),
-                                                fourcc,
-                                                fps, output_size)
-
-                if starter_frame + MAX_DURATION * frame_rate == frame_counter:  # if 4 seconds passed break
-                    video_counter += 1
-                    starter_frame = frame_counter
-                    if starter_frame + MAX_DURATION * frame_rate > total_frames:  # stop if last bit would not fit in 4 sec.
-                        out_input.release()
-                        break
-                    out_name = str(video_counter).zfill(5) + '.mp4'
-                    out_input = cv2.VideoWriter(str(input_out_path / out_name),
-                                                fourcc,
-                                                fps, output_size)
-                start = False
-                frame = cv2.resize(frame, output_size)
-                out_input.write(np.uint8(frame))
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--virtual", action="store_true",
+                        help="only saves the index of the clips (clips.json) instead of encoding them")
+    args = parser.parse_args()
+    # number of processes, on the grid the number of requested slots ("-pe default <n>")
+    num_processes = int(os.environ.get("NSLOTS", os.cpu_count()))
+    for split in splits:
+        vid_path = Path("src/dataset/data/videos/YT_originals") / split
+        video_names = sorted(vid.stem for vid in vid_path.glob("*"))  # the clip ids depend on the order
 
-                frame_counter += 1
-            else:
-                break
-        cap.release()
-        out_input.release()
\ No newline at end of file
+        out_path = Path("src/dataset/data/videos/YT_4sec") / split
+        input_out_path = out_path / "input"
+        input_out_path.mkdir(parents=True, exist_ok=True)
+        # the clip ids are planned in the order of the videos, afterwards the videos can be encoded in parallel
+        plan = plan_clips([str(vid_path / vid) + ".mp4" for vid in video_names], max_duration=MAX_DURATION)
+        save_clip_index(plan, out_path / "clips.json", output_size)
+        if args.virtual:
+            print("{}: saved {} virtual clips".format(split, sum(len(clips) for clips in plan.values())))
+            continue
+        manifest = Manifest(out_path / "manifest.json",
+                            {"output_size": output_size, "fps": fps, "max_duration": MAX_DURATION})
+        # a video is unchanged if its content and the frame ranges of its clips are the same, the clip ids of the
+        # following videos shift if a video is added or removed, their clips are only renamed
+        signatures = {video_file: {"hash": manifest.hash(video_file),
+                                   "ranges": [[start, end] for _, start, end in clips]}
+                      for video_file, clips in plan.items()}
+        todo = [video_file for video_file in plan
+                if not manifest.unchanged(video_file, signatures[video_file]) or
+                not all(clip_file(input_out_path, clip_id).exists()
+                        for clip_id, _, _ in manifest.entries[video_file]["clips"])]
+        renames = [(old[0], new[0]) for video_file in plan if video_file not in todo
+                   for old, new in zip(manifest.entries[video_file]["clips"], plan[video_file]) if old[0] != new[0]]
+        # the renamed clips are moved out of the way first, their new names may still be taken by other clips
+        for old_id, _ in renames:
+            os.replace(str(clip_file(input_out_path, old_id)), str(clip_file(input_out_path, old_id)) + ".tmp")
+        # clips of removed videos that are not written again
+        planned_ids = {clip_id for clips in plan.values() for clip_id, _, _ in clips}
+        for video_file in list(manifest.entries):
+            if video_file not in plan or video_file in todo:
+                for clip_id, _, _ in manifest.entries.pop(video_file)["clips"]:
+                    if clip_id not in planned_ids and clip_file(input_out_path, clip_id).exists():
+                        os.remove(str(clip_file(input_out_path, clip_id)))
+        for old_id, new_id in renames:
+            os.replace(str(clip_file(input_out_path, old_id)) + ".tmp", str(clip_file(input_out_path, new_id)))
+        for video_file in plan:
+            if video_file not in todo:
+                manifest.entries[video_file] = dict(signatures[video_file],
+                                                    clips=[list(clip) for clip in plan[video_file]])
+        manifest.save()
+        print("{}: {} of {} videos unchanged ({} clips renamed)".format(split, len(plan) - len(todo), len(plan),
+                                                                        len(renames)))
+        with ProcessPoolExecutor(max_workers=num_processes) as executor:
+            futures = [executor.submit(encode_clips, video_file, plan[video_file], input_out_path, output_size, fps)
+                       for video_file in todo]
+            for future in as_completed(futures):
+                video_file, num_clips = future.result()
+                manifest.entries[video_file] = dict(signatures[video_file],
+                                                    clips=[list(clip) for clip in plan[video_file]])
+                print("video: {} ({} clips)".format(video_file, num_clips))
+        manifest.save()
@@ -4,9 +4,12 @@ from PIL import Image
 import torchvision.transforms as T
 import torchvision.transforms.functional as TF
 import torch
-import json
 from torch.utils import data
 import numpy as np
+from src.dataset.frame_store import PackedFrameStore
+from src.dataset.index import DATA_ROOT, FrameIndex
+from src.dataset.masks import PackedMasks
+from src.dataset.backgrounds import background_index, background_paths
 
 
 def vstack(images):
@@ -57,37 +60,60 @@ class YT_Greenscreen(data.Dataset):
     """
     This dataset class implements data.Dataset and is supposed to be used in conjunction with PyTorch Dataloader.
     It is designed to work on the Grid Network and can be interrupted and restarted at any epoch and any batch.
-    Unfortunately, it is not possible to provide the Dataloader with a "Batch start index".
-    Therefore, this class has a work around that allows to continue training at any specific batch index wanted.
+    The position in the epoch is tracked by the batch samplers in src/dataset/samplers.py, which are stored in the
+    checkpoint and continue at the exact batch after a restart.
     It is important to consider that this class returns more than just the input and ground truth image.
     For more details pls read the __getitem__ documentation.
 
     The Images need to be saved in "src/dataset/data/images/YT_4sec/[train|test]" and a log file located at:
     "src/dataset/data/images/YT_4sec/[train|test]/out_log.json" needs to be provided.
     This log file contains the paths of the image files and a flag that is true if a new 4 sec. video clip starts.
+    It is converted once into a compact index (see src/dataset/index.py), which is shared by all DataLoader workers.
+    If the bit-packed masks of src/dataset/masks.py exist, they are used instead of the JPEG labels.
 
     :param train: if true returns the training dataset else returns the testing dataset
-    :param start_index: from which dataset index should the training start
     :param batch_size: batch size provided to the loader
-    :param seed: enables reproducability
+    :param seed: enables reproducability. The augmentation of each clip is derived from the seed, the epoch and the
+                 clip index (see clip_transform()), so the dataset can be used with multiple DataLoader workers.
     :param apply_transform: turn on data augmentation
+    :param packed: if true the frames are read from the memory-mapped arrays created by src/dataset/frame_store.py
+                   instead of decoding the JPEG files listed in the log file
+    :param device_augment: if true no augmentation is applied in __getitem__. Instead the batches are augmented after
+                           collation with src.dataset.augmentation.BatchAugmentation and augmentation_params().
+                           Frames and labels are returned as uint8 tensors in that case and are converted to float on
+                           the device (see src.dataset.prefetcher.DevicePrefetcher)
+    :param foreground: if true the green screen frames of "foreground/" are returned instead of the inputs with the
+                       baked in background. The background is inserted after collation by
+                       src.dataset.backgrounds.BackgroundBank (see background_indices()). Requires device_augment and
+                       can not be used with packed.
     """
-    def __init__(self, train=True, start_index=torch.tensor([0]), batch_size=1, seed=0, apply_transform=True):
+    def __init__(self, train=True, batch_size=1, seed=0, apply_transform=True,
+                 packed=False, device_augment=False, foreground=False):
         """
                 Please see help(YT_Greenscreen) for more information.
         """
         self.train = train
         self.mode = "train" if train else "test"
-        with open("src/dataset/data/images/YT_4sec/" + self.mode + "/out_log.json", "r") as json_file:
-            self.data = json.load(json_file)
-        self.start_index = start_index if isinstance(start_index, int) else start_index[0].item()
+        self.store = None
+        self.index = None
+        self.masks = None
+        if packed:
+            self.store = PackedFrameStore(self.mode)
+        else:
+            self.index = FrameIndex(self.mode)
+            if PackedMasks.exists(DATA_ROOT / self.mode / "masks"):
+                self.masks = PackedMasks(DATA_ROOT / self.mode / "masks")
+        # index of the first frame of every 4 sec. clip, the last entry is the number of frames
+        self.clip_offsets = self.store.offsets if self.store is not None else self.index.offsets
         self.seed = seed  # makes sure the transformations are applied equally
-        self.cur_idx = self.start_index
-        self.transform = Segmentation_transform(seed=self.seed)
+        self.epoch = 0
         self.batch_size = batch_size
         self.apply_transform = apply_transform
-        self.zeros_inp = None
-        self.zeros_lbl = None
+        self.device_augment = device_augment
+        self.foreground = foreground
+        if foreground and (packed or not device_augment):
+            raise ValueError("foreground frames can only be used with device_augment and without packed frames")
+        self.num_backgrounds = len(background_paths(self.mode)) if foreground else 0
         self.set_seeds(self.seed)
 
     def __len__(self):
@@ -96,7 +122,7 @@ class YT_Greenscreen(data.Dataset):
         Cuts off the last few images that would not fit in the last batch
         :return: length of the dataset
         """
-        length = len(self.data["inputs"])
+        length = len(self.store) if self.store is not None else len(self.index)
         rest = length % self.batch_size
 
         return length - rest  # self.batch_size * 500 #length - rest
@@ -115,57 +141,150 @@ class YT_Greenscreen(data.Dataset):
             torch.backends.cudnn.deterministic = True
             torch.backends.cudnn.benchmark = False
 
-    def set_start_index(self, idx):
+    def load_frame(self, idx):
+        """
+        loads a single frame either from the packed frame store or from the JPEG files
+        :param idx: index of the frame
+        :return: video_start, input image (RGB), label image (L)
         """
-        helper function to set the start index
+        if self.store is not None:
+            video_start = bool(self.store.video_start[idx])
+            img = Image.fromarray(self.store.frames[idx])
+            lbl = Image.fromarray(self.store.masks[idx] * 255)
+        else:
+            video_start = self.index.video_start(idx)
+            img = Image.open(self.index.input_path(idx))
+            lbl = Image.fromarray(self.load_mask(idx) * 255)
+        return video_start, img, lbl
 
-        :param idx: int or torch tensor
+    def load_arrays(self, idx):
+        """
+        loads a single frame as uint8 arrays without any PIL or float conversion
+        :param idx: index of the frame
+        :return: video_start, frame (H, W, 3), mask (H, W) with values 0 and 1
         """
-        if isinstance(idx, int):
-            self.start_index = idx
+        if self.store is not None:
+            video_start = bool(self.store.video_start[idx])
+            frame = np.array(self.store.frames[idx])
+            mask = np.array(self.store.masks[idx])
         else:
-            self.start_index = idx[0].item()
+            video_start = self.index.video_start(idx)
+            path = self.index.foreground_path(idx) if self.foreground else self.index.input_path(idx)
+            frame = np.array(Image.open(path).convert("RGB"))
+            mask = self.load_mask(idx)
+        return video_start, frame, mask
+
+    def load_mask(self, idx):
+        """
+        loads the label of a frame from the bit-packed masks or, if they do not exist, from the JPEG label
+        (not used for the packed frame store)
+        :param idx: index of the frame
+        :return: uint8 mask (H, W) with the values 0 and 1
+        """
+        if self.masks is not None:
+            clip = self.clip_index(idx)
+            return self.masks.mask(clip, idx - int(self.index.clip_start[clip]))
+        # same rounding as the float conversion: values >= 128 belong to the person
+        return (np.array(Image.open(self.index.label_path(idx)).convert("L")) >= 128).astype(np.uint8)
+
+    def load_sample(self, idx, clip):
+        """
+        loads a frame and its label as tensors.
+        If device_augment is true they stay uint8 ((3, H, W) and (H, W)), else the augmentation of the clip is applied
+        to the PIL images and float / long tensors are returned.
+        :param idx: index of the frame
+        :param clip: index of the 4 sec. clip the frame belongs to
+        :return: video_start, input, label
+        """
+        if self.device_augment:
+            video_start, frame, mask = self.load_arrays(idx)
+            return video_start, torch.from_numpy(frame).permute(2, 0, 1), torch.from_numpy(mask)
+        video_start, img, lbl = self.load_frame(idx)
+        # the same transform is applied to input and lbl and to all frames of the clip
+        transform = self.clip_transform(clip)
+        return video_start, transform(img), transform(lbl, label=True).squeeze(0).round().long()
+
+    def set_epoch(self, epoch):
+        """
+        changes the augmentation of every clip for the next epoch
+        :param epoch: the current epoch
+        """
+        self.epoch = epoch
+
+    def clip_transform(self, clip):
+        """
+        The augmentation parameters only depend on the seed, the epoch and the clip index. They are drawn from a local
+        random generator, such that all frames of a clip are transformed equally, no matter which DataLoader worker
+        loads them, and the global random state is never changed.
+
+        :param clip: index of the 4 sec. clip
+        :return: Segmentation_transform of the clip
+        """
+        return Segmentation_transform(seed="{}-{}-{}".format(self.seed, self.epoch, clip),
+                                      activate=self.apply_transform)
+
+    def augmentation_params(self, idx):
+        """
+        augmentation values of the clips in a batch, to be used with src.dataset.augmentation.BatchAugmentation
+        :param idx: frame indices of the batch as returned by the DataLoader, (B) or (B, T)
+        :return: (B, 7) tensor
+        """
+        first = idx if idx.dim() == 1 else idx[:, 0]
+        return torch.stack([self.clip_transform(self.clip_index(int(i))).params() for i in first])
+
+    def background_indices(self, idx):
+        """
+        backgrounds of the clips in a batch, to be used with src.dataset.backgrounds.BackgroundBank
+        :param idx: frame indices of the batch as returned by the DataLoader, (B) or (B, T)
+        :return: (B) tensor
+        """
+        first = idx if idx.dim() == 1 else idx[:, 0]
+        return torch.tensor([background_index(self.seed, self.epoch, self.clip_index(int(i)), self.num_backgrounds)
+                             for i in first])
+
+    def clip_index(self, idx):
+        """
+        :param idx: index of a frame
+        :return: index of the 4 sec. clip the frame belongs to
+        """
+        if self.index is not None:
+            return int(self.index.clip_ids[idx])
+        return int(np.searchsorted(self.clip_offsets, idx, side="right")) - 1
+
+    def get_window(self, start, seq_len):
+        """
+        returns seq_len consecutive frames of one clip. Used together with src.dataset.samplers.ClipBatchSampler,
+        which interleaves windows of several clips in one batch.
+
+        :param start: index of the first frame of the window
+        :param seq_len: number of frames (T)
+        :return: idx (T), video_start, (images (T, 3, H, W), labels (T, H, W))
+        """
+        clip = self.clip_index(start)
+        video_start = start == self.clip_offsets[clip]
+        inputs, labels = [], []
+        for idx in range(start, start + seq_len):
+            _, inp, lbl = self.load_sample(idx, clip)
+            inputs.append(inp)
+            labels.append(lbl)
+        return torch.arange(start, start + seq_len), video_start, (torch.stack(inputs), torch.stack(labels))
 
     def __getitem__(self, idx):
         """
-        this method is automatically called by the dataloader and returns the current idx.
-        To ensure that training is continued at the desired position the idx = idx + start_index.
-        The dataloader class is only finished if it returend len(dataset) batches, meaning it is necessary to manually
-        check each batch if the current idx exceeds the dataset size.
-        If this is the case, idx = 0 will be returned.
+        this method is automatically called by the dataloader and returns the frame at idx.
+        Use it together with one of the batch samplers of src/dataset/samplers.py.
 
-        in order to end the finished train batch properly use the following inside your batch loop:
-        for batch in loader:
-            idx, video_start, (images, labels) = batch
-            # (only works for bs > 1)
-            if torch.sum(idx == 0) > 1: # if more than one 0 is present in the current batch, end the batch
-                self.dataset.start_index = 0  # reset start index for the next batch
-                break
+        If idx is a (start_index, seq_len) tuple (see ClipBatchSampler) a window of seq_len frames is returned instead,
+        see get_window().
 
         :param idx: the indx to be returned (automatically called by dataloader)
         :return: idx, video_start, (images, labels)
         """
-        idx = idx + self.start_index
-        if idx >= self.__len__():
-            return 0, False, (self.zeros_inp, self.zeros_lbl)
-        video_start = bool(int(self.data["inputs"][idx][1])) # indicates whether a new video has started
-        if video_start:
-            # change the random augmentation with each new video start
-            self.seed = random.randint(0, 999)
-            print("random seed:", self.seed)
-            self.transform = Segmentation_transform(seed=self.seed, activate=self.apply_transform)
-            self.transform.random_apply()
-        img = Image.open(self.data["inputs"][idx][0])
-        lbl = Image.open(self.data["labels"][idx][0]).convert("L")
-        random.seed(self.seed) # makes sure the same transforms are applied to input and lbl
-        inp = self.transform(img)
-        random.seed(self.seed)
-        lbl = (self.transform(lbl, label=True)).squeeze(0)
-        self.cur_idx = idx
-        if self.zeros_inp is None or self.zeros_lbl is None: # black screen will be returned if end of dataset is reached
-            self.zeros_inp = torch.zeros_like(inp)
-            self.zeros_lbl = torch.zeros_like(lbl).long()
-        return idx, video_start, (inp, lbl.round().long())
+        if isinstance(idx, tuple):
+            return self.get_window(*idx)
+        # video_start indicates whether a new video has started
+        video_start, inp, lbl = self.load_sample(idx, self.clip_index(idx))
+        return idx, video_start, (inp, lbl)
 
     def show(self, num_images, start_idx: int = 0, random_images=False):
         """
@@ -181,21 +300,19 @@ class YT_Greenscreen(data.Dataset):
                 indx = np.random.randint(0, len(self))
             else:
                 indx = start_idx + i
-            video_start = bool(int(self.data["inputs"][indx][1]))
-            if video_start:
-                self.transform = Segmentation_transform(seed=random.randint(0, 20))
-            img = Image.open(self.data["inputs"][indx][0])
-            lbl = Image.open(self.data["labels"][indx][0]).convert("L")
-            img = self.transform(img)
-            lbl = self.transform(lbl, label=True)
+            _, img, lbl = self.load_frame(indx)
+            transform = self.clip_transform(self.clip_index(indx))
+            img = transform(img)
+            lbl = transform(lbl, label=True)
             out.append(hstack([to_PIL(img), to_PIL(lbl)]))
         result = vstack(out)
         result.show()
 
 class Segmentation_transform:
     """
-    Custom transform function that will transform the inp and lbl
-    :param seed: ensures reproducability
+    Custom transform function that will transform the inp and lbl.
+    The augmentation values are drawn once from a local random generator, the global random state is not used.
+    :param seed: ensures reproducability (int or str)
     :param activate: if True, augmentations are applied, else only necessary transformations are applied.
     """
     def __init__(self, seed, activate=True):
@@ -203,12 +320,13 @@ class Segmentation_transform:
         see help(Segmentation_transform)
         """
         self.seed = seed
+        self.rng = random.Random(seed)
         self.angle = 0
         self.translate = (0, 0)
-        self.shear = random.randint(-7, 7)
+        self.shear = self.rng.randint(-7, 7)
         self.scale = 1
-        self.hflip = random.randint(0, 1)
-        self.brightness = random.choice([0.6, 0.8, 1.2, 1.4])
+        self.hflip = self.rng.randint(0, 1)
+        self.brightness = self.rng.choice([0.6, 0.8, 1.2, 1.4])
         self.random_apply()
         self.apply_transform = activate
 
@@ -225,7 +343,6 @@ class Segmentation_transform:
         :param label: should be True if img is a label, else false
         :return: the transformed image
         """
-        random.seed(self.seed)
         if self.apply_transform:
 
             if self.hflip:
@@ -233,18 +350,17 @@ class Segmentation_transform:
             img = TF.affine(img=img, angle=self.angle, translate=self.translate, shear=self.shear, scale=self.scale)
             if not label:
                 img = TF.adjust_brightness(img=img, brightness_factor=self.brightness)
-        img = TF.to_tensor(img)
-        if not label:
-            # Normalize according to the ImageNet dataset
-            img = TF.normalize(img, mean=[0.485, 0.456, 0.406],
-                               std=[0.229, 0.224, 0.225])
-            # bring the values back to a range of [0-1]
-            invTrans = T.Normalize(
-                mean=[-0.485 / 0.229, -0.456 / 0.224, -0.406 / 0.225],
-                std=[1 / 0.229, 1 / 0.224, 1 / 0.225]
-            )
-            img = invTrans(img)
-        return img
+        return TF.to_tensor(img)
+
+    def params(self):
+        """
+        :return: tensor with the augmentation values in the order of src.dataset.augmentation.PARAM_NAMES
+                 (identity values if the augmentation is deactivated)
+        """
+        if not self.apply_transform:
+            return torch.tensor([0, 0, 0, 0, 1, 0, 1], dtype=torch.float)
+        return torch.tensor([self.hflip, self.angle, self.translate[0], self.translate[1], self.scale, self.shear,
+                             self.brightness], dtype=torch.float)
 
     def renormalize(self, tensor):
         """
@@ -262,22 +378,22 @@ class Segmentation_transform:
         """
         determines the augmentation values
         """
-        if random.random() < 0.5:
-            self.angle = random.randint(-10, 10)
-            self.scale = random.choice([1, 1.2, 1.1, 1.3])
-        if random.random() > 0.5:
-            self.translate = (random.randint(-10, 10), random.randint(-10, 10))
-            self.scale = random.choice([1, 1.2, 1.1, 1.3])
-        if random.random() > 0.5:
+        if self.rng.random() < 0.5:
+            self.angle = self.rng.randint(-10, 10)
+            self.scale = self.rng.choice([1, 1.2, 1.1, 1.3])
+        if self.rng.random() > 0.5:
+            self.translate = (self.rng.randint(-10, 10), self.rng.randint(-10, 10))
+            self.scale = self.rng.choice([1, 1.2, 1.1, 1.3])
+        if self.rng.random() > 0.5:
             self.shear = 0
-        if random.random() > 0.5:
+        if self.rng.random() > 0.5:
             self.brightness = 1
 
 
 if __name__ == "__main__":
     from torch.utils.data import Dataset, DataLoader
 
-    dataset = YT_Greenscreen(train=True, start_index=0)
+    dataset = YT_Greenscreen(train=True)
     loader = DataLoader(dataset=dataset, batch_size=1, shuffle=False)
     to_pil = T.ToPILImage()
     iter = 0
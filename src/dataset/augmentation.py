@@ -0,0 +1,90 @@
+import math
+import torch
+import torch.nn.functional as F
+
+"""
+Batched version of the Segmentation_transform augmentation.
+Instead of transforming one PIL image at a time inside the DataLoader worker, the augmentation is applied after
+collation to the whole (B, T, C, H, W) batch (e.g. on the GPU), with one affine_grid / grid_sample call for all inputs
+and one for all labels.
+
+The augmentation values of every clip are provided as a (B, 7) tensor, see Segmentation_transform.params() and
+YT_Greenscreen.augmentation_params(). Column order: hflip, angle, translate_x, translate_y, scale, shear, brightness
+"""
+
+PARAM_NAMES = ["hflip", "angle", "translate_x", "translate_y", "scale", "shear", "brightness"]
+
+
+def affine_theta(params, height, width):
+    """
+    Creates the normalized sampling matrices for F.affine_grid (align_corners=False).
+    The geometry is the same as torchvision.transforms.functional.affine (rotation and x-shear around the image center,
+    translation in pixels) applied after an optional horizontal flip.
+
+    :param params: (N, 7) augmentation values
+    :param height: image height in pixels
+    :param width: image width in pixels
+    :return: (N, 2, 3) theta
+    """
+    hflip, angle, tx, ty, scale, shear = params[:, :6].unbind(dim=1)
+    rot = angle * (math.pi / 180)
+    sx = shear * (math.pi / 180)
+    # rotation-scale-shear matrix [[a, b], [c, d]] (see torchvision _get_inverse_affine_matrix)
+    a = torch.cos(rot)
+    b = -torch.cos(rot) * torch.tan(sx) - torch.sin(rot)
+    c = torch.sin(rot)
+    d = -torch.sin(rot) * torch.tan(sx) + torch.cos(rot)
+    # inverse mapping in pixel coordinates centered at the image center
+    m00, m01, m10, m11 = d / scale, -b / scale, -c / scale, a / scale
+    m02 = -m00 * tx - m01 * ty
+    m12 = -m10 * tx - m11 * ty
+    # pixel -> normalized coordinates
+    theta = torch.stack([
+        torch.stack([m00, m01 * height / width, m02 * 2 / width], dim=1),
+        torch.stack([m10 * width / height, m11, m12 * 2 / height], dim=1),
+    ], dim=1)
+    # flipping the input horizontally negates the sampled x coordinate
+    flip = 1 - 2 * hflip
+    theta[:, 0, :] = theta[:, 0, :] * flip.unsqueeze(1)
+    return theta
+
+
+class BatchAugmentation:
+    """
+    Applies the per clip flip / affine / shear / brightness augmentation to a whole batch.
+    Inputs are resampled with mode, by default nearest like TF.affine() of the per image augmentation (see
+    Segmentation_transform), labels with nearest sampling. Pixels outside of the image are filled with 0.
+
+    :param mode: interpolation mode for the input images ("nearest" or "bilinear")
+    """
+    def __init__(self, mode="nearest"):
+        """
+        see help(BatchAugmentation)
+        """
+        self.mode = mode
+
+    def __call__(self, images, labels, params):
+        """
+        :param images: float tensor (B, T, C, H, W) or (B, C, H, W) in the range [0, 1]
+        :param labels: integer tensor (B, T, H, W) or (B, H, W)
+        :param params: (B, 7) augmentation values of the clip of every batch position
+        :return: augmented images and labels with the same shapes as the inputs
+        """
+        single_frame = images.dim() == 4
+        if single_frame:
+            images, labels = images.unsqueeze(1), labels.unsqueeze(1)
+        b, t, ch, h, w = images.shape
+        # all frames of a clip share the same augmentation
+        params = params.to(device=images.device, dtype=images.dtype).repeat_interleave(t, dim=0)
+        theta = affine_theta(params, h, w)
+        grid = F.affine_grid(theta, [b * t, ch, h, w], align_corners=False)
+        images = F.grid_sample(images.reshape(b * t, ch, h, w), grid, mode=self.mode, padding_mode="zeros",
+                               align_corners=False)
+        images = (images * params[:, 6].view(-1, 1, 1, 1)).clamp_(0, 1)
+        labels = F.grid_sample(labels.reshape(b * t, 1, h, w).to(images.dtype), grid, mode="nearest",
+                               padding_mode="zeros", align_corners=False)
+        images = images.view(b, t, ch, h, w)
+        labels = labels.round().long().view(b, t, h, w)
+        if single_frame:
+            images, labels = images.squeeze(1), labels.squeeze(1)
+        return images, labels
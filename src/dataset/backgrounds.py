@@ -0,0 +1,122 @@
+import random
+import cv2
+import numpy as np
+import torch
+from pathlib import Path
+
+"""
+Online green screen compositing.
+
+Instead of baking one background into every clip during the preprocessing, the foreground frames (the original green
+screen frames) and the labels are loaded and the background is inserted after collation:
+input = label * foreground + (1 - label) * background
+The backgrounds are loaded once, resized to the frame size and noise is added (like in "Vid2Img_preprocess.py"), and
+then kept as one uint8 tensor on the device. The background of every clip is chosen randomly every epoch
+(see YT_Greenscreen.background_indices()).
+"""
+
+BACKGROUND_ROOT = Path("src/dataset/data/images/backgrounds")
+
+
+def background_paths(mode):
+    """
+    background images of a split. Uses the split created by "Vid2Img_preprocess.py" or, if it has not been run,
+    performs the same split of "backgrounds/all"
+    :param mode: "train" or "test"
+    :return: sorted list of paths
+    """
+    paths = sorted((BACKGROUND_ROOT / mode).glob("*"))
+    if not paths:
+        from sklearn.model_selection import train_test_split
+        names = [bg for bg in (BACKGROUND_ROOT / "all").glob("*")]
+        train_bg, test_bg = train_test_split(names, train_size=0.8, test_size=0.2, shuffle=True, random_state=12345)
+        paths = sorted(train_bg if mode == "train" else test_bg)
+    return paths
+
+
+def load_background(path, size, seed):
+    """
+    loads a background, resizes it and adds gaussian noise with mean=0 and std=1
+    :param path: path of the image
+    :param size: (width, height)
+    :param seed: seed of the noise
+    :return: uint8 BGR image (height, width, 3)
+    """
+    bgimg = cv2.resize(cv2.imread(str(path)), size)
+    noise = np.random.RandomState(seed).normal(0, 1, bgimg.shape)
+    return np.clip(bgimg + noise, 0, 255).astype(np.uint8)
+
+
+def choose_background(paths, seed, clip):
+    """
+    randomly chooses the background of a clip that is baked into the frames (depending on the seed and the clip)
+    :param paths: background images of the split (see background_paths())
+    :param seed: seed of the choice and the noise
+    :param clip: index or name of the clip
+    :return: path of the background, seed of the noise
+    """
+    rng = random.Random("{}-{}".format(seed, clip))
+    return rng.choice(paths), rng.randrange(2 ** 32)
+
+
+def clip_background(paths, seed, clip, size):
+    """
+    background of a clip (see choose_background()), resized and with gaussian noise
+    :param size: (width, height) of the frames
+    :return: uint8 BGR image (height, width, 3)
+    """
+    path, noise_seed = choose_background(paths, seed, clip)
+    return load_background(path, size, noise_seed)
+
+
+def background_index(seed, epoch, clip, num_backgrounds):
+    """
+    :return: index of the background of a clip in the given epoch
+    """
+    return random.Random("{}-{}-{}-background".format(seed, epoch, clip)).randrange(num_backgrounds)
+
+
+class BackgroundBank:
+    """
+    Keeps all backgrounds of a split as one uint8 tensor (N, 3, H, W) on the device and composites batches.
+    The backgrounds are loaded at the first call, when the frame size and the device are known.
+
+    :param mode: "train" or "test"
+    :param seed: seed of the noise that is added to the backgrounds
+    """
+    def __init__(self, mode, seed=0):
+        """
+        see help(BackgroundBank)
+        """
+        self.paths = background_paths(mode)
+        self.seed = seed
+        self.backgrounds = None
+
+    def __len__(self):
+        return len(self.paths)
+
+    def load(self, height, width, device):
+        """
+        loads, resizes and adds noise to all backgrounds
+        :return: uint8 RGB tensor (N, 3, height, width) on the device
+        """
+        images = [load_background(path, (width, height), self.seed + i)[..., ::-1] for i, path in enumerate(self.paths)]
+        return torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).contiguous().to(device)
+
+    def __call__(self, images, labels, indices):
+        """
+        replaces the background of the foreground frames
+        :param images: float foreground frames (B, T, 3, H, W) or (B, 3, H, W) in the range [0, 1]
+        :param labels: integer tensor (B, T, H, W) or (B, H, W), 1 = person
+        :param indices: (B) index of the background of every batch position
+        :return: composited images with the same shape as the input
+        """
+        height, width = images.shape[-2:]
+        if self.backgrounds is None or self.backgrounds.shape[-2:] != (height, width):
+            self.backgrounds = self.load(height, width, images.device)
+        background = self.backgrounds[indices.to(images.device)].to(images.dtype).div_(255)
+        if images.dim() == 5:
+            background, person = background.unsqueeze(1), labels.unsqueeze(2).bool()
+        else:
+            person = labels.unsqueeze(1).bool()
+        return torch.where(person, images, background)
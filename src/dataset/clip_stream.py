@@ -0,0 +1,252 @@
+import sys
+import cv2
+import numpy as np
+import torch
+from pathlib import Path
+from torch.utils import data
+from torch.utils.data import DataLoader
+from src.dataset.YT_Greenscreen import Segmentation_transform
+from src.dataset.samplers import ClipBatchSampler
+from src.dataset.backgrounds import background_index, background_paths, clip_background
+from src.dataset.video_clips import load_clip_index
+
+"""
+Streaming version of the YT_Greenscreen dataset.
+
+Instead of reading tens of thousands of JPEG files created by "Vid2Img_preprocess.py", the 4 second MP4 clips created by
+"4sec_preprocess.py" ("src/dataset/data/videos/YT_4sec/[train|test]/input") are decoded sequentially with
+cv2.VideoCapture inside of the DataLoader worker that owns the clip. The green screen is replaced by a background
+(same keying and noise as in "Vid2Img_preprocess.py") while decoding, or, with foreground=True, after collation
+(see src/dataset/backgrounds.py).
+If the clips have not been encoded ("4sec_preprocess.py --virtual"), the frame range of every clip is decoded from the
+original video instead (see src/dataset/video_clips.py) and resized to the size of the clips. Decoding the full
+resolution originals is slower, so more DataLoader workers are needed.
+"""
+
+VIDEO_ROOT = Path("src/dataset/data/videos/YT_4sec")
+LOWER_GREEN = np.array([0, 125, 0])
+UPPER_GREEN = np.array([100, 255, 120])
+
+
+def slot_parts(batch_size, num_workers):
+    """
+    distributes the B batch positions (slots) over the DataLoader workers
+    :param batch_size: number of slots (B)
+    :param num_workers: number of DataLoader workers (0 = main process)
+    :return: list with the slots of every worker that has at least one slot
+    """
+    return [list(part) for part in np.array_split(np.arange(batch_size), max(1, min(num_workers, batch_size)))]
+
+
+class YT_GreenscreenStream(data.IterableDataset):
+    """
+    Iterable dataset that decodes the 4 sec. MP4 clips directly and yields batches of B clips x T frames.
+    The clips are grouped exactly like src.dataset.samplers.ClipBatchSampler (which is also used to track the position
+    for restarts, see self.sampler). The B slots of a batch are distributed over the DataLoader workers
+    (see slot_parts()): every worker owns the clips of its slots and decodes them sequentially, and yields its part of
+    each batch. The DataLoader returns the parts of the workers round robin, ClipStreamLoader concatenates them into
+    whole batches. This way, consecutive batches always continue the same B clips, like with ClipBatchSampler.
+
+    The parts are idx (b, T), video_start (b), (frames uint8 (b, T, 3, H, W), labels uint8 (b, T, H, W)), the same
+    format as YT_Greenscreen with ClipBatchSampler and device_augment=True. idx are positions in the concatenation of
+    all clips, so augmentation_params() works the same way.
+
+    :param train: if true returns the training dataset else returns the testing dataset
+    :param batch_size: number of clips processed in parallel (B)
+    :param seq_len: number of consecutive frames per clip and batch (T)
+    :param seed: seed of the clip order, the backgrounds and the augmentation
+    :param shuffle: if True the order of the clips is shuffled every epoch
+    :param apply_transform: turn on data augmentation
+    :param foreground: if true the green screen frames are returned without replacing the background, which is done
+                       after collation by src.dataset.backgrounds.BackgroundBank (see background_indices())
+    """
+    def __init__(self, train=True, batch_size=1, seq_len=1, seed=0, shuffle=False, apply_transform=True,
+                 foreground=False):
+        """
+        see help(YT_GreenscreenStream)
+        """
+        self.train = train
+        self.mode = "train" if train else "test"
+        self.backgrounds = background_paths(self.mode)
+        # (video, first frame, number of frames) of every clip
+        clip_paths = sorted((VIDEO_ROOT / self.mode / "input").glob("*.mp4"))
+        if clip_paths:
+            self.clips, self.output_size = [], None
+            for path in clip_paths:
+                cap = cv2.VideoCapture(str(path))
+                self.clips.append((str(path), 0, int(cap.get(cv2.CAP_PROP_FRAME_COUNT))))
+                cap.release()
+        else:  # virtual clips
+            self.output_size, virtual_clips = load_clip_index(VIDEO_ROOT / self.mode / "clips.json")
+            self.clips = [(source, start, length) for _, source, start, length in virtual_clips]
+        lengths = [length for _, _, length in self.clips]
+        # index of the first frame of every 4 sec. clip, the last entry is the number of frames
+        self.clip_offsets = np.append(0, np.cumsum(lengths)).astype(np.int64)
+        self.seed = seed
+        self.epoch = 0
+        self.apply_transform = apply_transform
+        self.foreground = foreground
+        self.device_augment = True  # the frames are augmented after collation (see YT_Greenscreen)
+        self.sampler = ClipBatchSampler(self.clip_offsets, batch_size=batch_size, seq_len=seq_len, shuffle=shuffle,
+                                        seed=seed)
+
+    def __len__(self):
+        """
+        :return: number of batches of a full epoch
+        """
+        return len(self.sampler)
+
+    def set_epoch(self, epoch):
+        """
+        changes the augmentation of every clip for the next epoch
+        :param epoch: the current epoch
+        """
+        self.epoch = epoch
+
+    def clip_transform(self, clip):
+        """
+        see YT_Greenscreen.clip_transform()
+        """
+        return Segmentation_transform(seed="{}-{}-{}".format(self.seed, self.epoch, clip),
+                                      activate=self.apply_transform)
+
+    def augmentation_params(self, idx):
+        """
+        see YT_Greenscreen.augmentation_params()
+        """
+        first = idx if idx.dim() == 1 else idx[:, 0]
+        return torch.stack([self.clip_transform(self.clip_index(int(i))).params() for i in first])
+
+    def background_indices(self, idx):
+        """
+        see YT_Greenscreen.background_indices()
+        """
+        first = idx if idx.dim() == 1 else idx[:, 0]
+        return torch.tensor([background_index(self.seed, self.epoch, self.clip_index(int(i)), len(self.backgrounds))
+                             for i in first])
+
+    def clip_index(self, idx):
+        """
+        :param idx: index of a frame
+        :return: index of the 4 sec. clip the frame belongs to
+        """
+        return int(np.searchsorted(self.clip_offsets, idx, side="right")) - 1
+
+    def background(self, clip, size):
+        """
+        background of a clip: randomly chosen (depending on the seed and the clip), resized and with gaussian noise
+        :param clip: index of the clip
+        :param size: (width, height) of the frames
+        :return: uint8 BGR image
+        """
+        return clip_background(self.backgrounds, self.seed, clip, size)
+
+    def composite(self, frame, bgimg):
+        """
+        replaces the green screen of a frame (only keys the frame if foreground is true)
+        :param frame: uint8 BGR frame
+        :param bgimg: uint8 BGR background of the same size
+        :return: RGB input (H, W, 3), label (H, W) with 1 = person
+        """
+        key = cv2.inRange(frame, LOWER_GREEN, UPPER_GREEN)
+        out = frame if self.foreground else np.where(key[..., None] > 0, bgimg, frame)
+        return out[..., ::-1], (key == 0).astype(np.uint8)
+
+    def open_clip(self, clip, start_frame):
+        """
+        :param clip: index of the clip
+        :param start_frame: first frame of the clip that should be read
+        :return: VideoCapture, background of the clip, black frame and label (used if the video ends too early)
+        """
+        video, first_frame, _ = self.clips[clip]
+        cap = cv2.VideoCapture(video)
+        if first_frame + start_frame > 0:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, first_frame + start_frame)
+        if self.output_size is None:
+            width, height = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        else:
+            width, height = self.output_size
+        blank = (np.zeros((height, width, 3), dtype=np.uint8), np.zeros((height, width), dtype=np.uint8))
+        bgimg = None if self.foreground else self.background(clip, (width, height))
+        return cap, bgimg, blank
+
+    def __iter__(self):
+        info = data.get_worker_info()
+        worker, num_workers = (0, 1) if info is None else (info.id, info.num_workers)
+        parts = slot_parts(self.sampler.batch_size, num_workers)
+        if worker >= len(parts):  # more workers than slots
+            return
+        slots = parts[worker]
+        seq_len = self.sampler.seq_len
+        skip = self.sampler.position  # batches that have already been trained (see ResumableBatchSampler)
+        for group, num_windows in self.sampler.groups():
+            if skip >= num_windows:
+                skip -= num_windows
+                continue
+            clips = [group[slot] for slot in slots]
+            opened = [self.open_clip(clip, skip * seq_len) for clip in clips]
+            last = [blank for _, _, blank in opened]
+            for w in range(skip, num_windows):
+                frames, labels = [], []
+                for k, (cap, bgimg, _) in enumerate(opened):
+                    for t in range(seq_len):
+                        ret, frame = cap.read()
+                        if ret:
+                            if self.output_size is not None:
+                                frame = cv2.resize(frame, self.output_size)
+                            last[k] = self.composite(frame, bgimg)
+                        else:  # repeat the last frame, all workers have to yield the same number of parts
+                            sys.stderr.write("\nCould not read frame {} of clip {}\n".format(w * seq_len + t, clips[k]))
+                        frames.append(last[k][0])
+                        labels.append(last[k][1])
+                starts = torch.tensor([int(self.clip_offsets[c]) + w * seq_len for c in clips])
+                idx = starts.unsqueeze(1) + torch.arange(seq_len)
+                frames = torch.from_numpy(np.stack(frames)).view(len(clips), seq_len, *frames[0].shape)
+                labels = torch.from_numpy(np.stack(labels)).view(len(clips), seq_len, *labels[0].shape)
+                video_start = torch.full((len(clips),), w == 0, dtype=torch.bool)
+                yield idx, video_start, (frames.permute(0, 1, 4, 2, 3), labels)
+            for cap, _, _ in opened:
+                cap.release()
+            skip = 0
+
+
+class ClipStreamLoader:
+    """
+    DataLoader for YT_GreenscreenStream. Concatenates the parts of the workers into whole batches.
+
+    :param dataset: YT_GreenscreenStream
+    :param num_workers: number of DataLoader workers
+    :param pin_memory: if True the batches are returned in pinned memory
+    """
+    def __init__(self, dataset, num_workers=0, pin_memory=False):
+        """
+        see help(ClipStreamLoader)
+        """
+        self.dataset = dataset
+        self.num_parts = len(slot_parts(dataset.sampler.batch_size, num_workers))
+        self.pin_memory = pin_memory
+        self.loader = DataLoader(dataset=dataset, batch_size=None, num_workers=num_workers)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def merge(self, parts):
+        """
+        :param parts: list of the parts of all workers
+        :return: idx, video_start, (frames, labels) of the whole batch
+        """
+        idx = torch.cat([part[0] for part in parts])
+        video_start = torch.cat([part[1] for part in parts])
+        frames = torch.cat([part[2][0] for part in parts])
+        labels = torch.cat([part[2][1] for part in parts])
+        if self.pin_memory:
+            frames, labels = frames.pin_memory(), labels.pin_memory()
+        return idx, video_start, (frames, labels)
+
+    def __iter__(self):
+        parts = []
+        for part in self.loader:  # the parts are returned in the order of the workers
+            parts.append(part)
+            if len(parts) == self.num_parts:
+                yield self.merge(parts)
+                parts = []
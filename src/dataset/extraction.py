@@ -0,0 +1,230 @@
+import json
+import os
+import sys
+import cv2
+import numpy as np
+from collections import defaultdict
+from pathlib import Path
+from src.dataset.backgrounds import choose_background, clip_background
+from src.dataset.keying import ChromaKeyer
+from src.dataset.manifest import Manifest
+from src.dataset.masks import MaskWriter, pack_masks
+from src.dataset.pipeline import Pipeline
+
+"""
+Incremental frame extraction of the YT_Greenscreen dataset, used by "Vid2Img_preprocess.py" and "fused_preprocess.py".
+
+Every 4 sec. clip is given as (key, source video, start frame, end frame), the source video is either an encoded clip
+of "4sec_preprocess.py" or the original video of a virtual clip (see src/dataset/video_clips.py). The key is the
+stable identity of the clip (its original video and start frame, see video_clips.clip_key()), so that adding a video
+does not change the keys and backgrounds of the other clips. Its frames flow
+through a thread pipeline (see src/dataset/pipeline.py):
+decode (one source video per thread) -> resize -> key / composite -> encode / write.
+Creates in the output folder ("src/dataset/data/images/YT_4sec/[train|test]"):
+- input/, labels/, foreground/  JPEG files "<frame id>.jpg"
+- masks/                         packed masks of every clip (see src/dataset/masks.py)
+- out_log.json                   the frames of all clips in the order of the clips
+- manifest.json                  hashes of the source video and background of every clip (see src/dataset/manifest.py)
+
+A rerun only extracts the clips that are new or whose source video, frame range or background changed. The clips that
+did not change keep their frame ids and their order, the new clips are appended to out_log.json. The frames of clips
+that have been removed or changed are deleted and their frame ids are reused by the new clips.
+The background of a clip is chosen by its key (see src/dataset/backgrounds.py), adding a background image to the
+split therefore changes the background of many clips.
+"""
+
+SEEK_DISTANCE = 100  # frames between two clips of a video that are skipped by seeking instead of decoding
+
+
+def frame_name(frame_id):
+    return str(frame_id).zfill(5) + ".jpg"
+
+
+def allocate_ids(used, lengths):
+    """
+    assigns consecutive frame ids to the new clips
+    :param used: list of (first id, number of frames) of the clips that are kept
+    :param lengths: number of frames of every new clip
+    :return: first id of every new clip. The gaps of removed clips are reused (first fit), the remaining clips are
+             appended after the highest id, so the ids do not grow with every rerun.
+    """
+    gaps, end = [], 0
+    for first, num_frames in sorted(used):
+        if first > end:
+            gaps.append([end, first - end])
+        end = max(end, first + num_frames)
+    first_ids = []
+    for length in lengths:
+        for gap in gaps:
+            if gap[1] >= length:
+                first_ids.append(gap[0])
+                gap[0] += length
+                gap[1] -= length
+                break
+        else:
+            first_ids.append(end)
+            end += length
+    return first_ids
+
+
+def extract_split(clips, out_path, bg_paths, output_size, lower_green, upper_green, quality=70, seed=12345,
+                  num_decoders=1, num_writers=1, chunk_size=8):
+    """
+    extracts, keys and writes the frames of all clips of a split
+    :param clips: list of (key, source video, start frame, end frame), new clips are appended in this order
+    :param out_path: output folder of the split
+    :param bg_paths: background images of the split
+    :param output_size: (width, height) of the frames
+    :param lower_green: lower bound of the green screen color (BGR)
+    :param upper_green: upper bound of the green screen color (BGR)
+    :param quality: JPEG quality
+    :param seed: seed of the background choice and noise
+    :param num_decoders: number of threads that decode videos
+    :param num_writers: number of threads that encode and write the JPEG files
+    :param chunk_size: number of frames per pipeline item
+    :return: the pipeline (for its statistics)
+    """
+    out_path = Path(out_path)
+    paths = {name: out_path / name for name in ["input", "labels", "foreground"]}
+    for path in paths.values():
+        path.mkdir(parents=True, exist_ok=True)
+    mask_path = out_path / "masks"
+    params = {"output_size": [int(v) for v in output_size], "lower_green": [int(v) for v in lower_green],
+              "upper_green": [int(v) for v in upper_green], "quality": int(quality), "seed": int(seed)}
+    manifest = Manifest(out_path / "manifest.json", params)
+
+    signatures = {}
+    for key, source, start, end in clips:
+        bg_path, _ = choose_background(bg_paths, seed, key)
+        # the path of the source is left out, the encoded clips are renamed if their clip ids change
+        signatures[key] = {"source_hash": manifest.hash(source), "start": int(start), "end": int(end),
+                           "background_hash": manifest.hash(bg_path)}
+    old_position = {key: position for position, key in enumerate(manifest.order)}
+
+    def complete(key):
+        entry = manifest.entries[key]
+        if entry["num_frames"] == 0:
+            return True
+        last = frame_name(entry["first_id"] + entry["num_frames"] - 1)
+        return (key in old_position and (mask_path / (str(old_position[key]).zfill(5) + ".npy")).exists() and
+                all((path / last).exists() for path in paths.values()))
+
+    kept = {key for key in signatures if manifest.unchanged(key, signatures[key]) and complete(key)}
+    for key in list(manifest.entries):  # frames of removed and changed clips
+        if key not in kept:
+            entry = manifest.entries.pop(key)
+            for frame_id in range(entry["first_id"], entry["first_id"] + entry["num_frames"]):
+                for path in paths.values():
+                    if (path / frame_name(frame_id)).exists():
+                        os.remove(str(path / frame_name(frame_id)))
+    # the kept clips move to the front, the masks are renamed in ascending order (a position can only decrease)
+    manifest.order = [key for key in manifest.order if key in kept]
+    for position, key in enumerate(manifest.order):
+        if old_position[key] != position:
+            os.replace(str(mask_path / (str(old_position[key]).zfill(5) + ".npy")),
+                       str(mask_path / (str(position).zfill(5) + ".npy")))
+    manifest.save()
+
+    new_clips = [clip for clip in clips if clip[0] not in kept]
+    sys.stderr.write("{}: {} clips unchanged, {} clips to extract\n".format(out_path, len(kept), len(new_clips)))
+    used = [(entry["first_id"], entry["num_frames"]) for entry in manifest.entries.values()]
+    first_ids = dict(zip([key for key, _, _, _ in new_clips],
+                         allocate_ids(used, [end - start for _, _, start, end in new_clips])))
+    positions = {key: len(manifest.order) + k for k, (key, _, _, _) in enumerate(new_clips)}
+    tasks = defaultdict(list)
+    for key, source, start, end in new_clips:
+        tasks[str(source)].append((key, start, end))
+    tasks = [(source, sorted(source_clips, key=lambda clip: clip[1])) for source, source_clips in tasks.items()]
+
+    mask_writer = MaskWriter(mask_path, output_size)
+    keyer = ChromaKeyer(lower_green, upper_green, height=output_size[1], width=output_size[0], chunk_size=chunk_size)
+    jpeg_params = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
+    packed_masks = defaultdict(list)
+    backgrounds = {}
+    num_frames = {}
+
+    def decode(task):
+        """
+        decodes a video once and yields the frames of its clips in chunks, (key, first id, None) ends a clip
+        """
+        source, source_clips = task
+        sys.stderr.write("Video: {} ({} clips)\n".format(source, len(source_clips)))
+        cap = cv2.VideoCapture(source)
+        try:
+            frame_counter = 0
+            for key, start, end in source_clips:
+                first, frames = first_ids[key], []
+                if start - frame_counter > SEEK_DISTANCE:  # e.g. only a later clip of the video has to be extracted
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+                    frame_counter = start
+                while frame_counter < end:
+                    ret, frame = cap.read()
+                    if not ret:
+                        break
+                    if frame_counter >= start:  # frames of clips that are overwritten by a later video are skipped
+                        frames.append(frame)
+                        if len(frames) == chunk_size:
+                            yield key, first, frames
+                            first, frames = first + len(frames), []
+                    frame_counter += 1
+                if frames:
+                    yield key, first, frames
+                yield key, first + len(frames), None
+        finally:
+            cap.release()
+
+    def resize(item):
+        key, first, frames = item
+        if frames is not None:
+            frames = np.stack([cv2.resize(frame, output_size) for frame in frames])
+        yield key, first, frames
+
+    def composite(item):
+        key, first, frames = item
+        if frames is None:  # end of the clip
+            if packed_masks[key]:
+                mask_writer.write_clip(positions[key], packed_masks.pop(key))
+            num_frames[key] = int(first - first_ids[key])
+            backgrounds.pop(key, None)
+            return
+        if key not in backgrounds:
+            backgrounds[key] = clip_background(bg_paths, seed, key, output_size)
+        n = len(frames)
+        keyer.frames[:n] = frames
+        inputs, labels = keyer.key(n, backgrounds[key])
+        packed_masks[key].extend(pack_masks(labels))  # everything that is not green is the person
+        yield first, inputs.copy(), labels.copy(), frames
+
+    def write(item):
+        first, inputs, labels, foreground = item
+        for k in range(len(inputs)):
+            out_name = frame_name(first + k)
+            cv2.imwrite(str(paths["input"] / out_name), inputs[k], jpeg_params)
+            cv2.imwrite(str(paths["labels"] / out_name), labels[k], jpeg_params)
+            cv2.imwrite(str(paths["foreground"] / out_name), foreground[k], jpeg_params)
+            yield out_name
+
+    pipeline = Pipeline([("decode", decode, num_decoders), ("resize", resize, 1), ("key", composite, 1),
+                         ("write", write, num_writers)], maxsize=4)
+    pipeline.run(tasks)
+
+    # clips without any frame are left out, the masks are numbered in the order of the remaining clips
+    for key, _, _, _ in new_clips:
+        manifest.entries[key] = dict(signatures[key], first_id=first_ids[key], num_frames=num_frames.get(key, 0))
+        if num_frames.get(key, 0) > 0:
+            if positions[key] != len(manifest.order):
+                os.replace(str(mask_path / (str(positions[key]).zfill(5) + ".npy")),
+                           str(mask_path / (str(len(manifest.order)).zfill(5) + ".npy")))
+            manifest.order.append(key)
+
+    out_log = defaultdict(list)
+    for key in manifest.order:
+        entry = manifest.entries[key]
+        for k in range(entry["num_frames"]):
+            out_name = frame_name(entry["first_id"] + k)
+            out_log["inputs"].append((str(paths["input"] / out_name), int(k == 0)))
+            out_log["labels"].append((str(paths["labels"] / out_name), int(k == 0)))
+    with open(str(out_path / "out_log.json"), "w") as js:
+        json.dump(dict(out_log), js)
+    manifest.save()
+    return pipeline
@@ -0,0 +1,217 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import numpy as np
+import torch
+from pathlib import Path
+from torch.utils import data
+from torch.utils.data import DataLoader
+from src.dataset.index import DATA_ROOT
+from src.dataset.masks import pack_masks, unpack_masks
+from src.dataset.prefetcher import DevicePrefetcher
+from src.dataset.samplers import FrameBatchSampler
+
+"""
+Feature cache of the frozen backbone.
+
+The backbone of every model is frozen (see src/utils/initiator.py), so the backbone features of a frame only change if
+the frame is augmented differently. The features of all frames are computed once and stored as memory-mapped float16
+arrays in "src/dataset/data/images/YT_4sec/[train|test]/features/<backbone>/<fingerprint>/":
+- out.npy        float16 (V, N, C, h, w) "out" features of the backbone
+- low_level.npy  float16 (V, N, C_low, h_low, w_low) "low_level" features of the backbone
+- labels.npy     uint8 (V, N, H, ceil(W / 8)) bit-packed labels (see src/dataset/masks.py)
+- meta.json      number of frames and variants, the input size and the fingerprint
+V is the number of cached variants: variant 0 contains the frames without augmentation, variant v > 0 the frames with
+the augmentation of epoch v. Epoch e of the training uses variant e % V.
+The fingerprint (see cache_fingerprint()) is a hash of the frames of the split, the seed and the augmentation, so a
+changed dataset or another seed gets its own cache. A cache is built in a temporary folder "<fingerprint>.tmp-<pid>"
+and renamed when it is complete, so parallel trainings (e.g. src/train_multiple.py) never see a partial cache. If two
+trainings build the same cache at the same time, the first rename wins. Caches of old fingerprints and temporary
+folders of aborted builds are not deleted automatically.
+The cache of the mobilenet backbone needs about 0.8 MB per frame and variant, the resnet50 cache is much larger.
+"""
+
+
+def cache_folder(mode, backbone, root=DATA_ROOT):
+    """
+    :param mode: "train" or "test"
+    :param backbone: "mobilenet" or "resnet50"
+    :return: folder of the feature cache
+    """
+    return Path(root) / mode / "features" / backbone
+
+
+def cache_fingerprint(dataset, num_variants=1, augmentation=None, root=DATA_ROOT):
+    """
+    :param dataset: YT_Greenscreen dataset of the cache
+    :param num_variants: number of cached variants
+    :param augmentation: BatchAugmentation if the dataset returns uint8 frames
+    :param root: folder that contains the split folders
+    :return: sha1 hex digest of everything the cached features depend on: the frames and clips of the dataset (the
+             frame index and the extraction manifest or the packed frames), the seed and the augmentation
+    """
+    split_path = Path(root) / dataset.mode
+    sha1 = hashlib.sha1()
+    if dataset.store is not None:
+        arrays = [dataset.store.offsets, dataset.store.video_start]
+        # the packed arrays are too large to be hashed, they are only written by src/dataset/frame_store.py
+        stats = [os.stat(str(split_path / "packed" / name)) for name in ["frames.npy", "masks.npy"]]
+        source = {"packed": [[stat.st_size, stat.st_mtime_ns] for stat in stats]}
+    else:
+        index = dataset.index
+        arrays = [index.frame_ids, index.clip_ids, index.clip_start, index.clip_length]
+        source = {"input_prefix": index.input_prefix, "label_prefix": index.label_prefix, "width": index.width,
+                  "suffix": index.suffix, "packed_masks": dataset.masks is not None}
+        # the entries of the manifest contain the content hashes of the sources of all clips and the preprocessing
+        # parameters (see src/dataset/extraction.py)
+        if (split_path / "manifest.json").exists():
+            with open(str(split_path / "manifest.json"), "r") as js:
+                manifest = json.load(js)
+            source["manifest"] = [manifest.get("params"), manifest.get("entries")]
+    for array in arrays:
+        sha1.update(np.ascontiguousarray(array).tobytes())
+    params = {"source": source, "seed": str(dataset.seed), "num_variants": int(num_variants),
+              "device_augment": bool(dataset.device_augment),
+              "augmentation": augmentation.mode if augmentation is not None else None}
+    sha1.update(json.dumps(params, sort_keys=True).encode())
+    return sha1.hexdigest()
+
+
+def build_feature_cache(model, dataset, folder, device, num_variants=1, augmentation=None, fingerprint=None):
+    """
+    computes the backbone features of all frames of the dataset. They are written into a temporary folder, which is
+    renamed to folder when the cache is complete. If folder already exists (built by another process), the temporary
+    folder is deleted.
+    :param model: model with a backbone_features() method (see src.models.custom_deeplabs.DeeplabWrapper)
+    :param dataset: YT_Greenscreen dataset (not in foreground mode)
+    :param folder: output folder
+    :param device: device of the model
+    :param num_variants: number of cached variants
+    :param augmentation: BatchAugmentation if the dataset returns uint8 frames (device_augment=True)
+    :param fingerprint: fingerprint of the cache, stored in meta.json (see cache_fingerprint())
+    """
+    folder = Path(folder)
+    tmp_folder = folder.parent / "{}.tmp-{}".format(folder.name, os.getpid())
+    if tmp_folder.exists():
+        shutil.rmtree(str(tmp_folder))
+    tmp_folder.mkdir(parents=True)
+    num_frames = len(dataset)
+    epoch, apply_transform = dataset.epoch, dataset.apply_transform
+    backbone_training = model.base.backbone.training
+    model.base.backbone.eval()
+    arrays = None
+    try:
+        with torch.no_grad():
+            for variant in range(num_variants):
+                sys.stderr.write("Caching backbone features, variant {} of {}\n".format(variant + 1, num_variants))
+                dataset.set_epoch(variant)
+                dataset.apply_transform = variant > 0
+                loader = DataLoader(dataset=dataset, batch_sampler=FrameBatchSampler(num_frames, dataset.batch_size))
+                for idx, _, (images, labels) in DevicePrefetcher(loader, device):
+                    if augmentation is not None and variant > 0:
+                        images, labels = augmentation(images, labels, dataset.augmentation_params(idx))
+                    features = model.backbone_features(images)
+                    if arrays is None:
+                        arrays = {name: np.lib.format.open_memmap(
+                            str(tmp_folder / (name + ".npy")), mode="w+", dtype=np.float16,
+                            shape=(num_variants, num_frames) + tuple(features[name].shape[1:]))
+                            for name in ["out", "low_level"]}
+                        arrays["labels"] = np.lib.format.open_memmap(
+                            str(tmp_folder / "labels.npy"), mode="w+", dtype=np.uint8,
+                            shape=(num_variants, num_frames) + pack_masks(labels[0].cpu().numpy()).shape)
+                        height, width = images.shape[-2:]
+                    idx = idx.numpy()
+                    for name in ["out", "low_level"]:
+                        arrays[name][variant, idx] = features[name].half().cpu().numpy()
+                    arrays["labels"][variant, idx] = pack_masks(labels.cpu().numpy())
+    finally:
+        dataset.set_epoch(epoch)
+        dataset.apply_transform = apply_transform
+        model.base.backbone.train(backbone_training)
+    for array in arrays.values():
+        array.flush()
+    del arrays
+    with open(str(tmp_folder / "meta.json"), "w") as js:
+        json.dump({"num_frames": num_frames, "num_variants": num_variants, "height": int(height),
+                   "width": int(width), "fingerprint": fingerprint}, js)
+    try:
+        os.rename(str(tmp_folder), str(folder))
+    except OSError:
+        if not (folder / "meta.json").exists():
+            raise
+        sys.stderr.write("Feature cache {} was built by another process\n".format(folder))
+        shutil.rmtree(str(tmp_folder))
+
+
+class FeatureCache(data.Dataset):
+    """
+    Returns the cached backbone features instead of the frames, in the same format as YT_Greenscreen:
+    idx, video_start, ((out, low_level), labels). Supports the same indices (frames or (start, seq_len) windows of
+    src.dataset.samplers.ClipBatchSampler).
+    The cache is built by build_feature_cache() if no cache with the fingerprint of the dataset exists.
+
+    :param dataset: YT_Greenscreen dataset of the cache (for the frame and clip information)
+    :param model: model with a backbone_features() method
+    :param folder: folder of the caches of the backbone (see cache_folder()), the cache is stored in a sub folder named
+                   after its fingerprint
+    :param device: device of the model
+    :param num_variants: number of cached variants (see module documentation)
+    :param augmentation: BatchAugmentation if the dataset returns uint8 frames
+    """
+    def __init__(self, dataset, model, folder, device, num_variants=1, augmentation=None):
+        """
+        see help(FeatureCache)
+        """
+        fingerprint = cache_fingerprint(dataset, num_variants, augmentation)
+        folder = Path(folder) / fingerprint
+        meta = None
+        if (folder / "meta.json").exists():
+            with open(str(folder / "meta.json"), "r") as js:
+                meta = json.load(js)
+        if meta is None:
+            build_feature_cache(model, dataset, folder, device, num_variants=num_variants, augmentation=augmentation,
+                                fingerprint=fingerprint)
+            with open(str(folder / "meta.json"), "r") as js:
+                meta = json.load(js)
+        self.dataset = dataset
+        self.num_variants = num_variants
+        self.input_shape = (meta["height"], meta["width"])
+        self.out = np.load(str(folder / "out.npy"), mmap_mode="r")
+        self.low_level = np.load(str(folder / "low_level.npy"), mmap_mode="r")
+        self.labels = np.load(str(folder / "labels.npy"), mmap_mode="r")
+        self.variant = 0
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def set_epoch(self, epoch):
+        """
+        :param epoch: the current epoch, selects the cached variant
+        """
+        self.variant = epoch % self.num_variants
+
+    def load(self, idx):
+        """
+        :param idx: index of a frame
+        :return: out, low_level (float16) and label (uint8 with the values 0 and 1) tensors
+        """
+        label = unpack_masks(self.labels[self.variant, idx], self.input_shape[1])
+        return (torch.from_numpy(np.array(self.out[self.variant, idx])),
+                torch.from_numpy(np.array(self.low_level[self.variant, idx])), torch.from_numpy(label))
+
+    def video_start(self, idx):
+        """
+        :return: True if the frame is the first frame of a 4 sec. clip
+        """
+        return bool(idx == self.dataset.clip_offsets[self.dataset.clip_index(idx)])
+
+    def __getitem__(self, idx):
+        if isinstance(idx, tuple):
+            start, seq_len = idx
+            out, low_level, labels = zip(*[self.load(i) for i in range(start, start + seq_len)])
+            return torch.arange(start, start + seq_len), self.video_start(start), \
+                ((torch.stack(out), torch.stack(low_level)), torch.stack(labels))
+        out, low_level, label = self.load(idx)
+        return idx, self.video_start(idx), ((out, low_level), label)
@@ -0,0 +1,105 @@
+import sys
+import numpy as np
+from pathlib import Path
+from PIL import Image
+from src.dataset.index import DATA_ROOT, FrameIndex
+from src.dataset.masks import PackedMasks
+
+"""
+Packed frame store for the YT_Greenscreen dataset.
+
+Converts the JPEG frames listed in "src/dataset/data/images/YT_4sec/[train|test]/out_log.json" (read through the
+index of src/dataset/index.py) into memory-mapped uint8 arrays, such that an epoch can be trained without decoding a
+single JPEG file.
+Creates the following files in "src/dataset/data/images/YT_4sec/[train|test]/packed/":
+- frames.npy     uint8 (N, H, W, 3) RGB input frames
+- masks.npy      uint8 (N, H, W) binary ground truth masks (0 = background, 1 = person)
+- clips.npz      clip boundary table: "offsets" (num_clips + 1) with the index of the first frame of each clip
+                 (the last entry equals N) and "video_start" (N) the new clip flag of each frame
+
+Run after "Vid2Img_preprocess.py" with: python -m src.dataset.frame_store
+"""
+
+def pack_split(mode, root=DATA_ROOT):
+    """
+    packs all frames and labels of one split into memory-mapped arrays
+    :param mode: "train" or "test"
+    :param root: folder that contains the split folders
+    :return: path of the packed folder
+    """
+    index = FrameIndex(mode, root)
+    out_path = Path(root) / mode / "packed"
+    out_path.mkdir(parents=True, exist_ok=True)
+
+    num_frames = len(index)
+    width, height = Image.open(index.input_path(0)).size
+    frames = np.lib.format.open_memmap(str(out_path / "frames.npy"), mode="w+", dtype=np.uint8,
+                                       shape=(num_frames, height, width, 3))
+    masks = np.lib.format.open_memmap(str(out_path / "masks.npy"), mode="w+", dtype=np.uint8,
+                                      shape=(num_frames, height, width))
+    packed_masks = PackedMasks(Path(root) / mode / "masks") if PackedMasks.exists(Path(root) / mode / "masks") else None
+    for i in range(num_frames):
+        frames[i] = np.asarray(Image.open(index.input_path(i)).convert("RGB"))
+        if packed_masks is not None:
+            clip = int(index.clip_ids[i])
+            masks[i] = packed_masks.mask(clip, i - int(index.clip_start[clip]))
+        else:
+            # same rounding as YT_Greenscreen: values >= 128 belong to the person
+            masks[i] = np.asarray(Image.open(index.label_path(i)).convert("L")) >= 128
+        if i % 1000 == 0:
+            sys.stderr.write("Packed {}/{} frames of {}\n".format(i, num_frames, mode))
+    frames.flush()
+    masks.flush()
+    offsets = index.offsets
+    video_start = np.zeros(num_frames, dtype=np.bool_)
+    video_start[index.clip_start] = True
+    np.savez(str(out_path / "clips.npz"), offsets=offsets, video_start=video_start)
+    return out_path
+
+
+class PackedFrameStore:
+    """
+    Read only view on a split packed by pack_split().
+    All accessors return slices of the memory-mapped arrays, no data is copied or decoded.
+
+    :param mode: "train" or "test"
+    :param root: folder that contains the split folders
+    """
+    def __init__(self, mode, root=DATA_ROOT):
+        """
+        see help(PackedFrameStore)
+        """
+        path = Path(root) / mode / "packed"
+        self.frames = np.load(str(path / "frames.npy"), mmap_mode="r")
+        self.masks = np.load(str(path / "masks.npy"), mmap_mode="r")
+        clips = np.load(str(path / "clips.npz"))
+        self.offsets = clips["offsets"]
+        self.video_start = clips["video_start"]
+
+    @staticmethod
+    def exists(mode, root=DATA_ROOT):
+        """
+        :return: True if the split has already been packed
+        """
+        path = Path(root) / mode / "packed"
+        return all((path / name).exists() for name in ["frames.npy", "masks.npy", "clips.npz"])
+
+    def __len__(self):
+        return len(self.frames)
+
+    @property
+    def num_clips(self):
+        return len(self.offsets) - 1
+
+    def clip(self, clip_idx):
+        """
+        :param clip_idx: index of the 4 second clip
+        :return: frames (T, H, W, 3) and masks (T, H, W) of the whole clip
+        """
+        start, end = self.offsets[clip_idx], self.offsets[clip_idx + 1]
+        return self.frames[start:end], self.masks[start:end]
+
+
+if __name__ == "__main__":
+    for split in ["train", "test"]:
+        sys.stderr.write("Packing {}: {}\n".format(split, pack_split(split)))
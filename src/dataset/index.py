@@ -0,0 +1,155 @@
+import json
+import os
+import re
+import sys
+import numpy as np
+from pathlib import Path
+
+"""
+Compact index of the YT_Greenscreen dataset.
+
+The log file "src/dataset/data/images/YT_4sec/[train|test]/out_log.json" stores one [path, flag] pair per frame.
+Loaded as python lists, every DataLoader worker touches the reference counts of these objects and therefore slowly
+copies the whole structure after the fork (copy-on-read).
+The index stores the same information in a few numpy arrays, which are shared between the forked workers:
+- frame_ids     int64 (N) number in the file name of every frame ("00042.jpg" -> 42)
+- clip_ids      int64 (N) index of the 4 sec. clip of every frame
+- clip_start    int64 (num_clips) index of the first frame of every clip
+- clip_length   int64 (num_clips) number of frames of every clip
+The paths are rebuilt from a single prefix for the inputs and labels, the zero padding width and the file suffix.
+
+The index is cached in "index.npz" next to the log file and rebuilt whenever the log file is newer.
+"""
+
+DATA_ROOT = Path("src/dataset/data/images/YT_4sec")
+FILE_NAME = re.compile(r"^(.*?)(\d+)(\.\w+)$")
+
+
+def split_paths(paths):
+    """
+    splits the frame paths into a common prefix and the frame ids
+    :param paths: list of paths with names like "<prefix>00042.jpg", ids that need more digits than the zero padding
+                  width are longer ("<prefix>123456.jpg", like str(frame_id).zfill(5))
+    :return: prefix, frame ids, zero padding width, suffix
+    """
+    prefix, suffix = None, None
+    digits = []
+    for path in paths:
+        match = FILE_NAME.match(path)
+        if match is None or (prefix is not None and (match.group(1), match.group(3)) != (prefix, suffix)):
+            raise ValueError("Path '{}' does not follow the naming scheme '{}<id>{}'".format(path, prefix, suffix))
+        prefix, suffix = match.group(1), match.group(3)
+        digits.append(match.group(2))
+    width = min(len(d) for d in digits) if digits else 0
+    frame_ids = np.array([int(d) for d in digits], dtype=np.int64)
+    for path, d, frame_id in zip(paths, digits, frame_ids):
+        if str(frame_id).zfill(width) != d:  # the name could not be rebuilt from the id
+            raise ValueError("Path '{}' is not padded to {} digits like the other frames".format(path, width))
+    return prefix, frame_ids, width, suffix
+
+
+def build_index(mode, root=DATA_ROOT):
+    """
+    converts the log file of a split into the compact index and saves it as index.npz
+    :param mode: "train" or "test"
+    :param root: folder that contains the split folders
+    :return: path of the index file
+    """
+    split_path = Path(root) / mode
+    with open(str(split_path / "out_log.json"), "r") as json_file:
+        data = json.load(json_file)
+    input_prefix, frame_ids, width, suffix = split_paths([path for path, _ in data["inputs"]])
+    label_prefix, label_ids, label_width, label_suffix = split_paths([path for path, _ in data["labels"]])
+    if not np.array_equal(frame_ids, label_ids) or (width, suffix) != (label_width, label_suffix):
+        raise ValueError("Inputs and labels of {} are not named equally".format(split_path / "out_log.json"))
+    flags = np.array([int(flag) for _, flag in data["inputs"]], dtype=np.bool_)
+    flags[:1] = True  # the first frame always starts a clip
+    clip_start = np.flatnonzero(flags)
+    clip_length = np.diff(np.append(clip_start, len(flags)))
+    clip_ids = np.repeat(np.arange(len(clip_start)), clip_length)
+    path = split_path / "index.npz"
+    np.savez(str(path), frame_ids=frame_ids, clip_ids=clip_ids, clip_start=clip_start, clip_length=clip_length,
+             input_prefix=input_prefix, label_prefix=label_prefix, width=width, suffix=suffix)
+    return path
+
+
+class FrameIndex:
+    """
+    Read only, fork-safe replacement of the out_log.json lists (see module documentation).
+    The cached index is (re)built from the log file if necessary.
+
+    :param mode: "train" or "test"
+    :param root: folder that contains the split folders
+    """
+    def __init__(self, mode, root=DATA_ROOT):
+        """
+        see help(FrameIndex)
+        """
+        split_path = Path(root) / mode
+        log_path, path = split_path / "out_log.json", split_path / "index.npz"
+        if not path.exists() or os.path.getmtime(str(path)) < os.path.getmtime(str(log_path)):
+            sys.stderr.write("Building frame index of {}\n".format(log_path))
+            build_index(mode, root)
+        index = np.load(str(path))
+        self.frame_ids = index["frame_ids"]
+        self.clip_ids = index["clip_ids"]
+        self.clip_start = index["clip_start"]
+        self.clip_length = index["clip_length"]
+        self.input_prefix = str(index["input_prefix"])
+        self.label_prefix = str(index["label_prefix"])
+        # the green screen frames of the online compositing are saved in "foreground/" next to the input folder
+        self.foreground_prefix = os.path.join(os.path.dirname(os.path.dirname(self.input_prefix)), "foreground", "")
+        self.width = int(index["width"])
+        self.suffix = str(index["suffix"])
+
+    def __len__(self):
+        return len(self.frame_ids)
+
+    @property
+    def num_clips(self):
+        return len(self.clip_start)
+
+    @property
+    def offsets(self):
+        """
+        :return: index of the first frame of every clip, the last entry is the number of frames
+        """
+        return np.append(self.clip_start, len(self.frame_ids))
+
+    def video_start(self, idx):
+        """
+        :param idx: index of a frame
+        :return: True if the frame is the first frame of a 4 sec. clip
+        """
+        return bool(self.clip_start[self.clip_ids[idx]] == idx)
+
+    def clip(self, clip_idx):
+        """
+        :param clip_idx: index of the 4 sec. clip
+        :return: index of the first frame and number of frames of the clip
+        """
+        return int(self.clip_start[clip_idx]), int(self.clip_length[clip_idx])
+
+    def file_name(self, idx):
+        return str(self.frame_ids[idx]).zfill(self.width) + self.suffix
+
+    def input_path(self, idx):
+        """
+        :param idx: index of a frame
+        :return: path of the input image
+        """
+        return self.input_prefix + self.file_name(idx)
+
+    def foreground_path(self, idx):
+        """
+        :param idx: index of a frame
+        :return: path of the green screen frame (see src/dataset/backgrounds.py)
+        """
+        return self.foreground_prefix + self.file_name(idx)
+
+    def label_path(self, idx):
+        """
+        :param idx: index of a frame
+        :return: path of the label image
+        """
+        return self.label_prefix + self.file_name(idx)
@@ -0,0 +1,71 @@
+import cv2
+import numpy as np
+
+"""
+Chroma keying of the green screen frames on preallocated uint8 buffers.
+
+A chunk of frames is keyed with a single cv2.inRange call, the composite and the (single channel) label are written
+into buffers that are reused for every chunk, so no int64 / float64 intermediate arrays are created.
+Produces the same composite as np.where(mask, background, frame) with the noisy background cast to uint8.
+"""
+
+
+class ChromaKeyer:
+    """
+    Keys chunks of up to chunk_size frames of size (height, width).
+
+    Usage:
+        n = keyer.read(cap)  # reads the next chunk of a cv2.VideoCapture into keyer.frames
+        composite, label = keyer.key(n, background)
+
+    :param lower: lower bound of the green screen color (BGR)
+    :param upper: upper bound of the green screen color (BGR)
+    :param height: height of the frames
+    :param width: width of the frames
+    :param chunk_size: maximum number of frames processed at once
+    """
+    def __init__(self, lower, upper, height, width, chunk_size=32):
+        """
+        see help(ChromaKeyer)
+        """
+        self.lower = np.asarray(lower)
+        self.upper = np.asarray(upper)
+        self.chunk_size = chunk_size
+        self.frames = np.empty((chunk_size, height, width, 3), dtype=np.uint8)
+        self.composite = np.empty((chunk_size, height, width, 3), dtype=np.uint8)
+        self.key_mask = np.empty((chunk_size, height, width), dtype=np.uint8)
+        self.green = np.empty((chunk_size, height, width, 1), dtype=np.bool_)
+        self.label = np.empty((chunk_size, height, width), dtype=np.uint8)
+
+    def read(self, cap):
+        """
+        reads up to chunk_size frames into self.frames
+        :param cap: cv2.VideoCapture
+        :return: number of frames that have been read
+        """
+        for n in range(self.chunk_size):
+            ret, frame = cap.read(self.frames[n])
+            if not ret:
+                return n
+            if not np.shares_memory(frame, self.frames):  # cv2 could not decode into the buffer
+                self.frames[n] = frame
+        return self.chunk_size
+
+    def key(self, n, background):
+        """
+        keys the first n frames of self.frames
+        :param n: number of frames
+        :param background: uint8 BGR background (height, width, 3)
+        :return: composite (n, height, width, 3) and label (n, height, width) with 255 = person, 0 = background.
+                 Both are views of the buffers and are overwritten by the next call.
+        """
+        frames, key_mask = self.frames[:n], self.key_mask[:n]
+        height, width = frames.shape[1:3]
+        # one inRange call for the whole chunk (the frames are stacked vertically)
+        cv2.inRange(frames.reshape(n * height, width, 3), self.lower, self.upper,
+                    dst=key_mask.reshape(n * height, width))
+        np.greater(key_mask[..., None], 0, out=self.green[:n])
+        np.copyto(self.composite[:n], frames)
+        np.copyto(self.composite[:n], background, where=self.green[:n])
+        np.subtract(255, key_mask, out=self.label[:n])
+        return self.composite[:n], self.label[:n]
@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+import sys
+from pathlib import Path
+
+"""
+Manifest of an incremental preprocessing step.
+
+The manifest ("manifest.json" in the output folder) records the parameters of the preprocessing and one entry per
+processed unit (a source video or a 4 sec. clip), containing the content hashes of its inputs and what has been
+written for it. A rerun compares the entries with the current inputs and only processes the units that are new or
+whose inputs changed. If the parameters differ from the recorded ones, all entries are discarded and everything is
+processed again.
+Hashing a video reads the whole file, therefore the hashes are cached together with the size and modification time of
+the file.
+"""
+
+
+def file_hash(path, block_size=1 << 20):
+    """
+    :param path: path of a file
+    :return: sha1 hex digest of the content of the file
+    """
+    sha1 = hashlib.sha1()
+    with open(str(path), "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+class Manifest:
+    """
+    Read and write access to a manifest file.
+
+    - entries: dict key -> entry (json serializable dict)
+    - order: list of keys, e.g. the order of the clips in out_log.json
+
+    :param path: path of the manifest file
+    :param params: json serializable dict of the preprocessing parameters
+    """
+    def __init__(self, path, params):
+        """
+        see help(Manifest)
+        """
+        self.path = Path(path)
+        self.params = json.loads(json.dumps(params))  # tuples -> lists, to compare it with the loaded parameters
+        data = {}
+        if self.path.exists():
+            with open(str(self.path), "r") as js:
+                data = json.load(js)
+        self.hashes = data.get("hashes", {})  # path -> [size, modification time, hash]
+        if data and data.get("params") != self.params:
+            sys.stderr.write("Preprocessing parameters changed, {} is rebuilt\n".format(self.path.parent))
+            data = {}
+        self.entries = data.get("entries", {})
+        self.order = data.get("order", [])
+
+    def hash(self, path):
+        """
+        :param path: path of a file
+        :return: content hash of the file (cached)
+        """
+        stat = os.stat(str(path))
+        cached = self.hashes.get(str(path))
+        if cached is not None and cached[:2] == [stat.st_size, stat.st_mtime_ns]:
+            return cached[2]
+        digest = file_hash(path)
+        self.hashes[str(path)] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+    def unchanged(self, key, signature):
+        """
+        :param key: key of the entry
+        :param signature: dict of the inputs of the unit (e.g. hashes and frame range)
+        :return: True if the entry exists and was created from the same inputs
+        """
+        entry = self.entries.get(key)
+        return entry is not None and all(entry.get(name) == value for name, value in signature.items())
+
+    def save(self):
+        """
+        writes the manifest (atomically, an interrupted run keeps the previous manifest)
+        """
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(str(tmp_path), "w") as js:
+            json.dump({"params": self.params, "entries": self.entries, "order": self.order, "hashes": self.hashes}, js)
+        os.replace(str(tmp_path), str(self.path))
@@ -0,0 +1,106 @@
+import json
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+
+"""
+Lossless bit-packed storage of the ground truth masks.
+
+The masks of every 4 sec. clip are stored in "src/dataset/data/images/YT_4sec/[train|test]/masks/<clip>.npy" as
+np.packbits of the binary mask along the image width, uint8 (T, H, ceil(W / 8)), so 8 pixels per byte.
+"masks/size.json" contains the height and width of the masks.
+Compared to the JPEG labels no decoding, rounding or channel conversion is necessary and there is no compression noise
+at the edges of the person.
+
+Created by "Vid2Img_preprocess.py", read by YT_Greenscreen.
+"""
+
+
+def pack_masks(masks):
+    """
+    :param masks: binary masks (T, H, W) or (H, W), nonzero values belong to the person
+    :return: bit-packed masks (T, H, ceil(W / 8)) or (H, ceil(W / 8))
+    """
+    return np.packbits(np.asarray(masks) != 0, axis=-1)
+
+
+def unpack_masks(bits, width):
+    """
+    :param bits: bit-packed masks as created by pack_masks()
+    :param width: width of the masks
+    :return: uint8 masks with the values 0 (background) and 1 (person)
+    """
+    return np.unpackbits(bits, axis=-1, count=width)
+
+
+class MaskWriter:
+    """
+    Writes the packed masks of a split clip by clip.
+
+    :param folder: output folder, e.g. "src/dataset/data/images/YT_4sec/train/masks"
+    :param size: (width, height) of the masks
+    """
+    def __init__(self, folder, size):
+        """
+        see help(MaskWriter)
+        """
+        self.folder = Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        with open(str(self.folder / "size.json"), "w") as js:
+            json.dump({"width": int(size[0]), "height": int(size[1])}, js)
+
+    def write_clip(self, clip_idx, packed):
+        """
+        :param clip_idx: index of the 4 sec. clip in the split (same order as the clips in out_log.json)
+        :param packed: list or array of the packed masks of all frames of the clip (see pack_masks())
+        """
+        np.save(str(self.folder / (str(clip_idx).zfill(5) + ".npy")), np.stack(packed))
+
+
+class PackedMasks:
+    """
+    Read access to the masks written by MaskWriter.
+    The clip files are memory-mapped when they are accessed for the first time, so only the bytes of the requested
+    frames are read. At most max_open clips stay mapped (least recently used ones are closed).
+
+    :param folder: folder of the packed masks
+    :param max_open: number of clips that are kept open, should be at least the number of clips in a batch
+    """
+    def __init__(self, folder, max_open=64):
+        """
+        see help(PackedMasks)
+        """
+        self.folder = Path(folder)
+        with open(str(self.folder / "size.json"), "r") as js:
+            size = json.load(js)
+        self.width, self.height = size["width"], size["height"]
+        self.max_open = max_open
+        self.clips = OrderedDict()
+
+    @staticmethod
+    def exists(folder):
+        """
+        :return: True if packed masks have been created for the split
+        """
+        return (Path(folder) / "size.json").exists()
+
+    def clip(self, clip_idx):
+        """
+        :param clip_idx: index of the 4 sec. clip
+        :return: memory-mapped packed masks (T, H, ceil(W / 8)) of the clip
+        """
+        if clip_idx in self.clips:
+            self.clips.move_to_end(clip_idx)
+        else:
+            self.clips[clip_idx] = np.load(str(self.folder / (str(clip_idx).zfill(5) + ".npy")), mmap_mode="r")
+            if len(self.clips) > self.max_open:
+                self.clips.popitem(last=False)
+        return self.clips[clip_idx]
+
+    def mask(self, clip_idx, frame):
+        """
+        :param clip_idx: index of the 4 sec. clip
+        :param frame: index of the frame inside of the clip
+        :return: uint8 mask (H, W) with the values 0 (background) and 1 (person)
+        """
+        return unpack_masks(self.clip(clip_idx)[frame], self.width)
@@ -0,0 +1,162 @@
+import queue
+import sys
+import threading
+import time
+
+"""
+Thread pipeline with bounded queues.
+
+Every stage runs a function on the items of its input queue in one or more threads and puts the results into the
+input queue of the next stage. The queues between the stages are bounded, so a fast stage blocks instead of filling the
+memory when the next stage is slower. cv2 releases the GIL while decoding, resizing and encoding, so the stages run in
+parallel without copying the frames between processes.
+Items of a stage with one thread stay in order, a stage with several threads may reorder them.
+"""
+
+END = object()  # marks the end of the input of a stage
+
+
+class PipelineError(Exception):
+    """
+    raised in the main thread if a stage failed
+    """
+
+
+class _Abort(Exception):
+    pass
+
+
+class Pipeline:
+    """
+    Runs a list of stages, each stage is a tuple (name, function, number of threads).
+    The function is called with one item and returns an iterable of output items (e.g. a generator), which are passed
+    to the next stage. The output items of the last stage are discarded.
+
+    Usage:
+        pipeline = Pipeline([("decode", decode, 2), ("key", key, 1), ("write", write, 4)])
+        pipeline.run(videos)
+        pipeline.print_stats()
+
+    :param stages: list of (name, function, number of threads)
+    :param maxsize: capacity of the queues between the stages
+    :param count: function that returns the number of frames of an output item (e.g. of a chunk of frames), if given
+                  print_stats() reports the frames per second of every stage
+    """
+    def __init__(self, stages, maxsize=4, count=None):
+        """
+        see help(Pipeline)
+        """
+        self.stages = stages
+        self.maxsize = maxsize
+        self.count = count
+        self.error = None
+        self.failed = threading.Event()
+        self.lock = threading.Lock()
+        self.busy = {name: 0. for name, _, _ in stages}  # seconds spent in the function of every stage
+        self.items = {name: 0 for name, _, _ in stages}  # number of output items of every stage
+        self.frames = {name: 0 for name, _, _ in stages}  # number of frames of the output items (see count)
+        self.duration = 0.
+
+    def put(self, q, item):
+        while True:
+            try:
+                q.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self.failed.is_set():
+                    raise _Abort()
+
+    def get(self, q):
+        while True:
+            try:
+                return q.get(timeout=0.1)
+            except queue.Empty:
+                if self.failed.is_set():
+                    raise _Abort()
+
+    def worker(self, name, function, in_queue, out_queue, running):
+        """
+        processes the items of in_queue until END is received
+        :param running: list with the number of running threads of the stage
+        """
+        try:
+            while True:
+                item = self.get(in_queue)
+                if item is END:
+                    self.put(in_queue, END)  # the other threads of the stage have to stop as well
+                    break
+                start = time.time()
+                outputs = iter(function(item))
+                while True:
+                    try:
+                        output = next(outputs)
+                    except StopIteration:
+                        break
+                    finally:
+                        with self.lock:
+                            self.busy[name] += time.time() - start
+                    frames = self.count(output) if self.count is not None else 0
+                    with self.lock:
+                        self.items[name] += 1
+                        self.frames[name] += frames
+                    if out_queue is not None:
+                        self.put(out_queue, output)
+                    start = time.time()
+            with self.lock:
+                running[0] -= 1
+                last = running[0] == 0
+            if last and out_queue is not None:
+                self.put(out_queue, END)
+        except _Abort:
+            pass
+        except BaseException as e:
+            with self.lock:
+                if self.error is None:
+                    self.error = (name, e)
+            self.failed.set()
+
+    def run(self, items):
+        """
+        feeds the items into the first stage and waits until all stages are finished
+        :param items: iterable of the input items of the first stage
+        """
+        start = time.time()
+        queues = [queue.Queue(maxsize=self.maxsize) for _ in self.stages]
+        threads = []
+        for i, (name, function, num_threads) in enumerate(self.stages):
+            out_queue = queues[i + 1] if i + 1 < len(queues) else None
+            running = [num_threads]
+            for _ in range(num_threads):
+                thread = threading.Thread(target=self.worker, name=name, daemon=True,
+                                          args=(name, function, queues[i], out_queue, running))
+                thread.start()
+                threads.append(thread)
+        try:
+            for item in items:
+                self.put(queues[0], item)
+            self.put(queues[0], END)
+        except _Abort:
+            pass
+        for thread in threads:
+            thread.join()
+        self.duration = time.time() - start
+        if self.error is not None:
+            name, e = self.error
+            raise PipelineError("Stage '{}' failed: {!r}".format(name, e)) from e
+
+    def print_stats(self, file=sys.stderr):
+        """
+        prints the number of items and the time spent in every stage (a stage is the bottleneck if its busy time
+        divided by its number of threads is close to the total duration)
+        """
+        file.write("Pipeline finished after {:.1f}s\n".format(self.duration))
+        for name, _, num_threads in self.stages:
+            file.write("  {:<10} {:>8} items, busy {:8.1f}s in {} thread(s)\n".format(name, self.items[name],
+                                                                                    self.busy[name], num_threads))
+            if self.count is not None:
+                # frames per second of the stage if it never waited for the other stages
+                fps = self.frames[name] * num_threads / self.busy[name] if self.busy[name] > 0 else float("inf")
+                file.write("  {:<10} {:>8} frames, {:8.1f} frames/s\n".format("", self.frames[name], fps))
+        if self.count is not None and self.duration > 0:
+            last = self.stages[-1][0]
+            file.write("  {:.1f} frames/s in total\n".format(self.frames[last] / self.duration))
@@ -0,0 +1,75 @@
+import contextlib
+import torch
+
+
+def to_model_input(images, labels):
+    """
+    converts a batch as returned by the DataLoader into the format expected by the models and loss functions.
+    uint8 frames (0 - 255) are scaled to float in the range [0, 1], labels are converted to long.
+    :param images: uint8 or float tensor, or a tuple of cached float16 backbone features (see feature_cache.py)
+    :param labels: integer tensor
+    :return: images, labels
+    """
+    if isinstance(images, (tuple, list)):
+        return tuple(features.float() for features in images), labels.long()
+    if images.dtype == torch.uint8:
+        images = images.float().div_(255)
+    return images, labels.long()
+
+
+class DevicePrefetcher:
+    """
+    Wraps a DataLoader and moves its batches to the device.
+    On a cuda device, the host-to-device copy (and the uint8 -> float conversion) of the next batch is started on a
+    separate stream before the current batch is returned, such that the copy overlaps with the current training step
+    (double buffering). Use together with DataLoader(pin_memory=True), otherwise the copy can not be asynchronous.
+    On the cpu the batches are converted synchronously.
+
+    Yields the same structure as YT_Greenscreen: idx, video_start, (images, labels), only images and labels are moved.
+
+    :param loader: the DataLoader
+    :param device: target device
+    """
+    def __init__(self, loader, device):
+        """
+        see help(DevicePrefetcher)
+        """
+        self.loader = loader
+        self.device = torch.device(device)
+
+    def __len__(self):
+        return len(self.loader)
+
+    def _preload(self, iterator, stream):
+        """
+        fetches the next batch and starts copying it to the device
+        :return: the batch on the device or None if the loader is exhausted
+        """
+        try:
+            idx, video_start, (images, labels) = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream) if stream is not None else contextlib.nullcontext():
+            if isinstance(images, (tuple, list)):
+                images = tuple(features.to(self.device, non_blocking=True) for features in images)
+            else:
+                images = images.to(self.device, non_blocking=True)
+            labels = labels.to(self.device, non_blocking=True)
+            images, labels = to_model_input(images, labels)
+        return idx, video_start, (images, labels)
+
+    def __iter__(self):
+        stream = torch.cuda.Stream(device=self.device) if self.device.type == "cuda" else None
+        iterator = iter(self.loader)
+        next_batch = self._preload(iterator, stream)
+        while next_batch is not None:
+            if stream is not None:
+                torch.cuda.current_stream(self.device).wait_stream(stream)
+                _, _, (images, labels) = next_batch
+                # the tensors were allocated on the copy stream but will be used on the current stream
+                for tensor in images if isinstance(images, tuple) else (images,):
+                    tensor.record_stream(torch.cuda.current_stream(self.device))
+                labels.record_stream(torch.cuda.current_stream(self.device))
+            batch = next_batch
+            next_batch = self._preload(iterator, stream)
+            yield batch
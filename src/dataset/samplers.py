@@ -0,0 +1,188 @@
+import random
+from collections import deque
+from torch.utils.data import Sampler
+
+
+class ResumableBatchSampler(Sampler):
+    """
+    Base class of the batch samplers of the YT_Greenscreen dataset.
+    The sampler keeps track of the batch the training loop is at, such that the training can be continued at exactly
+    this batch after a script restart, without iterating over (or padding) the batches that have already been trained.
+
+    The training loop has to call step() after every processed batch. The position is not advanced while iterating,
+    because the DataLoader requests batches from the sampler ahead of time (worker prefetching).
+    state_dict() / load_state_dict() capture the epoch, the position and the seed. Together they determine the random
+    order of the current epoch, since the order is derived from seed + epoch only (see batches()).
+
+    Subclasses implement batches().
+
+    :param batch_size: number of samples per batch (B)
+    :param shuffle: if True the order is shuffled every epoch (see set_epoch())
+    :param seed: seed used for shuffling
+    """
+    def __init__(self, batch_size, shuffle=False, seed=0):
+        """
+        see help(ResumableBatchSampler)
+        """
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.position = 0
+
+    def set_epoch(self, epoch):
+        """
+        changes the order of the batches if shuffle is True. The position is reset to the first batch if a new epoch
+        starts, if the epoch is continued after a restart the position is kept.
+        :param epoch: the current epoch
+        """
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.position = 0
+
+    def step(self):
+        """
+        marks the current batch as processed
+        """
+        self.position += 1
+
+    def state_dict(self):
+        """
+        :return: dict that can be stored in the checkpoint
+        """
+        return {"epoch": self.epoch, "position": self.position, "seed": self.seed}
+
+    def load_state_dict(self, state_dict):
+        """
+        continues at the position stored by state_dict()
+        :param state_dict: dict returned by state_dict()
+        """
+        self.epoch = state_dict["epoch"]
+        self.position = state_dict["position"]
+        self.seed = state_dict["seed"]
+
+    def rng(self):
+        """
+        :return: random generator of the current epoch
+        """
+        return random.Random(self.seed + self.epoch)
+
+    def batches(self):
+        """
+        creates all batches of the current epoch
+        :return: list of batches
+        """
+        raise NotImplementedError
+
+    def __iter__(self):
+        return iter(self.batches()[self.position:])
+
+    def __len__(self):
+        """
+        :return: number of batches of a full epoch (independent of the position)
+        """
+        return len(self.batches())
+
+
+class FrameBatchSampler(ResumableBatchSampler):
+    """
+    Batch sampler that yields batches of B consecutive frames (same order as DataLoader(batch_size=B, shuffle=False)).
+    The last incomplete batch is dropped.
+
+    :param num_frames: number of frames of the dataset
+    :param batch_size: number of frames per batch (B)
+    :param start_frame: index of the first frame of the first batch (e.g. the first frame of a clip for evaluation)
+    """
+    def __init__(self, num_frames, batch_size, start_frame=0):
+        """
+        see help(FrameBatchSampler)
+        """
+        super().__init__(batch_size)
+        self.num_frames = num_frames
+        self.start_frame = start_frame
+
+    def batches(self):
+        starts = range(self.start_frame, self.num_frames - self.batch_size + 1, self.batch_size)
+        return [list(range(start, start + self.batch_size)) for start in starts]
+
+
+class ClipBatchSampler(ResumableBatchSampler):
+    """
+    Batch sampler for the YT_Greenscreen dataset that yields batches of B clips x T consecutive frames.
+    Instead of filling a batch with consecutive frames of the same clip, every batch position (slot) follows its own
+    4 second clip, such that a recurrent model can unroll T steps on B independent streams per forward pass.
+
+    By default the clips are grouped into groups of B clips that are processed in lockstep: all slots start a new clip
+    in the same batch. Every group yields min(clip length) // T windows, the remaining frames of the group are skipped.
+    With mixed=True every slot starts its next clip as soon as its current clip has no complete window left, so the
+    slots of a batch start their clips in different batches and only the clips' last length % T frames are skipped.
+    This requires a model that only resets the state of the slots whose video_start is set
+    (see src.models.recurrent_modules.RecurrentState).
+    Each batch is a list of (start_index, T) tuples, which YT_Greenscreen.__getitem__ turns into a window of T frames.
+
+    :param clip_offsets: index of the first frame of every clip, the last entry is the number of frames
+    :param batch_size: number of clips processed in parallel (B)
+    :param seq_len: number of consecutive frames per clip and batch (T)
+    :param shuffle: if True the order of the clips is shuffled every epoch (see set_epoch())
+    :param seed: seed used for shuffling the clips
+    :param mixed: if True the slots are not processed in lockstep (see above)
+    """
+    def __init__(self, clip_offsets, batch_size, seq_len, shuffle=False, seed=0, mixed=False):
+        """
+        see help(ClipBatchSampler)
+        """
+        super().__init__(batch_size, shuffle=shuffle, seed=seed)
+        self.clip_offsets = [int(offset) for offset in clip_offsets]
+        self.seq_len = seq_len
+        self.mixed = mixed
+
+    def clip_order(self):
+        """
+        :return: list of clip indices in the order they are processed in the current epoch
+        """
+        clips = list(range(len(self.clip_offsets) - 1))
+        if self.shuffle:
+            self.rng().shuffle(clips)
+        return clips
+
+    def groups(self):
+        """
+        :return: list of (clips, number of windows) of all groups of the current epoch
+        """
+        clips = self.clip_order()
+        groups = []
+        for g in range(0, len(clips) - self.batch_size + 1, self.batch_size):  # incomplete groups are dropped
+            group = clips[g:g + self.batch_size]
+            length = min(self.clip_offsets[c + 1] - self.clip_offsets[c] for c in group)
+            groups.append((group, length // self.seq_len))
+        return groups
+
+    def mixed_batches(self):
+        """
+        :return: list of batches (see batches()) in which every slot continues with the next clip of the clip order
+                 when its clip ends. The batches end when the clips run out, the last clips of the slots are cut off.
+        """
+        clips = iter(self.clip_order())
+        windows = [deque() for _ in range(self.batch_size)]  # start indices of the remaining windows of every slot
+        batches = []
+        while True:
+            for slot in windows:
+                while not slot:
+                    clip = next(clips, None)
+                    if clip is None:
+                        return batches
+                    start, end = self.clip_offsets[clip], self.clip_offsets[clip + 1]
+                    slot.extend(range(start, end - self.seq_len + 1, self.seq_len))
+            batches.append([(slot.popleft(), self.seq_len) for slot in windows])
+
+    def batches(self):
+        """
+        :return: list of batches, each batch is a list of (start_index, seq_len) tuples
+        """
+        if self.mixed:
+            return self.mixed_batches()
+        batches = []
+        for group, num_windows in self.groups():
+            for w in range(num_windows):
+                batches.append([(self.clip_offsets[c] + w * self.seq_len, self.seq_len) for c in group])
+        return batches
@@ -0,0 +1,137 @@
+import json
+import cv2
+import numpy as np
+from collections import OrderedDict
+from pathlib import Path
+
+"""
+Planning and encoding of the 4 second clips of "4sec_preprocess.py".
+
+The clip boundaries of a video only depend on its frame count and frame rate, so all clips (and their output ids) can
+be planned before any frame is decoded. The videos can then be encoded independently of each other (e.g. in a
+process pool), with exactly the same result as the original serial loop:
+- a video with T frames and L = 4 * fps frames per clip is split into max(1, T // L) clips, the remaining frames are
+  dropped (a video shorter than L frames becomes a single shorter clip)
+- the global clip counter is increased by T // L, but only by T // L - 1 if T is a multiple of L and not at all if
+  T < L. The next video therefore starts with the id of the last clip in these cases and overwrites its file
+  (the last video that writes an id wins)
+The plan assumes that the frame count reported by the container matches the number of decodable frames.
+
+The plan is also saved as an index of virtual clips ("clips.json", see save_clip_index()). Instead of reading the
+encoded clips, the frame extraction and the streaming dataset can decode the frame range of a clip directly from the
+original video.
+"""
+
+
+def clip_key(video_file, start):
+    """
+    stable identity of a clip, independent of the clip ids (which change if a video is added before it)
+    :param video_file: path of the original video
+    :param start: first frame of the clip in the original video
+    :return: key "<video file name>@<start frame>"
+    """
+    return "{}@{}".format(Path(str(video_file)).name, int(start))
+
+
+def plan_video(total_frames, frame_rate, first_id, max_duration=4):
+    """
+    plans the clips of a single video, following the frame loop of the serial splitting
+    :param total_frames: cv2.CAP_PROP_FRAME_COUNT of the video
+    :param frame_rate: int(cv2.CAP_PROP_FPS) of the video
+    :param first_id: value of the global clip counter before the video is processed
+    :param max_duration: length of the clips in seconds
+    :return: list of (clip_id, start_frame, end_frame) and the value of the clip counter after the video
+    """
+    if total_frames <= 0:
+        return [], first_id
+    length = max_duration * frame_rate
+    clips = []
+    clip_id, clip_start, starter_frame = first_id, 0, 0
+    for frame in range(total_frames):
+        if starter_frame + length == frame:  # 4 seconds passed
+            clips.append((clip_id, clip_start, frame))
+            clip_id += 1
+            starter_frame = frame
+            if starter_frame + length > total_frames:  # the last bit would not fit in 4 seconds
+                return clips, clip_id
+            clip_start = frame
+    clips.append((clip_id, clip_start, total_frames))
+    return clips, clip_id
+
+
+def plan_clips(video_files, max_duration=4):
+    """
+    plans the clips of all videos of a split
+    :param video_files: list of video paths in the order of the serial processing
+    :param max_duration: length of the clips in seconds
+    :return: OrderedDict video_file -> list of (clip_id, start_frame, end_frame), only containing the clips that are
+             not overwritten by a later video
+    """
+    owner = {}
+    next_id = 0
+    for video_file in video_files:
+        cap = cv2.VideoCapture(str(video_file))
+        total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        frame_rate = int(cap.get(cv2.CAP_PROP_FPS))
+        cap.release()
+        clips, next_id = plan_video(total_frames, frame_rate, next_id, max_duration)
+        for clip in clips:
+            owner[clip[0]] = (video_file, clip)  # a later video overwrites the clip
+    plan = OrderedDict((video_file, []) for video_file in video_files)
+    for video_file, clip in owner.values():
+        plan[video_file].append(clip)
+    for clips in plan.values():
+        clips.sort(key=lambda clip: clip[1])
+    return plan
+
+
+def encode_clips(video_file, clips, out_path, output_size, fps=29):
+    """
+    decodes a video once and writes the planned clips (resized to output_size)
+    :param video_file: path of the video
+    :param clips: list of (clip_id, start_frame, end_frame) sorted by start_frame
+    :param out_path: output folder, the clips are saved as "<clip_id>.mp4"
+    :param output_size: (width, height) of the clips
+    :param fps: frame rate of the clips
+    :return: video_file, number of written clips
+    """
+    fourcc = cv2.VideoWriter_fourcc(*"mp4v")
+    cap = cv2.VideoCapture(str(video_file))
+    frame_counter = 0
+    for clip_id, start, end in clips:
+        out_input = cv2.VideoWriter(str(out_path / (str(clip_id).zfill(5) + ".mp4")), fourcc, fps, output_size)
+        while frame_counter < end:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            if frame_counter >= start:  # frames of clips that are overwritten by a later video are skipped
+                out_input.write(np.uint8(cv2.resize(frame, output_size)))
+            frame_counter += 1
+        out_input.release()
+    cap.release()
+    return video_file, len(clips)
+
+
+def save_clip_index(plan, path, output_size):
+    """
+    saves the planned clips as virtual clips
+    :param plan: result of plan_clips()
+    :param path: path of the index file (json)
+    :param output_size: (width, height) the frames of the clips are resized to
+    """
+    clips = sorted((clip_id, str(video_file), start, end - start) for video_file, video_clips in plan.items()
+                   for clip_id, start, end in video_clips)
+    with open(str(path), "w") as js:
+        json.dump({"output_size": [int(v) for v in output_size],
+                   "clips": [[str(clip_id).zfill(5), video_file, start, length]
+                             for clip_id, video_file, start, length in clips]}, js)
+
+
+def load_clip_index(path):
+    """
+    :param path: path of the index file written by save_clip_index()
+    :return: output_size (width, height), list of (clip name, source video, start frame, number of frames)
+    """
+    with open(str(path), "r") as js:
+        index = json.load(js)
+    return tuple(index["output_size"]), [tuple(clip) for clip in index["clips"]]
@@ -0,0 +1,77 @@
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+import pandas as pd
+import torch
+from src.dataset.YT_Greenscreen import YT_Greenscreen
+from src.utils import fast_hist, jaccard_index
+from src.video_segmenter import VideoSegmenter
+
+"""
+Benchmark of the keyframe inference (see DeeplabWrapper.set_keyframes()): accuracy and speed of a trained model for
+different keyframe intervals k and adaptive thresholds.
+
+The clips of the test split are segmented frame by frame (like a live video). For every setting the script reports
+the mIoU to the labels, the pixel agreement with the predictions of k = 1 (every frame is a keyframe), the share of
+keyframes and the time per frame. The results are saved as keyframe_results.csv in the model folder.
+
+:param -pth: The path of the folder of the trained model
+:param --clips: number of clips of the test split
+:param --intervals: keyframe intervals, e.g. 1,2,3,5,10
+:param --thresholds: thresholds of the adaptive keyframes (with the largest interval as maximum distance)
+"""
+# python -m src.eval_keyframes -pth src/models/trained_models/yt_fullV4/<model folder> --clips 20
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-pth", "--path", help="The path of the folder", type=str, required=True)
+parser.add_argument("--checkpoint", type=str, default="best_checkpoint.pth.tar")
+parser.add_argument("--clips", help="number of clips of the test split", type=int, default=20)
+parser.add_argument("--intervals", help="keyframe intervals", type=str, default="1,2,3,5,10")
+parser.add_argument("--thresholds", help="thresholds of the adaptive keyframes", type=str, default="0.1,0.2")
+args = parser.parse_args()
+
+with open(str(Path(args.path) / "train_config.json")) as js:
+    config = json.load(js)
+segmenter = VideoSegmenter(config, checkpoint=Path(args.path) / args.checkpoint, max_streams=1)
+dataset = YT_Greenscreen(train=False, apply_transform=False)
+offsets = [int(offset) for offset in dataset.clip_offsets]
+clips = [range(offsets[k], offsets[k + 1]) for k in range(min(args.clips, len(offsets) - 1))]
+sys.stderr.write("Benchmark on {} clips ({} frames)\n".format(len(clips), sum(len(clip) for clip in clips)))
+
+intervals = [int(k) for k in args.intervals.split(",") if k]
+# k = 1 is the reference of the agreement
+settings = [(1, None)] + [(k, None) for k in intervals if k != 1] + \
+           [(max(intervals), float(t)) for t in args.thresholds.split(",") if t]
+reference = {}
+rows = []
+for interval, threshold in settings:
+    segmenter.set_keyframes(interval, threshold)
+    hist = torch.zeros((2, 2))
+    agreement, frames, duration = 0., 0, 0.
+    for clip in clips:
+        segmenter.close_stream("clip")
+        for idx in clip:
+            _, frame, label = dataset.load_arrays(idx)
+            images = segmenter.to_input([frame])
+            if segmenter.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+            pred = segmenter.predict(images, ["clip"])
+            mask = torch.argmax(pred, dim=1)[0].cpu()
+            duration += time.time() - start
+            hist += fast_hist(mask.flatten(), torch.from_numpy(label).long().flatten(), 2)
+            if (interval, threshold) == (1, None):
+                reference[idx] = mask
+            agreement += float((mask == reference[idx]).float().mean())
+            frames += 1
+    keyframes = segmenter.model.num_keyframes if segmenter.model.keyframes else frames
+    label = "k={}".format(interval) + (" t={}".format(threshold) if threshold is not None else "")
+    rows.append([label, float(jaccard_index(hist)), agreement / frames, keyframes / frames, duration / frames * 1000])
+    sys.stderr.write("{}: mIoU {:.4f}, agreement {:.4f}, keyframes {:.2f}, {:.1f}ms per frame\n".format(
+        label, *rows[-1][1:]))
+
+df = pd.DataFrame(rows, columns=["setting", "mIoU", "agreement", "keyframes", "ms_per_frame"])
+print(df)
+df.to_csv(Path(args.path) / "keyframe_results.csv", index=False)
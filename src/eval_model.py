@@ -37,6 +37,10 @@ args = parser.parse_args()
 with open(args.path + "/train_config.json") as js:
     print("Loading config: ", args.path)
     config = json.load(js)
+    # the evaluation runs on the extracted frames with the backgrounds of the preprocessing
+    config["stream_clips"] = False
+    config["online_compositing"] = False
+    config["feature_cache"] = False
 
 
 def getSystemInfo():
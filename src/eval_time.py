@@ -26,6 +26,10 @@ for folder in model_path.glob("*"):
     try:
         with open(folder / "train_config.json") as js:
             config = json.load(js)
+            # the evaluation runs on the extracted frames with the backgrounds of the preprocessing
+            config["stream_clips"] = False
+            config["online_compositing"] = False
+            config["feature_cache"] = False
     except FileNotFoundError as e:
         print(e)
         continue
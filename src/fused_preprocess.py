@@ -0,0 +1,79 @@
+import os
+import random
+import shutil
+import sys
+import numpy as np
+from pathlib import Path
+from src.dataset.backgrounds import BACKGROUND_ROOT, background_paths
+from src.dataset.extraction import extract_split
+from src.dataset.index import DATA_ROOT
+from src.dataset.video_clips import clip_key, plan_clips
+
+"""
+PREPROCESSING (fused)
+
+Replaces "4sec_preprocess.py" and "Vid2Img_preprocess.py" by a single pass from the original videos to the final
+dataset ("src/dataset/data/images/YT_4sec/[train|test]" with input/, labels/, foreground/, masks/ and out_log.json).
+The 4 sec. clips are planned like in "4sec_preprocess.py" (see src/dataset/video_clips.py), but the frames are not
+re-encoded as mp4v clips and decoded again, which removes one lossy compression step.
+
+The frames flow through a thread pipeline with bounded queues (see src/dataset/extraction.py):
+decode (one video per thread) -> resize -> key / composite -> encode / write JPEGs
+Every clip gets a randomly chosen background with noise (depending on SEED and the clip id, see
+src/dataset/backgrounds.py), the clips are shuffled in the log file like in "Vid2Img_preprocess.py".
+Reruns only extract the clips of new or changed videos (see src/dataset/manifest.py).
+The number of threads is taken from NSLOTS (on the grid) or the number of cpus, the busy time of every stage is
+printed at the end.
+
+The streaming dataset mode ("stream_clips") still needs the clips of "4sec_preprocess.py".
+"""
+
+output_size = (int(2048 / 4), int(1080 / 4))
+lower_green = np.array([0, 125, 0])
+upper_green = np.array([100, 255, 120])
+MAX_DURATION = 4
+SEED = 12345
+
+
+def plan_split(video_files):
+    """
+    plans the clips of a split and their order in the log file
+    :param video_files: original videos of the split
+    :return: list of (clip key, video_file, start_frame, end_frame) in the order of the log file, the key (video name
+             and start frame) does not depend on the other videos of the split
+    """
+    plan = plan_clips(video_files, max_duration=MAX_DURATION)
+    clips = [(clip_key(video_file, start), video_file, start, end) for video_file, video_clips in plan.items()
+             for _, start, end in video_clips]
+    random.Random(SEED).shuffle(clips)
+    return clips
+
+
+def preprocess_split(split, num_decoders=1, num_writers=1):
+    """
+    creates the dataset of one split
+    :param split: "train" or "test"
+    :param num_decoders: number of threads that decode videos
+    :param num_writers: number of threads that encode and write the JPEG files
+    :return: the pipeline (for its statistics)
+    """
+    vid_path = Path("src/dataset/data/videos/YT_originals") / split
+    # same background split as in "Vid2Img_preprocess.py", copied so the evaluation uses the same backgrounds
+    bg_paths = background_paths(split)
+    (BACKGROUND_ROOT / split).mkdir(parents=True, exist_ok=True)
+    if not any((BACKGROUND_ROOT / split).iterdir()):
+        for path in bg_paths:
+            shutil.copy(str(path), str(BACKGROUND_ROOT / split))
+        bg_paths = background_paths(split)
+    clips = plan_split(sorted(str(vid) for vid in vid_path.glob("*.mp4")))
+    return extract_split(clips, DATA_ROOT / split, bg_paths, output_size, lower_green, upper_green, seed=SEED,
+                         num_decoders=num_decoders, num_writers=num_writers)
+
+
+if __name__ == "__main__":
+    # number of threads, on the grid the number of requested slots ("-pe default <n>")
+    num_threads = int(os.environ.get("NSLOTS", os.cpu_count()))
+    for split in ["train", "test"]:
+        pipeline = preprocess_split(split, num_decoders=max(1, num_threads // 2), num_writers=max(1, num_threads // 2))
+        sys.stderr.write("{}: ".format(split))
+        pipeline.print_stats()
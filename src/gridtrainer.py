@@ -12,6 +12,12 @@ from torch import optim
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 from src.dataset.YT_Greenscreen import YT_Greenscreen
+from src.dataset.clip_stream import YT_GreenscreenStream, ClipStreamLoader
+from src.dataset.samplers import ClipBatchSampler, FrameBatchSampler
+from src.dataset.augmentation import BatchAugmentation
+from src.dataset.backgrounds import BackgroundBank
+from src.dataset.feature_cache import FeatureCache, cache_folder
+from src.dataset.prefetcher import DevicePrefetcher
 from src.utils import initiator, time_logger, AverageMeter, stack, eval_metrics, fast_hist, jaccard_index
 from src.utils.visualizations import visualize_logger
 
@@ -53,10 +59,12 @@ class GridTrainer:
         if the Grid kill time is soon to be exceeded.
         dataset: the Youtube Greenscreen dataset.
         loader: DataLoader object from pytorch
+        sampler: batch sampler of the loader (see src.dataset.samplers). Tracks the position in the current epoch and
+        is stored in the checkpoint, such that the training continues at the exact batch after a restart.
         optimizer: Adam optimizer
         scheduler: Cyclic LR with step_size_up of 7* len(loader)
         _Restart: Flag that indicates if the script was just restarted (necessary for initiating certain values).
-        cur_idx: current idx of the batch loop. Necessary for the restart
+        cur_idx: current idx of the batch loop
 
 
     :param config: dict:
@@ -79,6 +87,34 @@ class GridTrainer:
                                         - "Focal" (probably needs parameter adjustment,
                                                    default values did not enable good learning)
         "evaluation_steps"      int:    in what interval should a evaluation occur.
+        Optional keys:
+        "packed_frames":        bool:   If True, frames are read from the memory-mapped arrays created by
+                                        src/dataset/frame_store.py instead of the JPEG files. Default: False
+        "sequence_length":      int:    If given, every batch contains batch_size clips x sequence_length consecutive
+                                        frames (see src.dataset.samplers.ClipBatchSampler) and the model is unrolled
+                                        over the sequence_length frames. Default: None (batches of single frames)
+        "shuffle_clips":        bool:   Shuffle the clip order every epoch (only with "sequence_length").
+                                        Default: False
+        "mixed_clips":          bool:   Every batch position starts its next clip as soon as its clip ends, instead of
+                                        all positions changing clips together (only with "sequence_length", see
+                                        src.dataset.samplers.ClipBatchSampler). Default: False
+        "num_workers":          int:    Number of DataLoader worker processes. Default: 0
+        "device_augmentation":  bool:   If True, the augmentation is applied to the whole batch after it has been
+                                        moved to the device (see src.dataset.augmentation) instead of to every single
+                                        PIL image in the DataLoader. Default: True
+        "stream_clips":         bool:   If True, the training clips are decoded directly from the 4 sec. MP4 files
+                                        (see src.dataset.clip_stream) instead of reading the extracted frames.
+                                        Uses "sequence_length" (or 1) and "shuffle_clips". The evaluation scripts
+                                        still use the extracted frames. Default: False
+        "online_compositing":   bool:   If True, the green screen frames are loaded and a random background is
+                                        inserted on the device every epoch (see src.dataset.backgrounds), instead of
+                                        using the background baked in by the preprocessing. Default: False
+        "feature_cache":        bool:   If True, the features of the frozen backbone are computed once and stored in a
+                                        memory-mapped cache (see src.dataset.feature_cache), only the rest of the
+                                        model is trained from the cached features. Can not be combined with
+                                        "stream_clips" and "online_compositing". Default: False
+        "feature_cache_variants": int:  Number of cached augmentation variants, variant 0 is not augmented, epoch e
+                                        uses variant e % feature_cache_variants. Default: 1
 
     :param train: boolean:
         If True, the training dataset will be used, else the testing dataset will be used.
@@ -112,11 +148,52 @@ class GridTrainer:
 
         self.batch_size = self.config["batch_size"] if batch_size is None else batch_size
         self.time_logger = time_logger.TimeLogger(restart_time=60 * 60 * 1.19)  # 60 * 60 * 1.2
-        self.dataset = YT_Greenscreen(train=train, start_index=0,
-                                      batch_size=self.batch_size, seed=self.seed)
         self.test = not train
-        self.loader = DataLoader(dataset=self.dataset, shuffle=False,
-                                 batch_size=self.batch_size)
+        self.num_workers = self.config.get("num_workers", 0)
+        self.pin_memory = torch.cuda.is_available()
+        online_compositing = self.config.get("online_compositing", False)
+        if self.config.get("stream_clips", False):
+            self.dataset = YT_GreenscreenStream(train=train, batch_size=self.batch_size,
+                                                seq_len=self.config.get("sequence_length") or 1, seed=self.seed,
+                                                shuffle=self.config.get("shuffle_clips", False),
+                                                foreground=online_compositing)
+        else:
+            self.dataset = YT_Greenscreen(train=train,
+                                          batch_size=self.batch_size, seed=self.seed,
+                                          packed=self.config.get("packed_frames", False),
+                                          device_augment=self.config.get("device_augmentation", True),
+                                          foreground=online_compositing)
+        self.augmentation = BatchAugmentation() if self.dataset.device_augment else None
+        self.backgrounds = BackgroundBank(self.dataset.mode, seed=self.seed) if online_compositing else None
+        self.feature_cache = None
+        if self.config.get("feature_cache", False):
+            if self.config.get("stream_clips", False) or online_compositing:
+                raise ValueError("feature_cache can not be combined with stream_clips or online_compositing")
+            backbone = "resnet50" if "resnet50" in self.config["model"] else "mobilenet"
+            self.feature_cache = FeatureCache(self.dataset, self.model, cache_folder(self.dataset.mode, backbone),
+                                              self.device, num_variants=self.config.get("feature_cache_variants", 1),
+                                              augmentation=self.augmentation)
+            self.augmentation = None  # the cached variants are already augmented
+        # the sampler keeps track of the position in the epoch and is saved in the checkpoint
+        if self.config.get("mixed_clips", False) and self.config.get("stream_clips", False):
+            raise ValueError("mixed_clips can not be combined with stream_clips")
+        if self.config.get("stream_clips", False):
+            self.sampler = self.dataset.sampler
+        elif self.config.get("sequence_length") is not None:
+            self.sampler = ClipBatchSampler(self.dataset.clip_offsets, batch_size=self.batch_size,
+                                            seq_len=self.config["sequence_length"],
+                                            shuffle=self.config.get("shuffle_clips", False), seed=self.seed,
+                                            mixed=self.config.get("mixed_clips", False))
+        else:
+            self.sampler = FrameBatchSampler(len(self.dataset), batch_size=self.batch_size)
+        if self.config.get("stream_clips", False):
+            self.loader = ClipStreamLoader(self.dataset, num_workers=self.num_workers, pin_memory=self.pin_memory)
+        else:
+            self.loader = DataLoader(dataset=self.dataset if self.feature_cache is None else self.feature_cache,
+                                     batch_sampler=self.sampler, num_workers=self.num_workers,
+                                     pin_memory=self.pin_memory)
+        # number of frames processed in one epoch
+        self.epoch_length = len(self.loader) * self.batch_size * (self.config.get("sequence_length") or 1)
         self.optimizer = optim.Adam(self.model.parameters(),
                                     lr=self.lr_boundarys[0],
                                     weight_decay=self.weight_decay)
@@ -129,7 +206,7 @@ class GridTrainer:
         # self.scheduler = optim.lr_scheduler.OneCycleLR(self.optimizer, max_lr=self.lr_boundarys[1],
         #                                              steps_per_epoch=len(self.loader), epochs=self.config["num_epochs"])
         self._RESTART = False
-        self.cur_idx = self.dataset.start_index
+        self.cur_idx = 0
         self.set_seeds(self.seed)
         if load_from_checkpoint:
             self.load_after_restart()
@@ -160,7 +237,11 @@ class GridTrainer:
         self.optimizer.load_state_dict(checkpoint["optim_state_dict"])
         self.scheduler.load_state_dict(checkpoint["scheduler"])
         self.logger = checkpoint
-        self.dataset.start_index = self.logger["batch_index"]
+        if "sampler" in self.logger:
+            self.sampler.load_state_dict(self.logger["sampler"])
+        else:  # checkpoints of older versions only contain the index of the last frame
+            self.sampler.load_state_dict({"epoch": self.logger["epochs"][-1], "seed": self.sampler.seed,
+                                          "position": self.logger["batch_index"] // self.batch_size})
         self.cur_idx = self.logger["batch_index"]
         self.set_seeds(self.logger["seed"])
         self._RESTART = True
@@ -190,7 +271,8 @@ class GridTrainer:
         """
         self.logger["state_dict"] = self.model.state_dict()
         self.logger["optim_state_dict"] = self.optimizer.state_dict()
-        self.logger["batch_index"] = self.dataset.cur_idx  # self.cur_idx[-1] + 1 if self.cur_idx[-1] != 0 else 0
+        self.logger["sampler"] = self.sampler.state_dict()
+        self.logger["batch_index"] = self.sampler.position
         self.logger["scheduler"] = self.scheduler.state_dict()
         self.logger["seed"] = self.dataset.seed
         torch.save(self.logger, self.config["save_files_path"] + "/checkpoint.pth.tar")
@@ -308,34 +390,54 @@ class GridTrainer:
             self.logger["running_loss"] = self.get_starting_parameters(what="running_loss")
             self.logger["miou"] = self.get_starting_parameters(what="miou")
             self._RESTART = False
-            for i, batch in enumerate(self.loader):
+            self.dataset.set_epoch(epoch)
+            if self.feature_cache is not None:
+                self.feature_cache.set_epoch(epoch)
+            self.sampler.set_epoch(epoch)  # keeps the position if the epoch is continued after a restart
+            # the next batch is copied to the device while the current one is processed
+            for i, batch in enumerate(DevicePrefetcher(self.loader, self.device)):
 
                 # ensure that current batch can be finished within the max runtime
                 if self.time_logger.check_for_restart():
-                    self.restart_script()
+                    self.restart_script()  # the sampler position points to this batch
                     return  # End the script
 
                 idx, video_start, (images, labels) = batch
                 self.cur_idx = idx
                 sys.stderr.write(f"\nCurrent Index: {idx}; dataset idx {self.cur_idx}")
 
-                # sent tensores to gpu if available
-                images, labels = (images.to(self.device), labels.to(self.device))
+                # images and labels are already on the device (see DevicePrefetcher)
+                if self.backgrounds is not None:
+                    images = self.backgrounds(images, labels, self.dataset.background_indices(idx))
+                if self.augmentation is not None:
+                    images, labels = self.augmentation(images, labels, self.dataset.augmentation_params(idx))
 
                 # check if a new 4 sec clip has started, if so make sure the hidden and cell state are reset and no
                 # wrong information is used
-                if torch.any(video_start):
+                if isinstance(self.sampler, ClipBatchSampler):
+                    # every batch position follows its own clip, only the positions that start a new clip are reset
+                    self.model.reset(video_start)
+                elif torch.any(video_start):
+                    # the batch positions are consecutive frames of the same clip
                     self.model.reset()
 
-                # manually check if end of batch is reached. Dataset will return idx=0 if length is overshot
-                if len(idx) == self.batch_size:
-                    if torch.sum(idx == 0) > 1:
-                        sys.stderr.write(f"\nEnd reached of batch at index {idx}\n")
-                        self.dataset.start_index = 0  # reset start index for the next batch
-                        break
-
-                pred = self.model(images)
-                loss = self.criterion(pred, labels)
+                # single frame batches (B, C, H, W) are handled as sequences of length 1
+                if labels.dim() == 3:
+                    images = images.unsqueeze(1) if self.feature_cache is None else \
+                        tuple(features.unsqueeze(1) for features in images)
+                    labels = labels.unsqueeze(1)
+                # unroll the model over the T frames of each clip, every batch position is an independent stream
+                preds = []
+                loss = 0
+                for t in range(labels.size(1)):
+                    if self.feature_cache is None:
+                        pred = self.model(images[:, t])
+                    else:  # cached backbone features (out, low_level)
+                        features = {"out": images[0][:, t], "low_level": images[1][:, t]}
+                        pred = self.model.forward_head(features, self.feature_cache.input_shape)
+                    loss = loss + self.criterion(pred, labels[:, t])
+                    preds.append(pred)
+                loss = loss / labels.size(1)
 
                 # keep track of memory usage
                 # memory = get_gpu_memory_map()[0] if torch.cuda.is_available() else 0
@@ -353,23 +455,24 @@ class GridTrainer:
                     loss.backward(retain_graph=True)
                 self.optimizer.step()
                 self.scheduler.step()
-                self.logger["running_loss"] += loss.item() * images.size(0)
+                self.logger["running_loss"] += loss.item() * labels.size(0) * labels.size(1)
                 print("Loss: {}, running_loss: {}".format(loss, self.logger["running_loss"]))
                 with torch.no_grad():
-                    outputs = torch.argmax(pred, dim=1).float()
-                    labels = labels.type(torch.uint8)
+                    outputs = torch.argmax(torch.stack(preds, dim=1).flatten(0, 1), dim=1).float()
+                    labels = labels.flatten(0, 1).type(torch.uint8)
                     outputs = outputs.type(torch.uint8)
                     set_out = torch.max(outputs.int())  # can only be in range (0-1)
                     set_lbl = torch.max(labels.int())
                     num_classes = max(set_out, set_lbl) + 1
                     hist = fast_hist(outputs.to("cpu"), labels.to("cpu"), num_classes=num_classes)
                     self.logger["miou"] += jaccard_index(hist)
+                self.sampler.step()
 
             # with open(str(self.config["save_files_path"] + "/memory.txt"), "w") as txt_file:
             #
             #     txt_file.write(f"Max cuda memory used in epoch {epoch}: {max_mem}\n")
-            self.logger["mious"].append(self.logger["miou"] / len(self.dataset))
-            self.logger["loss"].append(self.logger["running_loss"] / len(self.dataset))
+            self.logger["mious"].append(self.logger["miou"] / self.epoch_length)
+            self.logger["loss"].append(self.logger["running_loss"] / self.epoch_length)
             visualize_logger(self.logger, self.config["save_files_path"])
             self.save_checkpoint()
             if epoch == self.config["num_epochs"] - 1:
@@ -400,7 +503,6 @@ class GridTrainer:
             self.load_after_restart(name=checkpoint)  # load the most recent log data
         else:
             self.logger["epochs"] = [-1]
-        self.dataset.set_start_index(0)
         self.dataset.apply_transform = False
         running_loss = 0
         with torch.no_grad():
@@ -409,10 +511,17 @@ class GridTrainer:
             self.model.start_eval()
             metrics = defaultdict(AverageMeter)
             to_PIL = T.ToPILImage()
+            start_frame = 0
             if random_start:
-                start_index = np.random.choice(range(len(self.dataset) - eval_length))
-                self.dataset.set_start_index(int(start_index))
-            loader = DataLoader(dataset=self.dataset, batch_size=self.batch_size, shuffle=False)
+                # start at the first frame of a clip that leaves enough frames for eval_length batches, such that the
+                # hidden state is reset by the first batch
+                last_start = len(self.dataset) - (eval_length + 1) * self.batch_size
+                starts = [int(offset) for offset in self.dataset.clip_offsets[:-1] if offset <= last_start]
+                start_frame = int(np.random.choice(starts)) if starts else 0
+            sampler = FrameBatchSampler(len(self.dataset), batch_size=self.batch_size, start_frame=start_frame)
+            loader = DataLoader(dataset=self.dataset, batch_sampler=sampler,
+                                num_workers=self.num_workers, pin_memory=self.pin_memory)
+            loader = DevicePrefetcher(loader, self.device)
             out_folder = Path(save_file_path)
             out_folder.mkdir(parents=True, exist_ok=True)
             mode = "train" if self.dataset.train else "val"
@@ -444,9 +553,6 @@ class GridTrainer:
                 sys.stderr.write("\n" + self.time_logger.get_status() + "\n")
                 start = time.time()
                 idx, video_start, (images, labels) = batch
-                if torch.sum(idx == 0) > 1:
-                    sys.stderr.write(f"\nlen: {len(self.dataset)}; eval_length: {eval_length}; idx: {idx}\n")
-                images, labels = (images.to(self.device), labels.to(self.device))
                 if torch.any(video_start.bool()):
                     self.model.reset()
                 pred = self.model(images)
@@ -550,13 +656,14 @@ class GridTrainer:
         self.set_seeds(seed=0)
         print("dataset seed: ", self.dataset.seed)
         self.load_after_restart(name=checkpoint)
-        self.dataset.set_start_index(0)
         durations = []
         with torch.no_grad():
             self.model.eval()
             self.model.start_eval()
             to_PIL = T.ToPILImage()
-            loader = DataLoader(dataset=self.dataset, batch_size=batch_size, shuffle=False)
+            loader = DataLoader(dataset=self.dataset, batch_sampler=FrameBatchSampler(len(self.dataset), batch_size),
+                                num_workers=self.num_workers, pin_memory=self.pin_memory)
+            loader = DevicePrefetcher(loader, self.device)
             out_folder = Path(self.config["save_files_path"]) / "example_results"
             out_folder.mkdir(parents=True, exist_ok=True)
             mode = "train" if not self.test else "val"
@@ -567,7 +674,6 @@ class GridTrainer:
                 start = time.time()
                 idx, video_start, (images, labels) = batch
                 print("index: ", idx)
-                images, labels = (images.to(self.device), labels.to(self.device))
                 if torch.any(video_start.bool()):
                     self.model.reset()
                 pred = self.model(images)
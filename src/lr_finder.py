@@ -25,6 +25,11 @@ args = parser.parse_args()
 
 with open(args.config) as js:
     config = json.load(js)
+    config["feature_cache"] = False  # the lr finder runs the whole model
+    config["device_augmentation"] = False  # the lr finder does not apply the batch augmentation of the trainer
+    config["online_compositing"] = False  # nor the backgrounds of the green screen frames
+    # the lr finder feeds (B, C, H, W) batches of consecutive frames to the model, not (B, T) windows of clips
+    config["sequence_length"] = None
 
 historys = []
 weight_decays = [0, 1e-4, 1e-6, 1e-8]
@@ -36,7 +41,7 @@ for wd in weight_decays:
     trainer = GridTrainer(config, load_from_checkpoint=False, batch_size=config["batch_size"])
     model = trainer.model
     criterion = trainer.criterion
-    val_dataset = YT_Greenscreen(train=False, start_index=0,
+    val_dataset = YT_Greenscreen(train=False,
                                  batch_size=config["batch_size"])  #
     val_loader = DataLoader(val_dataset, val_dataset.batch_size, shuffle=False)  # val_dataset.batch_size
     optimizer = optim.Adam(model.parameters(), lr=1e-7, weight_decay=wd)
@@ -15,8 +15,173 @@ V1 - 5 for lstm and gru
 (V6 is created through different V5 initialization)
 """
 
+class DeeplabWrapper(nn.Module):
+    """
+    Common base of the Deeplab alternations. The forward pass is split into the frozen backbone and the trainable rest
+    of the model (the head):
+    forward(x) = forward_head(backbone_features(x), input_shape)
+    such that the head can also be trained from backbone features that have been computed in advance
+    (see src/dataset/feature_cache.py).
+    A frozen backbone (see freeze_backbone()) runs without autograd and with its BatchNorm layers in eval mode, also
+    while the head is trained.
+    The recurrent models keep their hidden states and previous predictions in a RecurrentState (self.state), which
+    implements reset(), detach(), start_eval() and end_eval() for all of them. Every batch position is a separate
+    stream, reset(mask) only clears the streams that start a new video clip.
+    For inference the backbone and the ASPP can be restricted to keyframes (see set_keyframes()).
+    """
+    backbone_frozen = False
+    state = None  # RecurrentState, None for models without a recurrent state
+    keyframes = False
+    keyframe_interval = None
+    keyframe_threshold = None
+    num_keyframes = 0  # number of keyframes since set_keyframes()
+
+    def freeze_backbone(self):
+        """
+        stops the training of the backbone: its parameters do not require gradients, its activations are not stored
+        for the backward pass and its BatchNorm statistics are not updated anymore
+        """
+        for param in self.base.backbone.parameters():
+            param.requires_grad = False
+        self.backbone_frozen = True
+        self.base.backbone.eval()
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.backbone_frozen:
+            self.base.backbone.eval()
+        return self
+
+    def backbone_features(self, x):
+        """
+        :param x: input images (B, 3, H, W)
+        :return: dict with the "out" and "low_level" features of the backbone
+        """
+        if self.backbone_frozen:
+            with torch.no_grad():
+                return self.base.backbone(x)
+        return self.base.backbone(x)
+
+    def segment(self, features, input_shape):
+        """
+        deeplab classifier upsampled to the input size (the deeplab model without its backbone)
+        :param features: backbone features
+        :param input_shape: (H, W) of the input images
+        :return: prediction (B, 2, H, W)
+        """
+        out = self.base.classifier(features)
+        return F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
+
+    def forward_head(self, features, input_shape):
+        """
+        forward pass of everything after the backbone
+        :param features: backbone features (see backbone_features())
+        :param input_shape: (H, W) of the input images
+        :return: prediction (B, 2, H, W)
+        """
+        raise NotImplementedError
+
+    def head(self):
+        """
+        :return: the deeplab head with the ASPP (the classifier of the base model or of the GRU V3 / V4 models)
+        """
+        return self.base.classifier if self.base.classifier is not None else self.classifier
+
+    def set_keyframes(self, interval=1, threshold=None):
+        """
+        Keyframe inference: the backbone after its low level features and the ASPP only run on keyframes. The other
+        frames reuse the ASPP output of the last keyframe of their stream, only the low level features, their projection
+        and the rest of the head (e.g. the ConvGRU / ConvLSTM) are computed.
+        The keyframe cache of every stream is part of the recurrent state, the first frame of a clip is always a
+        keyframe. Only used in eval mode, has to be set before the first frame (the state is reset).
+        :param interval: maximum number of frames from one keyframe to the next (1: every frame is a keyframe),
+                         None for adaptive keyframes only (requires a threshold)
+        :param threshold: adaptive keyframes, a frame is also a keyframe if the mean absolute difference of its low level
+                          features to the ones of the keyframe, relative to their mean absolute value, exceeds threshold
+        """
+        if interval is None and threshold is None:
+            raise ValueError("keyframes need an interval or a threshold")
+        self.reset()
+        self.keyframes = threshold is not None or interval is None or interval > 1
+        self.keyframe_interval = interval
+        self.keyframe_threshold = threshold
+        self.num_keyframes = 0
+        names = ["key_left", "key_aspp", "key_low_level"]
+        for name in names:
+            setattr(self, name, None)
+        if self.keyframes and (self.state is None or names[0] not in self.state.names):
+            self.state = RecurrentState(self, (self.state.names if self.state is not None else []) + names)
+
+    def is_keyframe(self, low_level):
+        """
+        :param low_level: low level features of the batch
+        :return: bool tensor (B,), True for the frames that are keyframes of their stream
+        """
+        if self.key_left is None or self.key_low_level.shape != low_level.shape:
+            return torch.ones(low_level.size(0), dtype=torch.bool, device=low_level.device)
+        keyframe = self.key_left <= 0  # also after a reset of the stream
+        if self.keyframe_threshold is not None:
+            change = (low_level - self.key_low_level).abs().flatten(1).mean(1)
+            keyframe |= change > self.keyframe_threshold * (self.key_low_level.abs().flatten(1).mean(1) + 1e-6)
+        return keyframe
+
+    def keyframe_features(self, x):
+        """
+        backbone features with the ASPP output of the keyframes (see set_keyframes())
+        :param x: input images (B, 3, H, W)
+        :return: dict with the "low_level" features and the "aspp" output of the last keyframe of every stream
+        """
+        backbone = self.base.backbone
+        low_layers, high_layers = backbone.split("low_level")
+        low_level, _ = backbone.run(x, low_layers)
+        keyframe = self.is_keyframe(low_level)
+        idx = keyframe.nonzero().flatten()
+        self.num_keyframes += len(idx)
+        if len(idx) > 0:
+            _, features = backbone.run(low_level.index_select(0, idx), high_layers)
+            aspp = self.head().aspp(features["out"])
+            if self.key_left is None or self.key_low_level.shape != low_level.shape:
+                self.key_left = low_level.new_zeros(low_level.size(0))
+                self.key_low_level = torch.zeros_like(low_level)
+                self.key_aspp = aspp.new_zeros((low_level.size(0),) + tuple(aspp.shape[1:]))
+            self.key_aspp.index_copy_(0, idx, aspp)
+            self.key_low_level.index_copy_(0, idx, low_level.index_select(0, idx))
+        if self.keyframe_interval is not None:
+            self.key_left = torch.where(keyframe, torch.full_like(self.key_left, self.keyframe_interval - 1),
+                                        self.key_left - 1)
+        else:  # only a reset of the stream (key_left = 0) or the threshold lead to the next keyframe
+            self.key_left = torch.ones_like(self.key_left)
+        return {"low_level": low_level, "aspp": self.key_aspp}
+
+    def forward(self, x, *args):
+        if self.keyframes and not self.training:
+            with torch.no_grad():
+                return self.forward_head(self.keyframe_features(x), x.shape[-2:])
+        return self.forward_head(self.backbone_features(x), x.shape[-2:])
+
+    def reset(self, mask=None):
+        """
+        resets the recurrent state at the start of a new video clip
+        :param mask: bool tensor (B,) of the batch slots that start a new clip, None resets all slots
+        """
+        if self.state is not None:
+            self.state.reset(mask)
+
+    def detach(self):
+        if self.state is not None:
+            self.state.detach()
+
+    def start_eval(self):
+        if self.state is not None:
+            self.state.start_eval()
+
+    def end_eval(self):
+        if self.state is not None:
+            self.state.end_eval()
+
+
 # BASE
-class Deeplabv3Plus_base(nn.Module):
+class Deeplabv3Plus_base(DeeplabWrapper):
     """
     base model with either a mobilenet or resnet backbone.
 
@@ -28,25 +193,14 @@ class Deeplabv3Plus_base(nn.Module):
             self.base = deeplabv3plus_mobilenet(num_classes=2, pretrained_backbone=True)
         elif backbone == "resnet50":
             self.base = deeplabv3plus_resnet50(num_classes=2, pretrained_backbone=True)
-    def detach(self):
-        pass
-
-    def reset(self):
-        pass
 
-    def start_eval(self):
-        pass
-
-    def end_eval(self):
-        pass
-
-    def forward(self, x, *args):
-        return self.base(x)
+    def forward_head(self, features, input_shape):
+        return self.segment(features, input_shape)
 
 
 # --- LSTMs ---
 
-class Deeplabv3Plus_lstmV1(nn.Module):
+class Deeplabv3Plus_lstmV1(DeeplabWrapper):
     """
     Base model with lstm that receives no additional timesteps.
     Lstm is located at the end of the model.
@@ -62,32 +216,16 @@ class Deeplabv3Plus_lstmV1(nn.Module):
                              bias=True,
                              return_all_layers=False)
         self.hidden = None
-        self.tmp_hidden = None
-
-    def detach(self):
-        self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
-
-    def reset(self):
-        self.hidden = None
+        self.state = RecurrentState(self, ["hidden"])
 
-    def start_eval(self):
-        self.tmp_hidden = self.hidden
-        self.hidden = None
-
-    def end_eval(self):
-        self.hidden = self.tmp_hidden
-        self.tmp_hidden = None
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        out = self.base(x)
-        out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
+    def forward_head(self, features, input_shape):
+        out = self.segment(features, input_shape)
         out = out.unsqueeze(1)
         out, self.hidden = self.lstm(out, self.hidden)
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         return out[-1].squeeze(1)
 
-class Deeplabv3Plus_lstmV2(nn.Module):
+class Deeplabv3Plus_lstmV2(DeeplabWrapper):
     """
     Base model with lstm that receives 2 additional timesteps.
     Lstm is located at the end of the model.
@@ -104,53 +242,22 @@ class Deeplabv3Plus_lstmV2(nn.Module):
                              return_all_layers=True)
 
         self.hidden = None
-        self.tmp_hidden = None
-        self.tmp_old_pred = [None, None]
-        self.old_pred = [None, None]
-
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.hidden = None
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
+        self.state = RecurrentState(self, ["hidden", "old_pred"])
 
-    def start_eval(self):
-        self.tmp_hidden = self.hidden
-        self.hidden = None
-        self.tmp_old_pred = self.old_pred
-        self.old_pred = [None, None]
-
-    def end_eval(self):
-        self.hidden = self.tmp_hidden
-        self.tmp_hidden = None
-        self.old_pred = self.tmp_old_pred
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        x = self.base(x)
-        out = F.interpolate(x, size=input_shape, mode='bilinear', align_corners=False)
+    def forward_head(self, features, input_shape):
+        out = self.segment(features, input_shape)
         out = out.unsqueeze(1)
-        if None in self.old_pred:
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = torch.zeros_like(out)
-        # match shape
-        elif len(self.old_pred[0].shape) != len(out.shape):
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = self.old_pred[i].unsqueeze(1)
-        out = self.old_pred + [out]
-        out = torch.cat(out, dim=1)
+        out = self.old_pred.push(out)
 
         out, self.hidden = self.lstm(out, self.hidden)
         out = out[0]
         out = out[:, -1, :, :, :]  # <--- not to sure if 0 or -1
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
-        self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-        self.old_pred[1] = out.unsqueeze(1).detach()  # newest at 1 position
+        self.old_pred.update(out.unsqueeze(1))
         return out
 
-class Deeplabv3Plus_lstmV3(nn.Module):
+class Deeplabv3Plus_lstmV3(DeeplabWrapper):
     """
     Base model with lstm that receives no additional timesteps.
     Lstm is located after concatenation of encoder output and low level features.
@@ -166,35 +273,12 @@ class Deeplabv3Plus_lstmV3(nn.Module):
             in_channels = 2048
             low_level_channels = 256
         self.base.classifier = DeepLabHeadV3PlusLSTM(in_channels, low_level_channels, 2, [12, 24, 36])
-        self.tmp_old_pred = [None, None]
-        self.tmp_hidden = None
+        self.state = RecurrentState(self, ["base.classifier.hidden", "base.classifier.old_pred"])
 
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.base.classifier.hidden = None
-        self.base.classifier.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.base.classifier.hidden
-        self.tmp_old_pred = self.base.classifier.old_pred
-        self.reset()
-
-    def end_eval(self):
-        self.base.classifier.hidden = self.tmp_hidden
-        self.base.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = None
-        self.tmp_old_pred = [None, None]
+    def forward_head(self, features, input_shape):
+        return self.segment(features, input_shape)
 
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        out = self.base(x)
-
-        out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
-        return out
-
-class Deeplabv3Plus_lstmV4(nn.Module):
+class Deeplabv3Plus_lstmV4(DeeplabWrapper):
     """
     Base model with lstm that receives two additional timesteps.
     Lstm is located after concatenation of encoder output and low level features.
@@ -211,34 +295,12 @@ class Deeplabv3Plus_lstmV4(nn.Module):
             low_level_channels = 256
         self.base.classifier = DeepLabHeadV3PlusLSTM(in_channels, low_level_channels, 2, [12, 24, 36],
                                                      store_previous=True)
-        self.tmp_old_pred = [None, None]
-        self.tmp_hidden = None
-
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.base.classifier.hidden = None
-        self.base.classifier.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.base.classifier.hidden
-        self.tmp_old_pred = self.base.classifier.old_pred
-        self.reset()
-
-    def end_eval(self):
-        self.base.classifier.hidden = self.tmp_hidden
-        self.base.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = None
-        self.tmp_old_pred = [None, None]
+        self.state = RecurrentState(self, ["base.classifier.hidden", "base.classifier.old_pred"])
 
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        out = self.base(x)
-        out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
-        return out
+    def forward_head(self, features, input_shape):
+        return self.segment(features, input_shape)
 
-class Deeplabv3Plus_lstmV5(nn.Module):
+class Deeplabv3Plus_lstmV5(DeeplabWrapper):
     """
     Base model with lstm that uses 1x1 convolutions to reduce complexity.
     Lstm is located after concatenation of encoder output and low level features.
@@ -255,34 +317,12 @@ class Deeplabv3Plus_lstmV5(nn.Module):
             low_level_channels = 256
         self.base.classifier = DeepLabHeadV3PlusLSTMV2(in_channels, low_level_channels, 2, [12, 24, 36],
                                                      store_previous=store_previous)
-        self.tmp_old_pred = [None, None]
-        self.tmp_hidden = None
+        self.state = RecurrentState(self, ["base.classifier.hidden", "base.classifier.old_pred"])
 
-    def detach(self):
-        pass
+    def forward_head(self, features, input_shape):
+        return self.segment(features, input_shape)
 
-    def reset(self):
-        self.base.classifier.hidden = None
-        self.base.classifier.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.base.classifier.hidden
-        self.tmp_old_pred = self.base.classifier.old_pred
-        self.reset()
-
-    def end_eval(self):
-        self.base.classifier.hidden = self.tmp_hidden
-        self.base.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = None
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        out = self.base(x)
-        out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
-        return out
-
-class Deeplabv3Plus_lstmV7(nn.Module):
+class Deeplabv3Plus_lstmV7(DeeplabWrapper):
     """
     test version;
     """
@@ -300,58 +340,26 @@ class Deeplabv3Plus_lstmV7(nn.Module):
                              bias=True,
                              return_all_layers=return_all_layers)
         self.hidden = None
-        self.tmp_hidden = None
         self.keep_hidden = keep_hidden
-        self.tmp_old_pred = [None, None]
-        self.old_pred = [None, None]
-
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.hidden = None
-        self.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.hidden
-        self.hidden = None
-        self.tmp_old_pred = self.old_pred
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
+        self.state = RecurrentState(self, ["hidden", "old_pred"])
 
-    def end_eval(self):
-        self.hidden = self.tmp_hidden
-        self.tmp_hidden = None
-        self.old_pred = self.tmp_old_pred
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        x = self.base(x)
-        out = F.interpolate(x, size=input_shape, mode='bilinear', align_corners=False)
+    def forward_head(self, features, input_shape):
+        out = self.segment(features, input_shape)
         out = out.unsqueeze(1)
 
-        # initialize if necessary
-        if None in self.old_pred:
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = torch.zeros_like(out)
-        # match shape
-        elif len(self.old_pred[0].shape) != len(out.shape):
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = self.old_pred[i].unsqueeze(1)
-        out = self.old_pred + [out]
-        out = torch.cat(out, dim=1)
+        out = self.old_pred.push(out)
         if self.keep_hidden:
             out, self.hidden = self.lstm(out, self.hidden)
         else:
             out, self.hidden = self.lstm(out)
         out = out[0][:, -1, :, :, :]  # <--- not to sure if 0 or -1
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
-        self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-        self.old_pred[1] = out.unsqueeze(1).detach()
+        self.old_pred.update(out.unsqueeze(1))
         return out
 
 # --- GRU ---
-class Deeplabv3Plus_gruV1(nn.Module):
+class Deeplabv3Plus_gruV1(DeeplabWrapper):
     """
     Base model with gru that receives no additional timesteps.
     Gru is located at the end of the model.
@@ -366,31 +374,17 @@ class Deeplabv3Plus_gruV1(nn.Module):
         self.gru = ConvGRU(input_size=(270, 512), input_dim=2, hidden_dim=[2], kernel_size=(3, 3), num_layers=1,
                            dtype=torch.FloatTensor, batch_first=True, bias=True, return_all_layers=True)
         self.hidden = [None]
-        self.tmp_hidden = None
-
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.hidden = [None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.hidden
-        self.hidden = [None]
-
-    def end_eval(self):
-        self.hidden = self.tmp_hidden
-        self.tmp_hidden = [None]
+        self.state = RecurrentState(self, ["hidden"])
 
-    def forward(self, x, *args):
-        x = self.base(x)
+    def forward_head(self, features, input_shape):
+        x = self.segment(features, input_shape)
         x = x.unsqueeze(1)
         out, self.hidden = self.gru(x, self.hidden[-1])
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out = out[0][:, -1, :, :, :]
         return out
 
-class Deeplabv3Plus_gruV2(nn.Module):
+class Deeplabv3Plus_gruV2(DeeplabWrapper):
     """
     Base model with gru that receives two additional timesteps.
     Gru is located at the end of the model.
@@ -405,52 +399,23 @@ class Deeplabv3Plus_gruV2(nn.Module):
         self.gru = ConvGRU(input_size=(270, 512), input_dim=2, hidden_dim=[2], kernel_size=(3, 3), num_layers=1,
                            dtype=torch.FloatTensor, batch_first=True, bias=True, return_all_layers=True)
         self.hidden = [None]
-        self.tmp_hidden = [None]
-        self.old_pred = [None, None]
-        self.tmp_old_pred = [None, None]
-
-    def detach(self):
-        pass
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
+        self.state = RecurrentState(self, ["hidden", "old_pred"])
 
-    def reset(self):
-        self.hidden = [None]
-        self.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.hidden
-        self.hidden = [None]
-        self.tmp_old_pred = self.old_pred
-        self.old_pred = [None, None]
-
-    def end_eval(self):
-        self.hidden = self.tmp_hidden
-        self.tmp_hidden = [None]
-        self.old_pred = self.tmp_old_pred
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        out = self.base(x)
+    def forward_head(self, features, input_shape):
+        out = self.segment(features, input_shape)
         out = out.unsqueeze(1)  # add "timestep" dimension
 
-        if None in self.old_pred:
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = torch.zeros_like(out)
-        # match shape
-        elif len(self.old_pred[0].shape) != len(out.shape):
-            for i in range(len(self.old_pred)):
-                self.old_pred[i] = self.old_pred[i].unsqueeze(1)  # add "timestep" dimension
-        out = self.old_pred + [out]
-        out = torch.cat(out, dim=1)
+        out = self.old_pred.push(out)
         out, self.hidden = self.gru(out, self.hidden[-1])
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out = out[0]
         # out = self.conv3d(out)
         out = out[:, -1, :, :, :]  # <--- not to sure if 0 or -1
-        self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-        self.old_pred[1] = out.unsqueeze(1).detach()  # newest at 1 position
+        self.old_pred.update(out.unsqueeze(1))
         return out
 
-class Deeplabv3Plus_gruV3(nn.Module):
+class Deeplabv3Plus_gruV3(DeeplabWrapper):
     """
     Base model with gru that receives no additional timesteps.
     Gru is located after concatenation of encoder output and low level features.
@@ -468,37 +433,14 @@ class Deeplabv3Plus_gruV3(nn.Module):
         self.base.classifier = None
         self.classifier = DeepLabHeadV3PlusGRU(in_channels, low_level_channels, 2, [12, 24, 36],
                                                store_previous=False).to(device)
-        self.hidden = self.classifier.hidden
-        self.tmp_hidden = None
-        self.classifier.old_pred = [None, None]
-        self.tmp_old_pred = [None, None]
-    def detach(self):
-        pass
+        self.state = RecurrentState(self, ["classifier.hidden", "classifier.old_pred"])
 
-    def reset(self):
-        self.classifier.hidden = [None]
-        self.classifier.old_pred = [None, None]
-
-    def start_eval(self):
-        self.tmp_hidden = self.classifier.hidden
-        self.tmp_old_pred = self.classifier.old_pred
-        self.classifier.hidden = [None]
-        self.classifier.old_pred = [None, None]
-
-    def end_eval(self):
-        self.classifier.hidden = self.tmp_hidden
-        self.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = [None]
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        features = self.base.backbone(x)
+    def forward_head(self, features, input_shape):
         out = self.classifier(features)
         out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
         return out
 
-class Deeplabv3Plus_gruV4(nn.Module):
+class Deeplabv3Plus_gruV4(DeeplabWrapper):
     """
     Base model with gru that receives two additional timesteps.
     Gru is located after concatenation of encoder output and low level features.
@@ -516,37 +458,14 @@ class Deeplabv3Plus_gruV4(nn.Module):
         self.base.classifier = None
         self.classifier = DeepLabHeadV3PlusGRU(in_channels, low_level_channels, 2, [12, 24, 36],
                                                store_previous=True).to(device)
-        self.hidden = self.classifier.hidden
-        self.tmp_hidden = None
-        self.classifier.old_pred = [None, None]
-        self.tmp_old_pred = [None, None]
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.classifier.hidden = [None]
-        self.classifier.old_pred = [None, None]
+        self.state = RecurrentState(self, ["classifier.hidden", "classifier.old_pred"])
 
-    def start_eval(self):
-        self.tmp_hidden = self.classifier.hidden
-        self.tmp_old_pred = self.classifier.old_pred
-        self.classifier.hidden = [None]
-        self.classifier.old_pred = [None, None]
-
-    def end_eval(self):
-        self.classifier.hidden = self.tmp_hidden
-        self.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = [None]
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        features = self.base.backbone(x)
+    def forward_head(self, features, input_shape):
         out = self.classifier(features)
         out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
         return out
 
-class Deeplabv3Plus_gruV5(nn.Module):
+class Deeplabv3Plus_gruV5(DeeplabWrapper):
     """
     Base model with gru that uses 1x1 convolutions to reduce complexity.
     Gru is located after concatenation of encoder output and low level features.
@@ -563,29 +482,7 @@ class Deeplabv3Plus_gruV5(nn.Module):
             low_level_channels = 256
         self.base.classifier = DeepLabHeadV3PlusGRUV2(in_channels, low_level_channels, 2, [12, 24, 36],
                                                      store_previous=store_previous)
-        self.tmp_old_pred = [None, None]
-        self.tmp_hidden = None
-
-    def detach(self):
-        pass
-
-    def reset(self):
-        self.base.classifier.hidden = [None]
-        self.base.classifier.old_pred = [None, None]
+        self.state = RecurrentState(self, ["base.classifier.hidden", "base.classifier.old_pred"])
 
-    def start_eval(self):
-        self.tmp_hidden = self.base.classifier.hidden
-        self.tmp_old_pred = self.base.classifier.old_pred
-        self.reset()
-
-    def end_eval(self):
-        self.base.classifier.hidden = self.tmp_hidden
-        self.base.classifier.old_pred = self.tmp_old_pred
-        self.tmp_hidden = None
-        self.tmp_old_pred = [None, None]
-
-    def forward(self, x, *args):
-        input_shape = x.shape[-2:]
-        out = self.base(x)
-        out = F.interpolate(out, size=input_shape, mode='bilinear', align_corners=False)
-        return out
+    def forward_head(self, features, input_shape):
+        return self.segment(features, input_shape)
@@ -1,7 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import functional as F
-from src.models.recurrent_modules import ConvGRU, ConvLSTM
+from src.models.recurrent_modules import ConvGRU, ConvLSTM, TemporalWindow
 from src.models.network.utils import _SimpleSegmentationModel
 
 __all__ = ["DeepLabV3"]
@@ -9,6 +9,18 @@ __all__ = ["DeepLabV3"]
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
+def aspp_features(aspp, feature):
+    """
+    :param aspp: ASPP module of a head
+    :param feature: backbone features, optionally with the ASPP output of the last keyframe ("aspp", see
+                    DeeplabWrapper.set_keyframes())
+    :return: ASPP output of the "out" features, or the given ASPP output
+    """
+    if "aspp" in feature:
+        return feature["aspp"]
+    return aspp(feature["out"])
+
+
 class DeepLabV3(_SimpleSegmentationModel):
     """
     Implements DeepLabV3 model from
@@ -64,7 +76,7 @@ class DeepLabHeadV3PlusGRU(nn.Module):
                            dtype=torch.FloatTensor, batch_first=True, bias=True, return_all_layers=True)
         self.hidden = [None]
         self.store_previous = store_previous
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
 
     def forward(self, feature):
         """
@@ -73,7 +85,7 @@ class DeepLabHeadV3PlusGRU(nn.Module):
         :return: model output
         """
         low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
+        output_feature = aspp_features(self.aspp, feature)
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear',
                                        align_corners=False)
         concat = torch.cat([low_level_feature, output_feature], dim=1)
@@ -81,17 +93,12 @@ class DeepLabHeadV3PlusGRU(nn.Module):
 
         # store previous predictions to be used by gru
         if self.store_previous:
-            if None in self.old_pred:
-                for i in range(len(self.old_pred)):
-                    self.old_pred[i] = torch.zeros_like(out)
-            out = torch.cat(self.old_pred + [out], dim=1)
+            out = self.old_pred.push(out)
         out, self.hidden = self.gru(out, self.hidden[-1])
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out = out[0][:, -1, :, :, :].unsqueeze(1)
         if self.store_previous:
-            # out = self.conv3d(out)
-            self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-            self.old_pred[1] = out.detach()  # newest at 1 position
+            self.old_pred.update(out)
         return self.classifier(out[:, -1, :, :, :])
 
     def _init_weight(self):
@@ -152,7 +159,7 @@ class DeepLabHeadV3PlusGRUV2(nn.Module):
                            dtype=torch.FloatTensor, batch_first=True, bias=True, return_all_layers=True)
         self.hidden = [None]
         self.store_previous = store_previous
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
 
     def forward(self, feature):
         """
@@ -162,7 +169,7 @@ class DeepLabHeadV3PlusGRUV2(nn.Module):
         :return: model output
         """
         low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
+        output_feature = aspp_features(self.aspp, feature)
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear',
                                        align_corners=False)
         out = torch.cat([low_level_feature, output_feature], dim=1)
@@ -170,18 +177,14 @@ class DeepLabHeadV3PlusGRUV2(nn.Module):
         out_B = self.conv_1x1_B(out)
         out_A = out_A.unsqueeze(1)
         if self.store_previous:
-            if None in self.old_pred:
-                for i in range(len(self.old_pred)):
-                    self.old_pred[i] = torch.zeros_like(out_A)
-            out_A = torch.cat(self.old_pred + [out_A], dim=1)
+            out_A = self.old_pred.push(out_A)
 
         out_A, self.hidden = self.gru(out_A, self.hidden[-1])
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out_A = out_A[0][:, -1, :, :, :]
         out_A = out_A.unsqueeze(1)
         if self.store_previous:
-            self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-            self.old_pred[1] = out_A.detach()  # newest at 1 position
+            self.old_pred.update(out_A)
         out_A = out_A[:, -1, :, :, :]
         out = torch.cat([out_A, out_B], dim=1)
         return self.classifier(out)
@@ -232,7 +235,7 @@ class DeepLabHeadV3PlusLSTM(nn.Module):
                              return_all_layers=False)
         self.hidden = None
         self.store_previous = store_previous
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
 
     def forward(self, feature):
         """
@@ -242,24 +245,19 @@ class DeepLabHeadV3PlusLSTM(nn.Module):
         :return: model output
         """
         low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
+        output_feature = aspp_features(self.aspp, feature)
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear',
                                        align_corners=False)
         concat = torch.cat([low_level_feature, output_feature], dim=1)
         out = concat.unsqueeze(1)
         if self.store_previous:
-            if None in self.old_pred:
-                for i in range(len(self.old_pred)):
-                    self.old_pred[i] = torch.zeros_like(out)
-            out = torch.cat(self.old_pred + [out], dim=1)
+            out = self.old_pred.push(out)
 
         out, self.hidden = self.lstm(out, self.hidden)
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out = out[0][:, -1, :, :, :].unsqueeze(1)
         if self.store_previous:
-            # out = self.conv3d(out)
-            self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-            self.old_pred[1] = out.detach()  # newest at 1 position
+            self.old_pred.update(out)
         return self.classifier(out[:, -1, :, :, :])
 
     def _init_weight(self):
@@ -320,7 +318,7 @@ class DeepLabHeadV3PlusLSTMV2(nn.Module):
                              return_all_layers=False)
         self.hidden = None
         self.store_previous = store_previous
-        self.old_pred = [None, None]
+        self.old_pred = TemporalWindow(length=3)  # t-2, t-1 and t
 
     def forward(self, feature):
         """
@@ -330,7 +328,7 @@ class DeepLabHeadV3PlusLSTMV2(nn.Module):
         :return: model output
         """
         low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
+        output_feature = aspp_features(self.aspp, feature)
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear',
                                        align_corners=False)
         out = torch.cat([low_level_feature, output_feature], dim=1)
@@ -338,18 +336,14 @@ class DeepLabHeadV3PlusLSTMV2(nn.Module):
         out_B = self.conv_1x1_B(out)
         out_A = out_A.unsqueeze(1)
         if self.store_previous:
-            if None in self.old_pred:
-                for i in range(len(self.old_pred)):
-                    self.old_pred[i] = torch.zeros_like(out_A)
-            out_A = torch.cat(self.old_pred + [out_A], dim=1)
+            out_A = self.old_pred.push(out_A)
 
         out_A, self.hidden = self.lstm(out_A, self.hidden)
         self.hidden = [tuple(state.detach() for state in i) for i in self.hidden]
         out_A = out_A[0][:, -1, :, :, :]
         out_A = out_A.unsqueeze(1)
         if self.store_previous:
-            self.old_pred[0] = self.old_pred[1]  # oldest at 0 position
-            self.old_pred[1] = out_A.detach()  # newest at 1 position
+            self.old_pred.update(out_A)
         out_A = out_A[:, -1, :, :, :]
         out = torch.cat([out_A, out_B], dim=1)
         return self.classifier(out)
@@ -385,7 +379,7 @@ class DeepLabHeadV3Plus(nn.Module):
 
     def forward(self, feature):
         low_level_feature = self.project(feature['low_level'])
-        output_feature = self.aspp(feature['out'])
+        output_feature = aspp_features(self.aspp, feature)
         output_feature = F.interpolate(output_feature, size=low_level_feature.shape[2:], mode='bilinear',
                                        align_corners=False)
         return self.classifier(torch.cat([low_level_feature, output_feature], dim=1))
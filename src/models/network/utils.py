@@ -66,6 +66,29 @@ class IntermediateLayerGetter(nn.ModuleDict):
         super(IntermediateLayerGetter, self).__init__(layers)
         self.return_layers = orig_return_layers
 
+    def split(self, out_name):
+        """
+        :param out_name: name of a returned activation
+        :return: names of the layers up to the layer of the activation and names of the remaining layers
+        """
+        names = [name for name, _ in self.named_children()]
+        layer = next(name for name, new_name in self.return_layers.items() if new_name == out_name)
+        return names[:names.index(layer) + 1], names[names.index(layer) + 1:]
+
+    def run(self, x, layers):
+        """
+        runs a part of the layers, e.g. the layers after the low level features (see split())
+        :param x: input of the first layer
+        :param layers: names of consecutive layers
+        :return: output of the last layer, dict with the returned activations of the layers
+        """
+        out = OrderedDict()
+        for name in layers:
+            x = self[name](x)
+            if name in self.return_layers:
+                out[self.return_layers[name]] = x
+        return x, out
+
     def forward(self, x):
         out = OrderedDict()
         for name, module in self.named_children():
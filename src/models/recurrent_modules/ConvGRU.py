@@ -1,7 +1,6 @@
 import os
 import torch
 from torch import nn
-from torch.autograd import Variable
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
 class ConvGRUCell(nn.Module):
@@ -19,29 +18,59 @@ class ConvGRUCell(nn.Module):
         :param bias: bool
             Whether or not to add the bias.
         :param dtype: torch.cuda.FloatTensor or torch.FloatTensor
-            Whether or not to use cuda.
+            Not used anymore, the hidden state is allocated on the device and with the dtype of the weights.
         """
         super(ConvGRUCell, self).__init__()
         self.height, self.width = input_size
         self.padding = kernel_size[0] // 2, kernel_size[1] // 2
+        self.input_dim = input_dim
         self.hidden_dim = hidden_dim
         self.bias = bias
         self.dtype = dtype
 
-        self.conv_gates = nn.Conv2d(in_channels=input_dim + hidden_dim,
+        # the convolutions of the concatenated input and hidden state are split into the convolution of the input,
+        # which is computed for all timesteps at once (see ConvGRU.forward()), and the convolutions of the hidden state
+        self.conv_x = nn.Conv2d(in_channels=input_dim,
+                                out_channels=3*self.hidden_dim,  # for update_gate, reset_gate and candidate
+                                kernel_size=kernel_size,
+                                padding=self.padding,
+                                bias=self.bias)
+
+        self.conv_gates = nn.Conv2d(in_channels=hidden_dim,
                                     out_channels=2*self.hidden_dim,  # for update_gate,reset_gate respectively
                                     kernel_size=kernel_size,
                                     padding=self.padding,
-                                    bias=self.bias)
-
-        self.conv_can = nn.Conv2d(in_channels=input_dim+hidden_dim,
-                              out_channels=self.hidden_dim, # for candidate neural memory
-                              kernel_size=kernel_size,
-                              padding=self.padding,
-                              bias=self.bias)
-
-    def init_hidden(self, batch_size):
-        return (Variable(torch.zeros(batch_size, self.hidden_dim, self.height, self.width)).type(self.dtype))
+                                    bias=False)
+
+        self.conv_can = nn.Conv2d(in_channels=hidden_dim,
+                                  out_channels=self.hidden_dim,  # for candidate neural memory
+                                  kernel_size=kernel_size,
+                                  padding=self.padding,
+                                  bias=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the split convolve the concatenated input and hidden state in conv_gates and conv_can
+        weight = state_dict.get(prefix + "conv_gates.weight")
+        if weight is not None and weight.size(1) == self.input_dim + self.hidden_dim:
+            can_weight = state_dict[prefix + "conv_can.weight"]
+            state_dict[prefix + "conv_x.weight"] = torch.cat([weight[:, :self.input_dim],
+                                                              can_weight[:, :self.input_dim]], dim=0)
+            state_dict[prefix + "conv_gates.weight"] = weight[:, self.input_dim:]
+            state_dict[prefix + "conv_can.weight"] = can_weight[:, self.input_dim:]
+            if prefix + "conv_gates.bias" in state_dict:
+                state_dict[prefix + "conv_x.bias"] = torch.cat([state_dict.pop(prefix + "conv_gates.bias"),
+                                                                state_dict.pop(prefix + "conv_can.bias")])
+        super(ConvGRUCell, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def init_hidden(self, batch_size, image_size=None):
+        """
+        :param batch_size: int
+        :param image_size: (int, int) height and width of the hidden state, by default the input_size of the cell
+        :return: zero hidden state on the device and with the dtype of the weights
+        """
+        height, width = image_size if image_size is not None else (self.height, self.width)
+        weight = self.conv_can.weight
+        return torch.zeros(batch_size, self.hidden_dim, height, width, device=weight.device, dtype=weight.dtype)
 
     def forward(self, input_tensor, h_cur):
         """
@@ -53,19 +82,26 @@ class ConvGRUCell(nn.Module):
         :return: h_next,
             next hidden state
         """
-        h_cur = h_cur.to(device)
-        combined = torch.cat([input_tensor, h_cur], dim=1)
-        combined_conv = self.conv_gates(combined)
+        return self.step(self.conv_x(input_tensor), h_cur)
 
-        gamma, beta = torch.split(combined_conv, self.hidden_dim, dim=1)
-        reset_gate = torch.sigmoid(gamma)
-        update_gate = torch.sigmoid(beta)
+    def step(self, input_conv, h_cur):
+        """
+        :param input_conv: conv_x of the input (b, 3 * c_hidden, h, w)
+        :param h_cur: (b, c_hidden, h, w)
+            current hidden state
+        :return: h_next,
+            next hidden state
+        The step only consists of tensor operations (no allocation of the state, no device copies and no
+        concatenations), such that the cell can be compiled with torch.jit.script.
+        """
+        x_gates, x_can = torch.split(input_conv, [2*self.hidden_dim, self.hidden_dim], dim=1)
+        gates = torch.sigmoid(x_gates + self.conv_gates(h_cur))  # both gates with one sigmoid
+        reset_gate, update_gate = torch.split(gates, self.hidden_dim, dim=1)
 
-        combined = torch.cat([input_tensor, reset_gate*h_cur], dim=1)
-        cc_cnm = self.conv_can(combined)
-        cnm = torch.tanh(cc_cnm)
+        cnm = torch.tanh(x_can + self.conv_can(reset_gate*h_cur))
 
-        h_next = (1 - update_gate) * h_cur + update_gate * cnm
+        # (1 - update_gate) * h_cur + update_gate * cnm
+        h_next = torch.lerp(h_cur, cnm, update_gate)
         return h_next
 
 
@@ -85,7 +121,7 @@ class ConvGRU(nn.Module):
         :param num_layers: int
             Number of ConvLSTM layers
         :param dtype: torch.cuda.FloatTensor or torch.FloatTensor
-            Whether or not to use cuda.
+            Not used anymore, the hidden state is allocated on the device and with the dtype of the weights.
         :param alexnet_path: str
             pretrained alexnet parameters
         :param batch_first: bool
@@ -143,7 +179,7 @@ class ConvGRU(nn.Module):
             hidden_state = hidden_state
             # raise NotImplementedError()
         else:
-            hidden_state = self._init_hidden(batch_size=input_tensor.size(0))
+            hidden_state = self._init_hidden(batch_size=input_tensor.size(0), image_size=input_tensor.shape[-2:])
 
         layer_output_list = []
         last_state_list   = []
@@ -153,11 +189,15 @@ class ConvGRU(nn.Module):
 
         for layer_idx in range(self.num_layers):
             h = hidden_state[layer_idx]
+            cell = self.cell_list[layer_idx]
+            # input convolution of all timesteps in one batch, only the hidden state is convolved per timestep
+            b = cur_layer_input.size(0)
+            input_conv = cell.conv_x(cur_layer_input.reshape(b * seq_len, *cur_layer_input.shape[2:]))
+            input_conv = input_conv.view(b, seq_len, *input_conv.shape[1:])  # (b,t,3*c_hidden,h,w)
             output_inner = []
             for t in range(seq_len):
-                # input current hidden and cell state then compute the next hidden and cell state through ConvLSTMCell forward function
-                h = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :], # (b,t,c,h,w)
-                                              h_cur=h)
+                # input current hidden state then compute the next hidden state through ConvGRUCell.step
+                h = cell.step(input_conv[:, t], h_cur=h)
                 output_inner.append(h)
 
             layer_output = torch.stack(output_inner, dim=1)
@@ -172,10 +212,10 @@ class ConvGRU(nn.Module):
 
         return layer_output_list, last_state_list
 
-    def _init_hidden(self, batch_size):
+    def _init_hidden(self, batch_size, image_size=None):
         init_states = []
         for i in range(self.num_layers):
-            init_states.append(self.cell_list[i].init_hidden(batch_size))
+            init_states.append(self.cell_list[i].init_hidden(batch_size, image_size))
         return init_states
 
     @staticmethod
@@ -29,21 +29,41 @@ class ConvLSTMCell(nn.Module):
         self.padding = kernel_size[0] // 2, kernel_size[1] // 2
         self.bias = bias
 
-        self.conv = nn.Conv2d(in_channels=self.input_dim + self.hidden_dim,
-                              out_channels=4 * self.hidden_dim,
-                              kernel_size=self.kernel_size,
-                              padding=self.padding,
-                              bias=self.bias)
+        # the convolution of the concatenated input and hidden state is split into the convolution of the input,
+        # which is computed for all timesteps at once (see ConvLSTM.forward()), and the convolution of the hidden state
+        self.conv_x = nn.Conv2d(in_channels=self.input_dim,
+                                out_channels=4 * self.hidden_dim,
+                                kernel_size=self.kernel_size,
+                                padding=self.padding,
+                                bias=self.bias)
+        self.conv_h = nn.Conv2d(in_channels=self.hidden_dim,
+                                out_channels=4 * self.hidden_dim,
+                                kernel_size=self.kernel_size,
+                                padding=self.padding,
+                                bias=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints before the split contain one convolution "conv" of the concatenated input and hidden state
+        if prefix + "conv.weight" in state_dict:
+            weight = state_dict.pop(prefix + "conv.weight")
+            state_dict[prefix + "conv_x.weight"] = weight[:, :self.input_dim]
+            state_dict[prefix + "conv_h.weight"] = weight[:, self.input_dim:]
+            if prefix + "conv.bias" in state_dict:
+                state_dict[prefix + "conv_x.bias"] = state_dict.pop(prefix + "conv.bias")
+        super(ConvLSTMCell, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, input_tensor, cur_state):
-        h_cur, c_cur = cur_state
-
-
-        # sys.stderr.write("\n "+ str(input_tensor.shape) + " and " + str( h_cur.shape)+ "\n")
+        return self.step(self.conv_x(input_tensor), cur_state)
 
-        combined = torch.cat([input_tensor, h_cur], dim=1)  # concatenate along channel axis
+    def step(self, input_conv, cur_state):
+        """
+        :param input_conv: conv_x of the input (b, 4 * hidden_dim, h, w)
+        :param cur_state: (h, c)
+        :return: next (h, c)
+        """
+        h_cur, c_cur = cur_state
 
-        combined_conv = self.conv(combined)
+        combined_conv = input_conv + self.conv_h(h_cur)
         cc_i, cc_f, cc_o, cc_g = torch.split(combined_conv, self.hidden_dim, dim=1)
         i = torch.sigmoid(cc_i)
         f = torch.sigmoid(cc_f)
@@ -57,8 +77,9 @@ class ConvLSTMCell(nn.Module):
 
     def init_hidden(self, batch_size, image_size):
         height, width = image_size
-        return (torch.zeros(batch_size, self.hidden_dim, height, width, device=self.conv.weight.device),
-                torch.zeros(batch_size, self.hidden_dim, height, width, device=self.conv.weight.device))
+        weight = self.conv_h.weight
+        return (torch.zeros(batch_size, self.hidden_dim, height, width, device=weight.device, dtype=weight.dtype),
+                torch.zeros(batch_size, self.hidden_dim, height, width, device=weight.device, dtype=weight.dtype))
 
 
 class ConvLSTM(nn.Module):
@@ -160,10 +181,13 @@ class ConvLSTM(nn.Module):
         for layer_idx in range(self.num_layers):
 
             h, c = hidden_state[layer_idx]
+            cell = self.cell_list[layer_idx]
+            # input convolution of all timesteps in one batch, only the hidden state is convolved per timestep
+            input_conv = cell.conv_x(cur_layer_input.reshape(b * seq_len, *cur_layer_input.shape[2:]))
+            input_conv = input_conv.view(b, seq_len, *input_conv.shape[1:])
             output_inner = []
             for t in range(seq_len):
-                h, c = self.cell_list[layer_idx](input_tensor=cur_layer_input[:, t, :, :, :],
-                                                 cur_state=[h, c])
+                h, c = cell.step(input_conv[:, t], cur_state=[h, c])
 
                 output_inner.append(h)
 
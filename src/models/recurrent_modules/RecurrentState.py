@@ -0,0 +1,170 @@
+import copy
+import torch
+from src.models.recurrent_modules.TemporalWindow import TemporalWindow
+
+
+def _tensors(value):
+    """
+    :param value: state attribute, e.g. the hidden state list of ConvLSTM ([(h, c), ...]) or ConvGRU ([(h,), ...])
+    :return: all tensors of the value
+    """
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (list, tuple)):
+        return [tensor for element in value for tensor in _tensors(element)]
+    return []
+
+
+def map_state(function, value):
+    """
+    :param function: function that is applied to every tensor
+    :param value: state attribute (tensor, nested lists / tuples of tensors or None)
+    :return: value of the same structure with the results of the function instead of the tensors
+    """
+    if isinstance(value, torch.Tensor):
+        return function(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(map_state(function, element) for element in value)
+    return value
+
+
+def slot_mask(mask, tensor):
+    """
+    :param mask: bool tensor (B,), True for the batch slots that are reset
+    :param tensor: state tensor (B, ...)
+    :return: float mask (B, 1, ...) that is 0 for the reset slots and 1 otherwise, broadcastable to the tensor
+    """
+    keep = (~mask.to(device=tensor.device, dtype=torch.bool)).to(tensor.dtype)
+    return keep.view((-1,) + (1,) * (tensor.dim() - 1))
+
+
+class RecurrentState:
+    """
+    Recurrent state of a model: the hidden (and cell) states of its ConvLSTM / ConvGRU modules and the TemporalWindows
+    of the previous predictions. The state is kept in attributes of the model (or of its head), which are given as
+    dotted paths relative to the model, e.g. "hidden" or "base.classifier.old_pred".
+
+    Every batch position (slot) is an independent stream of frames. reset() with a mask only sets the state of the
+    slots that start a new video clip to zero (in place), the other slots keep their state. Since the first state of a
+    clip is zero, this is the same as starting the clip with an empty state.
+
+    :param model: the model that holds the state
+    :param names: dotted paths of the state attributes, their current values are the initial (empty) state
+    """
+    def __init__(self, model, names):
+        """
+        see help(RecurrentState)
+        """
+        self.model = model
+        self.names = list(names)
+        self.initial = {name: copy.copy(self.get(name)) for name in self.names
+                        if not isinstance(self.get(name), TemporalWindow)}
+        self.stash = None
+
+    def get(self, name):
+        value = self.model
+        for attribute in name.split("."):
+            value = getattr(value, attribute)
+        return value
+
+    def set(self, name, value):
+        owner, _, attribute = name.rpartition(".")
+        setattr(self.get(owner) if owner else self.model, attribute, value)
+
+    def clear(self, name):
+        """
+        sets a state attribute to its initial value
+        """
+        value = self.get(name)
+        if isinstance(value, TemporalWindow):
+            value.reset()
+        else:
+            self.set(name, copy.copy(self.initial[name]))
+
+    def reset(self, mask=None):
+        """
+        resets the state at the start of a new video clip
+        :param mask: bool tensor (B,) of the slots that start a new clip, None resets all slots
+        """
+        if mask is not None:
+            mask = torch.as_tensor(mask, dtype=torch.bool).flatten()
+            if not bool(mask.any()):
+                return
+            if bool(mask.all()):
+                mask = None
+        for name in self.names:
+            value = self.get(name)
+            if mask is None:
+                self.clear(name)
+            elif isinstance(value, TemporalWindow):
+                value.reset(mask)
+            else:
+                tensors = _tensors(value)
+                if any(tensor.size(0) != mask.numel() for tensor in tensors):  # state of a different batch size
+                    self.clear(name)
+                    continue
+                with torch.no_grad():
+                    for tensor in tensors:
+                        tensor.mul_(slot_mask(mask, tensor))
+
+    def detach(self):
+        """
+        cuts the state off the graph of the previous frames
+        """
+        for name in self.names:
+            if not isinstance(self.get(name), TemporalWindow):  # the windows only contain detached predictions
+                self.set(name, map_state(torch.Tensor.detach, self.get(name)))
+
+    def export(self):
+        """
+        :return: list with the value of every state attribute (see names), the TemporalWindows are exported as their
+                 previous predictions (see TemporalWindow.previous()). All tensors have the batch slots as first
+                 dimension, an empty state is None.
+        """
+        values = []
+        for name in self.names:
+            value = self.get(name)
+            if isinstance(value, TemporalWindow):
+                values.append(value.previous())
+            else:
+                values.append(value if _tensors(value) else None)
+        return values
+
+    def load(self, values):
+        """
+        sets the state to values exported by export(), e.g. the state of other streams
+        :param values: list with the value of every state attribute, None sets the attribute to its initial value
+        """
+        for name, value in zip(self.names, values):
+            current = self.get(name)
+            if isinstance(current, TemporalWindow):
+                current.load_previous(value)
+            elif value is None:
+                self.clear(name)
+            else:
+                self.set(name, value)
+
+    def start_eval(self):
+        """
+        stores the state of the training and starts the evaluation with an empty state
+        """
+        self.stash = {}
+        for name in self.names:
+            value = self.get(name)
+            if isinstance(value, TemporalWindow):
+                value.start_eval()
+            else:
+                self.stash[name] = value
+                self.clear(name)
+
+    def end_eval(self):
+        """
+        restores the state of the training
+        """
+        for name in self.names:
+            value = self.get(name)
+            if isinstance(value, TemporalWindow):
+                value.end_eval()
+            else:
+                self.set(name, self.stash[name])
+        self.stash = None
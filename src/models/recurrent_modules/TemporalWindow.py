@@ -0,0 +1,103 @@
+import torch
+
+
+class TemporalWindow:
+    """
+    Input window of the recurrent modules that receive additional timesteps: the (detached) predictions of the
+    previous length - 1 frames, oldest first, followed by the current frame.
+
+    The window is kept in one preallocated tensor (B, 2 * length, C, H, W) that is used as a ring buffer. Each frame is
+    written twice, at slot s = n % length and at slot s + length, so that the last `length` frames are always the
+    contiguous view buffer[:, s + 1:s + 1 + length] in chronological order. The predictions are not shifted through a
+    list and the window is not concatenated per frame.
+    While gradients are computed, the window is returned as a new tensor instead of the view: autograd keeps the input
+    of every timestep until the backward pass, but the buffer is overwritten by the next frame.
+
+    :param length: number of timesteps of the window (previous predictions and the current frame)
+    """
+    def __init__(self, length=3):
+        """
+        see help(TemporalWindow)
+        """
+        self.length = length
+        self.buffer = None
+        self.position = 0  # slot of the current frame
+        self.stash = None
+
+    def reset(self, mask=None):
+        """
+        sets the previous predictions to zero, e.g. at the start of a new video clip
+        :param mask: bool tensor (B,) of the batch slots that are reset, None resets all slots
+        """
+        if self.buffer is None:
+            return
+        if mask is None or mask.numel() != self.buffer.size(0):
+            self.buffer.zero_()
+        else:
+            keep = (~mask.to(device=self.buffer.device, dtype=torch.bool)).to(self.buffer.dtype)
+            self.buffer.mul_(keep.view((-1,) + (1,) * (self.buffer.dim() - 1)))
+
+    def start_eval(self):
+        """
+        stores the window of the training and starts with an empty window
+        """
+        self.stash = (self.buffer, self.position)
+        self.buffer, self.position = None, 0
+
+    def end_eval(self):
+        """
+        restores the window of the training
+        """
+        self.buffer, self.position = self.stash
+        self.stash = None
+
+    def previous(self):
+        """
+        :return: the previous predictions (B, length - 1, C, H, W), oldest first, None if the window is empty
+        """
+        if self.buffer is None:
+            return None
+        start = self.position + 1
+        return self.buffer[:, start:start + self.length - 1]
+
+    def load_previous(self, previous):
+        """
+        replaces the previous predictions, e.g. by the predictions of other streams
+        :param previous: tensor (B, length - 1, C, H, W) as returned by previous(), None empties the window
+        """
+        if previous is None:
+            self.buffer, self.position = None, 0
+            return
+        self.buffer = previous.new_zeros((previous.size(0), 2 * self.length) + tuple(previous.shape[2:]))
+        self.position = self.length - 1  # the window is buffer[:, length:2 * length]
+        with torch.no_grad():
+            self.buffer[:, :self.length - 1].copy_(previous)
+            self.buffer[:, self.length:2 * self.length - 1].copy_(previous)
+
+    def _write(self, frame):
+        with torch.no_grad():
+            self.buffer[:, self.position].copy_(frame[:, 0])
+            self.buffer[:, self.position + self.length].copy_(frame[:, 0])
+
+    def push(self, frame):
+        """
+        :param frame: current frame (B, 1, C, H, W)
+        :return: window (B, length, C, H, W), the previous predictions are zero after a reset
+        """
+        if self.buffer is None or self.buffer.shape[:1] + self.buffer.shape[2:] != frame.shape[:1] + frame.shape[2:] \
+                or self.buffer.device != frame.device or self.buffer.dtype != frame.dtype:
+            self.buffer = frame.new_zeros((frame.size(0), 2 * self.length) + tuple(frame.shape[2:]))
+            self.position = 0
+        start = self.position + 1
+        if torch.is_grad_enabled() and frame.requires_grad:
+            return torch.cat([self.buffer[:, start:start + self.length - 1], frame], dim=1)
+        self._write(frame)
+        return self.buffer[:, start:start + self.length]
+
+    def update(self, pred):
+        """
+        replaces the current frame of the window by its prediction and moves the window to the next frame
+        :param pred: prediction of the current frame (B, 1, C, H, W)
+        """
+        self._write(pred.detach())
+        self.position = (self.position + 1) % self.length
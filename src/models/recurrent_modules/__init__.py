@@ -1,2 +1,4 @@
 from .ConvGRU import *
-from .ConvLSTM import *
\ No newline at end of file
+from .ConvLSTM import *
+from .TemporalWindow import *
+from .RecurrentState import *
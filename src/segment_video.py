@@ -0,0 +1,130 @@
+import argparse
+import cv2
+import numpy as np
+import torch
+from src.dataset.pipeline import Pipeline
+from src.video_segmenter import VideoSegmenter
+
+"""
+Segments a video file (any size and frame rate) with a trained model and writes the mask video or the video with a
+replaced background.
+
+The frames flow in chunks through a thread pipeline with bounded queues (see src/dataset/pipeline.py):
+decode -> resize (to the input size of the model, BGR -> RGB) -> infer -> composite (upsampling of the prediction) ->
+encode (cv2.VideoWriter)
+All stages run at the same time, the frames per second of every stage are printed at the end. The models without
+recurrent state (e.g. "Deep+_mobile") segment every chunk in one batch. The recurrent models depend on the previous
+frame, they segment the frames of a chunk one after another with the state of the video (see src/video_segmenter.py).
+
+Usage:
+    python -m src.segment_video -pth src/models/trained_models/yt_fullV4/<model folder> -i in.mp4 -o out.mp4
+        [--output_mode mask|composite] [--background image.jpg]
+"""
+
+GREEN = (0, 255, 0)  # BGR background of the composite without a background image
+
+
+def segment_video(segmenter, in_path, out_path, output_mode="composite", background=None, chunk_size=8, maxsize=4):
+    """
+    :param segmenter: VideoSegmenter of the model
+    :param in_path: input video
+    :param out_path: output video (mp4v)
+    :param output_mode: "mask" writes the mask (white for the person), "composite" replaces the background
+    :param background: path of the background image of the composite, by default a green screen
+    :param chunk_size: number of frames per pipeline item (batch size of the models without recurrent state)
+    :param maxsize: capacity of the queues between the stages (in chunks)
+    :return: the pipeline (for its statistics)
+    """
+    if output_mode not in ("mask", "composite"):
+        raise ValueError("unknown output_mode {!r}".format(output_mode))
+    cap = cv2.VideoCapture(str(in_path))
+    if not cap.isOpened():
+        raise IOError("cannot open {}".format(in_path))
+    fps = cap.get(cv2.CAP_PROP_FPS) or 29
+    size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+    bgimg = cv2.resize(cv2.imread(str(background)), size) if background is not None else \
+        np.full((size[1], size[0], 3), GREEN, dtype=np.uint8)
+    stream_id = str(in_path)
+    segmenter.close_stream(stream_id)  # a new video starts with an empty state
+    writer = cv2.VideoWriter(str(out_path), cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+
+    def decode(cap):
+        frames = []
+        while True:
+            ret, frame = cap.read()
+            if not ret:
+                break
+            frames.append(frame)
+            if len(frames) == chunk_size:
+                yield np.stack(frames)
+                frames = []
+        if frames:
+            yield np.stack(frames)
+
+    def resize(frames):
+        inputs = np.stack([cv2.cvtColor(cv2.resize(frame, segmenter.input_size, interpolation=cv2.INTER_AREA),
+                                        cv2.COLOR_BGR2RGB) for frame in frames])
+        yield frames, inputs
+
+    def infer(item):
+        frames, inputs = item
+        images = segmenter.to_input(inputs)
+        if segmenter.model.state is None:  # the frames are independent
+            pred = segmenter.predict(images, list(range(len(images))))
+        else:
+            pred = torch.cat([segmenter.predict(images[k:k + 1], [stream_id]) for k in range(len(images))])
+        # probability of the person at the input size of the model
+        yield frames, torch.softmax(pred.float(), dim=1)[:, 1].cpu().numpy()
+
+    def composite(item):
+        frames, alphas = item
+        outputs = np.empty_like(frames)
+        for k, (frame, alpha) in enumerate(zip(frames, alphas)):
+            alpha = cv2.resize(alpha, size, interpolation=cv2.INTER_LINEAR)
+            if output_mode == "mask":
+                outputs[k] = ((alpha > 0.5) * 255).astype(np.uint8)[..., None]
+            else:
+                alpha = alpha[..., None]
+                outputs[k] = (alpha * frame + (1 - alpha) * bgimg).astype(np.uint8)
+        yield outputs
+
+    def encode(outputs):
+        for frame in outputs:
+            writer.write(frame)
+        yield outputs
+
+    pipeline = Pipeline([("decode", decode, 1), ("resize", resize, 1), ("infer", infer, 1),
+                         ("composite", composite, 1), ("encode", encode, 1)], maxsize=maxsize,
+                        count=lambda item: len(item[0]) if isinstance(item, tuple) else len(item))
+    try:
+        pipeline.run([cap])
+    finally:
+        cap.release()
+        writer.release()
+        segmenter.close_stream(stream_id)
+    return pipeline
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-pth", "--path", type=str, required=True,
+                        help="folder of the trained model (with train_config.json and the checkpoint)")
+    parser.add_argument("--checkpoint", type=str, default="best_checkpoint.pth.tar",
+                        help="name of the checkpoint in the folder")
+    parser.add_argument("-i", "--input", type=str, required=True, help="input video")
+    parser.add_argument("-o", "--output", type=str, required=True, help="output video (mp4v)")
+    parser.add_argument("--output_mode", type=str, default="composite", choices=["mask", "composite"],
+                        help="write the mask or replace the background")
+    parser.add_argument("--background", type=str, default=None,
+                        help="background image of the composite, by default a green screen")
+    parser.add_argument("--chunk_size", type=int, default=8, help="number of frames per pipeline item")
+    parser.add_argument("--keyframe_interval", type=int, default=1,
+                        help="the backbone and the ASPP only run every k frames (see DeeplabWrapper.set_keyframes())")
+    parser.add_argument("--keyframe_threshold", type=float, default=None, help="threshold of adaptive keyframes")
+    args = parser.parse_args()
+
+    segmenter = VideoSegmenter.from_folder(args.path, checkpoint=args.checkpoint, max_streams=1)
+    segmenter.set_keyframes(args.keyframe_interval, args.keyframe_threshold)
+    pipeline = segment_video(segmenter, args.input, args.output, output_mode=args.output_mode,
+                             background=args.background, chunk_size=args.chunk_size)
+    pipeline.print_stats()
@@ -0,0 +1,338 @@
+import argparse
+import asyncio
+import json
+import socket
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from src.video_segmenter import VideoSegmenter
+
+"""
+Local segmentation server: serves the frames of many clients (streams) with one model in one process.
+
+Every connection is one video stream. The frames of all connections are collected into micro batches: a batch is
+started as soon as it contains a frame of every connected stream, it is full (max_batch) or the oldest frame waited
+max_latency milliseconds. The batch is segmented by a VideoSegmenter, which moves the recurrent state of every stream
+into its batch slot. The latency of every frame is split into the queueing time (waiting for the batch) and the compute
+time (forward pass of the batch), both are reported in every response and summarized on stderr.
+
+Protocol (Unix socket or TCP on localhost), every message is a JSON line, optionally followed by raw bytes:
+    client: {"cmd": "frame", "height": h, "width": w}  followed by h * w * 3 bytes (RGB uint8)
+    server: {"height": h, "width": w, "queue_ms": ..., "compute_ms": ..., "batch_size": ...}  followed by h * w bytes
+            (uint8 mask, 1 for the person)
+    client: {"cmd": "reset"}  starts the stream with an empty state (e.g. after a scene cut), server: {}
+    client: {"cmd": "stats"}  server: latency statistics of the server (see LatencyStats.summary())
+On errors the server answers {"error": "..."}. The height and width of a frame must be in 1..MAX_FRAME_SIZE, otherwise
+the length of the raw bytes is unknown and the server closes the connection after the error. The state of a stream is
+freed when its connection is closed.
+
+Usage:
+    python -m src.segmentation_server -pth src/models/trained_models/yt_fullV4/<model folder> --socket /tmp/seg.sock
+    client = SegmentationClient(socket_path="/tmp/seg.sock")
+    mask, info = client.segment(frame)
+"""
+
+MAX_FRAME_SIZE = 4096  # maximum height and width of a frame
+
+
+class LatencyStats:
+    """
+    queueing and compute latency of the last `window` frames
+    """
+    def __init__(self, window=1000):
+        """
+        see help(LatencyStats)
+        """
+        self.queue_ms = deque(maxlen=window)
+        self.compute_ms = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.frames = 0
+
+    def add(self, queue_ms, compute_ms, batch_size):
+        self.queue_ms.append(queue_ms)
+        self.compute_ms.append(compute_ms)
+        self.batch_sizes.append(batch_size)
+        self.frames += 1
+
+    def summary(self):
+        """
+        :return: dict with the number of frames, the mean batch size and mean / 50th / 95th percentile of the latencies
+        """
+        summary = {"frames": self.frames}
+        if not self.queue_ms:
+            return summary
+        summary["batch_size"] = float(np.mean(self.batch_sizes))
+        for name, values in (("queue_ms", self.queue_ms), ("compute_ms", self.compute_ms)):
+            summary[name] = {"mean": float(np.mean(values)),
+                             "p50": float(np.percentile(values, 50)),
+                             "p95": float(np.percentile(values, 95))}
+        return summary
+
+    def print(self, file=sys.stderr):
+        summary = self.summary()
+        if "batch_size" not in summary:
+            return
+        file.write("{} frames, batch size {:.1f}, queue {:.1f}ms (p95 {:.1f}ms), compute {:.1f}ms (p95 {:.1f}ms)\n".format(
+            summary["frames"], summary["batch_size"], summary["queue_ms"]["mean"], summary["queue_ms"]["p95"],
+            summary["compute_ms"]["mean"], summary["compute_ms"]["p95"]))
+
+
+class _Request:
+    def __init__(self, stream_id, frame, future):
+        self.stream_id = stream_id
+        self.frame = frame
+        self.future = future
+        self.arrival = time.perf_counter()
+
+
+class SegmentationServer:
+    """
+    asyncio server that segments the frames of all connections in micro batches (see the module docstring).
+
+    :param segmenter: VideoSegmenter, its max_streams is the maximum number of connections
+    :param max_latency: maximum time in milliseconds a frame waits for other frames of its batch
+    :param max_batch: maximum number of frames of a batch, by default the max_streams of the segmenter
+    :param report_interval: seconds between the latency summaries on stderr, None disables them
+    """
+    def __init__(self, segmenter, max_latency=10., max_batch=None, report_interval=30.):
+        """
+        see help(SegmentationServer)
+        """
+        self.segmenter = segmenter
+        self.max_latency = max_latency / 1000.
+        self.max_batch = max_batch if max_batch is not None else segmenter.table.capacity
+        self.report_interval = report_interval
+        self.stats = LatencyStats()
+        self.pending = deque()
+        self.arrived = None
+        self.streams = set()  # stream ids of the open connections
+        self.next_id = 0
+        # the model runs in one thread, so the event loop keeps accepting frames during the forward pass and the slots
+        # of the segmenter are only changed by this thread
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def take(self, batch, streams):
+        """
+        moves the pending frames into the batch in the order of their arrival, at most one frame per stream
+        """
+        rest = deque()
+        while self.pending:
+            request = self.pending.popleft()
+            if len(batch) < self.max_batch and request.stream_id not in streams:
+                batch.append(request)
+                streams.add(request.stream_id)
+            else:
+                rest.append(request)
+        self.pending = rest
+
+    async def batches(self):
+        """
+        collects and segments the micro batches
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            while not self.pending:
+                self.arrived.clear()
+                await self.arrived.wait()
+            deadline = self.pending[0].arrival + self.max_latency
+            batch, streams = [], set()
+            self.take(batch, streams)
+            # no other frame can join the batch if every open stream has a frame in it
+            while len(batch) < self.max_batch and not self.streams <= streams:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self.arrived.clear()
+                try:
+                    await asyncio.wait_for(self.arrived.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self.take(batch, streams)
+            await self.run_batch(loop, batch)
+
+    async def run_batch(self, loop, batch):
+        start = time.perf_counter()
+        try:
+            masks = await loop.run_in_executor(self.executor, self.segmenter.segment,
+                                               [request.frame for request in batch],
+                                               [request.stream_id for request in batch])
+        except Exception as e:
+            if len(batch) == 1:
+                if not batch[0].future.done():
+                    batch[0].future.set_exception(e)
+                return
+            # one bad frame must not fail the frames of the other streams
+            for request in batch:
+                await self.run_batch(loop, [request])
+            return
+        compute_ms = (time.perf_counter() - start) * 1000
+        for request, mask in zip(batch, masks):
+            queue_ms = (start - request.arrival) * 1000
+            self.stats.add(queue_ms, compute_ms, len(batch))
+            if not request.future.done():
+                request.future.set_result((mask, {"queue_ms": queue_ms, "compute_ms": compute_ms,
+                                                  "batch_size": len(batch)}))
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.stats.print()
+
+    async def segment(self, stream_id, frame):
+        """
+        :return: mask of the frame and the latencies of the frame
+        """
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append(_Request(stream_id, frame, future))
+        self.arrived.set()
+        return await future
+
+    async def handle(self, reader, writer):
+        """
+        serves one connection (stream)
+        """
+        loop = asyncio.get_running_loop()
+        stream_id = self.next_id
+        self.next_id += 1
+        if len(self.streams) >= self.segmenter.table.capacity:
+            await reader.readline()  # the error is the answer to the first request
+            writer.write(_message({"error": "the server is full ({} streams)".format(self.segmenter.table.capacity)}))
+            await writer.drain()
+            writer.close()
+            return
+        self.streams.add(stream_id)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                try:
+                    request = json.loads(line)
+                    cmd = request.get("cmd", "frame")
+                    if cmd == "frame":
+                        height, width = int(request["height"]), int(request["width"])
+                        if not (0 < height <= MAX_FRAME_SIZE and 0 < width <= MAX_FRAME_SIZE):
+                            # the raw bytes of the frame can not be skipped, the connection is closed
+                            writer.write(_message({"error": "invalid frame size {}x{} (1..{})".format(
+                                height, width, MAX_FRAME_SIZE)}))
+                            await writer.drain()
+                            break
+                        data = await reader.readexactly(height * width * 3)
+                        frame = np.frombuffer(data, dtype=np.uint8).reshape(height, width, 3)
+                        mask, info = await self.segment(stream_id, frame)
+                        writer.write(_message(dict(height=height, width=width, **info)) + mask.tobytes())
+                    elif cmd == "reset":
+                        await loop.run_in_executor(self.executor, self.segmenter.reset_stream, stream_id)
+                        writer.write(_message({}))
+                    elif cmd == "stats":
+                        writer.write(_message(self.stats.summary()))
+                    else:
+                        raise ValueError("unknown command {!r}".format(cmd))
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    raise
+                except Exception as e:  # the connection stays open, e.g. after a malformed request
+                    writer.write(_message({"error": str(e)}))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.streams.discard(stream_id)
+            await loop.run_in_executor(self.executor, self.segmenter.close_stream, stream_id)
+            writer.close()
+
+    async def serve(self, socket_path=None, port=8765):
+        """
+        serves until the task is cancelled
+        :param socket_path: path of a Unix socket, if None the server listens on localhost:port
+        """
+        self.arrived = asyncio.Event()
+        if socket_path is not None:
+            server = await asyncio.start_unix_server(self.handle, path=str(socket_path))
+        else:
+            server = await asyncio.start_server(self.handle, host="127.0.0.1", port=port)
+        tasks = [asyncio.ensure_future(self.batches())]
+        if self.report_interval:
+            tasks.append(asyncio.ensure_future(self.report()))
+        sys.stderr.write("Serving on {}\n".format(socket_path if socket_path is not None else "127.0.0.1:{}".format(port)))
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.stats.print()
+
+
+def _message(header):
+    return (json.dumps(header) + "\n").encode()
+
+
+class SegmentationClient:
+    """
+    blocking client of one stream
+
+    :param socket_path: path of the Unix socket of the server, if None the server is reached on localhost:port
+    """
+    def __init__(self, socket_path=None, port=8765):
+        """
+        see help(SegmentationClient)
+        """
+        if socket_path is not None:
+            self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.socket.connect(str(socket_path))
+        else:
+            self.socket = socket.create_connection(("127.0.0.1", port))
+        self.file = self.socket.makefile("rwb")
+
+    def request(self, header, data=b""):
+        self.file.write(_message(header) + data)
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    def segment(self, frame):
+        """
+        :param frame: RGB uint8 frame (H, W, 3)
+        :return: uint8 mask (H, W), dict with the queue_ms, compute_ms and batch_size of the frame
+        """
+        frame = np.ascontiguousarray(frame, dtype=np.uint8)
+        response = self.request({"cmd": "frame", "height": frame.shape[0], "width": frame.shape[1]}, frame.tobytes())
+        mask = np.frombuffer(self.file.read(response["height"] * response["width"]), dtype=np.uint8)
+        return mask.reshape(response["height"], response["width"]), response
+
+    def reset(self):
+        self.request({"cmd": "reset"})
+
+    def stats(self):
+        return self.request({"cmd": "stats"})
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-pth", "--path", type=str, required=True,
+                        help="folder of the trained model (with train_config.json and the checkpoint)")
+    parser.add_argument("--checkpoint", type=str, default="best_checkpoint.pth.tar",
+                        help="name of the checkpoint in the folder")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="path of a Unix socket, by default the server listens on localhost:port")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--max_streams", type=int, default=8, help="maximum number of connections")
+    parser.add_argument("--max_batch", type=int, default=None, help="maximum batch size, by default max_streams")
+    parser.add_argument("--max_latency", type=float, default=10.,
+                        help="maximum time in milliseconds a frame waits for the other frames of its batch")
+    args = parser.parse_args()
+
+    segmenter = VideoSegmenter.from_folder(args.path, checkpoint=args.checkpoint, max_streams=args.max_streams)
+    server = SegmentationServer(segmenter, max_latency=args.max_latency, max_batch=args.max_batch)
+    try:
+        asyncio.run(server.serve(socket_path=args.socket, port=args.port))
+    except KeyboardInterrupt:
+        pass
@@ -157,9 +157,8 @@ def initiate_model(config):
         upper_lr_bound = None
         wd = 0
 
+    net.freeze_backbone()
     net.train()
-    for param in net.base.backbone.parameters():
-        param.requires_grad = False
 
     return net, wd, (lower_lr_bound, upper_lr_bound), detach_interval
 
@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from torch.utils.data import DataLoader
 
 from packaging import version
+from src.dataset.prefetcher import to_model_input
 
 PYTORCH_VERSION = version.parse(torch.__version__)
 
@@ -368,6 +369,9 @@ class LRFinder(object):
             inputs, labels = self._move_to_device(
                 inputs, labels, non_blocking=non_blocking_transfer
             )
+            # uint8 frames of the dataset are scaled to [0, 1] on the device
+            inputs, labels = to_model_input(inputs, labels)
+            # the batch positions are consecutive frames of the same clip (see src.dataset.samplers.FrameBatchSampler)
             if torch.any(video_start):
                 self.model.reset()
             # Forward pass
@@ -428,6 +432,7 @@ class LRFinder(object):
                 inputs, labels = self._move_to_device(
                     inputs, labels, non_blocking=non_blocking_transfer
                 )
+                inputs, labels = to_model_input(inputs, labels)
 
                 if isinstance(inputs, tuple) or isinstance(inputs, list):
                     batch_size = inputs[0].size(0)
@@ -0,0 +1,195 @@
+import json
+import cv2
+import numpy as np
+import torch
+from pathlib import Path
+from src.models.recurrent_modules import map_state
+from src.utils import initiator
+
+"""
+Stateful inference of the trained models on live video, independent of the YT_Greenscreen dataset.
+
+Several streams (e.g. cameras) share one model. Their frames are tagged with a stream id and the frames of different
+streams are segmented in one batch. The recurrent state of every stream (ConvLSTM / ConvGRU hidden states and the
+previous predictions, see src.models.recurrent_modules.RecurrentState) is stored in a row (slot) of a SlotTable and
+moved into the batch position of the stream before every forward pass.
+
+Example:
+    segmenter = VideoSegmenter.from_folder("src/models/trained_models/yt_fullV4/<model folder>")
+    masks = segmenter.segment([frame_cam_a, frame_cam_b], ["a", "b"])  # RGB uint8 frames, uint8 masks (0 or 1)
+"""
+
+INPUT_SIZE = (512, 270)  # (width, height) of the frames of the training (see Vid2Img_preprocess.py)
+
+
+class SlotTable:
+    """
+    States of up to `capacity` streams. Every state tensor of the model (B, ...) is stored in a table tensor
+    (capacity, ...), which is allocated when the model returns its first state. New streams start with a zero state,
+    which equals the empty state of a new video clip.
+
+    :param capacity: maximum number of streams
+    """
+    def __init__(self, capacity):
+        """
+        see help(SlotTable)
+        """
+        self.capacity = capacity
+        self.slots = {}  # stream id -> slot
+        self.free = list(range(capacity))
+        self.values = None  # state values as exported by RecurrentState.export() with capacity rows
+
+    def slot(self, stream_id):
+        """
+        :return: slot of the stream, a free slot with a zero state is assigned to new streams
+        """
+        if stream_id not in self.slots:
+            if not self.free:
+                raise ValueError("all {} slots are in use, close a stream first".format(self.capacity))
+            self.slots[stream_id] = self.free.pop(0)
+            self.clear(self.slots[stream_id])
+        return self.slots[stream_id]
+
+    def clear(self, slot):
+        if self.values is not None:
+            for value in self.values:
+                map_state(lambda table: table[slot].zero_(), value)
+
+    def release(self, stream_id):
+        """
+        frees the slot of a stream
+        """
+        if stream_id in self.slots:
+            self.free.append(self.slots.pop(stream_id))
+
+    def gather(self, slots):
+        """
+        :param slots: long tensor (B,) of the slots of the batch
+        :return: state values of the batch (see RecurrentState.load()), None before the first scatter()
+        """
+        if self.values is None:
+            return None
+        return [map_state(lambda table: table.index_select(0, slots.to(table.device)), value) for value in self.values]
+
+    def scatter(self, slots, values):
+        """
+        stores the state of a batch in the slots of its streams
+        :param slots: long tensor (B,) of the slots of the batch
+        :param values: state values of the batch (see RecurrentState.export())
+        """
+        if self.values is None:
+            self.values = [None] * len(values)
+        for k, value in enumerate(values):
+            if value is None:
+                continue
+            if self.values[k] is None:
+                self.values[k] = map_state(lambda tensor: tensor.new_zeros((self.capacity,) + tuple(tensor.shape[1:])),
+                                           value)
+            for table, tensor in zip(_leaves(self.values[k]), _leaves(value)):
+                table.index_copy_(0, slots.to(table.device), tensor)
+
+
+def _leaves(value):
+    leaves = []
+    map_state(leaves.append, value)
+    return leaves
+
+
+class VideoSegmenter:
+    """
+    Segments the frames of several concurrent video streams with one model.
+
+    :param config: training config of the model (only "model" is used, see src.utils.initiator.initiate_model())
+    :param checkpoint: path of a checkpoint of the GridTrainer, None keeps the initial weights
+    :param device: torch device, by default cuda if available
+    :param max_streams: maximum number of concurrent streams
+    :param input_size: (width, height) the frames are resized to
+    """
+    def __init__(self, config, checkpoint=None, device=None, max_streams=8, input_size=INPUT_SIZE):
+        """
+        see help(VideoSegmenter)
+        """
+        self.device = torch.device(device if device is not None else "cuda:0" if torch.cuda.is_available() else "cpu")
+        self.config = config
+        self.input_size = tuple(input_size)
+        self.model = initiator.initiate_model(config)[0]
+        if checkpoint is not None:
+            state = torch.load(str(checkpoint), map_location=self.device)
+            self.model.load_state_dict(state["state_dict"])
+        self.model.to(self.device)
+        self.model.eval()
+        self.table = SlotTable(max_streams)
+
+    @classmethod
+    def from_folder(cls, folder, checkpoint="best_checkpoint.pth.tar", **kwargs):
+        """
+        :param folder: folder of a trained model (save_files_path of the training)
+        :param checkpoint: name of the checkpoint in the folder
+        :return: VideoSegmenter of the model
+        """
+        with open(str(Path(folder) / "train_config.json")) as js:
+            config = json.load(js)
+        return cls(config, checkpoint=Path(folder) / checkpoint, **kwargs)
+
+    def set_keyframes(self, interval=1, threshold=None):
+        """
+        keyframe inference of the model (see DeeplabWrapper.set_keyframes()), closes all streams
+        """
+        self.model.set_keyframes(interval, threshold)
+        self.table = SlotTable(self.table.capacity)
+
+    def close_stream(self, stream_id):
+        """
+        forgets the state of a stream and frees its slot
+        """
+        self.table.release(stream_id)
+
+    def reset_stream(self, stream_id):
+        """
+        starts a stream with an empty state, e.g. after a scene cut
+        """
+        if stream_id in self.table.slots:
+            self.table.clear(self.table.slots[stream_id])
+
+    def to_input(self, frames):
+        """
+        :param frames: list of RGB uint8 frames (H, W, 3) of any size
+        :return: float tensor (B, 3, height, width) in the range [0, 1] on the device
+        """
+        batch = np.stack([cv2.resize(frame, self.input_size, interpolation=cv2.INTER_AREA)
+                          if frame.shape[1::-1] != self.input_size else frame for frame in frames])
+        return torch.from_numpy(batch).to(self.device).permute(0, 3, 1, 2).float().div_(255)
+
+    def predict(self, images, stream_ids):
+        """
+        one forward pass over the current frames of several streams
+        :param images: float tensor (B, 3, height, width) on the device, one frame per stream
+        :param stream_ids: stream id of every frame, the frames of a stream have to be passed in order
+        :return: prediction (B, 2, height, width)
+        """
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError("a batch can only contain one frame per stream")
+        with torch.no_grad():
+            state = self.model.state
+            if state is None:
+                return self.model(images)
+            slots = torch.tensor([self.table.slot(stream_id) for stream_id in stream_ids], dtype=torch.long)
+            values = self.table.gather(slots)
+            if values is None:
+                self.model.reset()
+            else:
+                state.load(values)
+            pred = self.model(images)
+            self.table.scatter(slots, state.export())
+        return pred
+
+    def segment(self, frames, stream_ids):
+        """
+        :param frames: list of RGB uint8 frames (H, W, 3), one frame per stream
+        :param stream_ids: stream id of every frame
+        :return: list of uint8 masks (H, W) with 1 for the person, in the size of the frames
+        """
+        pred = self.predict(self.to_input(frames), stream_ids)
+        masks = torch.argmax(pred, dim=1).to(torch.uint8).cpu().numpy()
+        return [cv2.resize(mask, frame.shape[1::-1], interpolation=cv2.INTER_NEAREST)
+                if mask.shape != frame.shape[:2] else mask for mask, frame in zip(masks, frames)]